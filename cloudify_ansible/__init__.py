@@ -16,11 +16,6 @@ import os
 
 from cloudify import ctx as ctx_from_import
 
-from cloudify_common_sdk.resource_downloader import untar_archive
-from cloudify_common_sdk.resource_downloader import unzip_archive
-from cloudify_common_sdk.resource_downloader import get_shared_resource
-from cloudify_common_sdk.resource_downloader import TAR_FILE_EXTENSTIONS
-
 from cloudify.exceptions import NonRecoverableError
 
 from cloudify_ansible_sdk import DIRECT_PARAMS
@@ -31,14 +26,26 @@ from cloudify_ansible.utils import (
     install_roles,
     setup_modules,
     handle_sources,
-    setup_kerberos,
     handle_site_yaml,
+    sync_playbook_dir,
+    get_playbook_source,
+    get_inventory_env,
     create_playbook_venv,
     install_extra_packages,
     create_playbook_workspace,
+    setup_kerberos_config,
+    patch_winrm_connection,
+    run_provisioning_pipeline,
+    provisioning_lock,
+    record_provisioning_plan,
     install_galaxy_collections,
+    install_galaxy_requirements,
     get_source_config_from_ctx,
     get_remerged_config_sources,
+    write_inventory_script,
+    write_inventory_token,
+    delete_inventory_token,
+    store_runtime_property,
 )
 
 
@@ -110,6 +117,16 @@ def ansible_playbook_node(func):
         additional_playbook_files = additional_playbook_files or []
         ansible_env_vars = set_ansible_env_vars(ansible_env_vars)
         _instance = get_instance(ctx)
+        # Build a deferred venv before anything is stored on the instance,
+        # since waiting for another operation's build refreshes it.
+        materialize_venv(ctx,
+                         extra_packages,
+                         galaxy_collections,
+                         roles,
+                         module_path)
+        # Like the static inventory, the dynamic one adds the hosts of
+        # related compute instances only when the sources are remerged.
+        remerge_target_hosts = bool(remerge_sources and not sources)
         if not sources:
             if remerge_sources:
                 # add sources from source node to target node
@@ -118,32 +135,20 @@ def ansible_playbook_node(func):
                 sources = get_source_config_from_ctx(ctx)
 
         # store sources in node runtime_properties
-        _instance.runtime_properties['sources'] = sources
+        store_runtime_property(ctx, constants.SOURCES, sources)
 
         try:
-            handle_venv(ctx,
-                        extra_packages,
-                        galaxy_collections,
-                        roles,
-                        module_path)
             # check if source path is provided [full path/URL]
             if playbook_source_path:
                 # here we will combine playbook_source_path with playbook_path
-                playbook_tmp_path = get_shared_resource(playbook_source_path)
-                if playbook_tmp_path == playbook_source_path:
-                    # didn't download anything so check the provided path
-                    # if file and absolute path
-                    if os.path.isfile(playbook_tmp_path) and \
-                            os.path.isabs(playbook_tmp_path):
-                        # check file type if archived
-                        file_name = playbook_tmp_path.rsplit('/', 1)[1]
-                        file_type = file_name.rsplit('.', 1)[1]
-                        if file_type == 'zip':
-                            playbook_tmp_path = \
-                                unzip_archive(playbook_tmp_path)
-                        elif file_type in TAR_FILE_EXTENSTIONS:
-                            playbook_tmp_path = \
-                                untar_archive(playbook_tmp_path)
+                # The cached tree is shared, so the playbook runs from a
+                # copy in the workspace, where the hosts file is written.
+                subtree = None
+                if get_node(ctx).properties.get('extract_playbook_subtree'):
+                    subtree = os.path.dirname(playbook_path) or None
+                playbook_tmp_path = sync_playbook_dir(
+                    get_playbook_source(ctx, playbook_source_path, subtree),
+                    ctx)
                 playbook_path = "{0}/{1}".format(playbook_tmp_path,
                                                  playbook_path)
             else:
@@ -151,10 +156,21 @@ def ansible_playbook_node(func):
                 playbook_path = handle_site_yaml(
                     playbook_path, additional_playbook_files, ctx)
 
+            if isinstance(sources, dict) and \
+                    get_node(ctx).properties.get('dynamic_inventory'):
+                # The inventory script reads the sources from the manager.
+                _instance.update()
+                inventory = write_inventory_script(
+                    ctx, remerge_target_hosts)
+                write_inventory_token(ctx)
+                ansible_env_vars.update(get_inventory_env(ctx))
+            else:
+                inventory = handle_sources(sources, playbook_path, ctx)
+
             playbook_args = {
                 'playbook_path': playbook_path,
                 'module_path': _instance.runtime_properties.get('module_path'),
-                'sources': handle_sources(sources, playbook_path, ctx),
+                'sources': inventory,
                 'verbosity': debug_level,
                 'additional_args': additional_args or '',
                 'logger': ctx.logger
@@ -177,6 +193,8 @@ def ansible_playbook_node(func):
                         ' so skipping storing facts.')
                     return
                 raise e
+            finally:
+                delete_inventory_token(ctx)
         except NonRecoverableError as e:
             raise e
 
@@ -200,21 +218,86 @@ def prepare_ansible_node(func):
     return wrapper
 
 
+def materialize_venv(ctx=None,
+                     extra_packages=None,
+                     galaxy_collections=None,
+                     roles=None,
+                     module_path=None):
+    """Prepare the venv for a playbook run. A venv that was deferred with
+    lazy_venv is built here, once, under a per-instance lock. Operations
+    that waited for the lock reuse the venv built by the first one.
+    """
+    ctx = ctx or ctx_from_import
+    _instance = get_instance(ctx)
+    if constants.PROVISIONING_PLAN not in _instance.runtime_properties:
+        return handle_venv(ctx,
+                           extra_packages,
+                           galaxy_collections,
+                           roles,
+                           module_path,
+                           materialize=True)
+    with provisioning_lock(ctx):
+        _instance.refresh(force=True)
+        plan = _instance.runtime_properties.get(constants.PROVISIONING_PLAN)
+        if plan is None:
+            ctx.logger.info('Reusing the Ansible venv built by another '
+                            'operation.')
+            return
+        ctx.logger.info('Creating the deferred Ansible venv.')
+        handle_venv(ctx,
+                    extra_packages or plan.get('extra_packages'),
+                    galaxy_collections or plan.get('galaxy_collections'),
+                    roles or plan.get('roles'),
+                    module_path or plan.get('module_path'),
+                    materialize=True)
+        del _instance.runtime_properties[constants.PROVISIONING_PLAN]
+        _instance.update()
+
+
 def handle_venv(ctx=None,
                 extra_packages=None,
                 galaxy_collections=None,
                 roles=None,
-                module_path=None):
+                module_path=None,
+                materialize=False):
     ctx = ctx or ctx_from_import
-    extra_packages = extra_packages or get_node(ctx).properties.get(
+    node = get_node(ctx)
+    if not materialize and node.properties.get('lazy_venv'):
+        return record_provisioning_plan(ctx,
+                                        extra_packages,
+                                        galaxy_collections,
+                                        roles,
+                                        module_path)
+    extra_packages = extra_packages or node.properties.get(
         'extra_packages') or []
     galaxy_collections = \
-        galaxy_collections or get_node(ctx).properties.get(
+        galaxy_collections or node.properties.get(
             'galaxy_collections') or []
-    create_playbook_venv(ctx)
-    create_playbook_workspace(ctx)
-    setup_modules(ctx, module_path)
-    install_extra_packages(ctx, extra_packages)
-    install_galaxy_collections(ctx, galaxy_collections)
-    install_roles(ctx, roles)
-    setup_kerberos(ctx)
+    # Collections are installed into the venv site-packages, so they wait
+    # for pip. Roles go to the workspace and only need ansible-galaxy.
+    # The WinRM patch must come after pip, which may reinstall ansible.
+    steps = [
+        ('venv',
+         lambda: create_playbook_venv(ctx, extra_packages), []),
+        ('workspace',
+         lambda: create_playbook_workspace(ctx), ['venv']),
+        ('modules',
+         lambda: setup_modules(ctx, module_path), []),
+        ('extra_packages',
+         lambda: install_extra_packages(ctx, extra_packages), ['venv']),
+        ('galaxy_collections',
+         lambda: install_galaxy_collections(ctx, galaxy_collections),
+         ['workspace', 'extra_packages']),
+        ('roles',
+         lambda: install_roles(ctx, roles),
+         ['workspace', 'extra_packages']),
+        ('galaxy_requirements',
+         lambda: install_galaxy_requirements(ctx),
+         ['workspace', 'extra_packages']),
+        ('kerberos_config',
+         lambda: setup_kerberos_config(ctx), []),
+        ('winrm_connection',
+         lambda: patch_winrm_connection(ctx), ['extra_packages']),
+    ]
+    run_provisioning_pipeline(
+        ctx, steps, node.properties.get('provisioning_concurrency', 1))
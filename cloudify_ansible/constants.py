@@ -19,10 +19,31 @@ SOURCES = 'sources'
 USER = 'ansible_user'
 WORKSPACE = 'workspace'
 LOCAL_VENV = 'local_venv'
+SHARED_VENV = 'shared_venv'
 BECOME = 'ansible_become'
 MODULE_PATH = 'module_path'
 PLAYBOOK_VENV = 'playbook_venv'
 SUPPORTED_PYTHON = ['3.6', '3.11']
+SHARED_VENVS_DIR = '.ansible_venvs'
+TEMPLATE_VENVS_DIR = '.ansible_venv_templates'
+GALAXY_STORE_DIR = '.ansible_galaxy_store'
+GALAXY_REQUIREMENTS_FILE = 'requirements.yml'
+GALAXY_REQUIREMENTS_LOCK = 'requirements.lock.json'
+PLAYBOOK_MANIFEST = '.playbook.manifest.json'
+PLAYBOOK_SOURCES_DIR = '.playbook_sources'
+BLUEPRINT_DIR_CACHE = '.blueprint_dir.json'
+DEPLOYMENT_GROUPS_CACHE = '.deployment_groups.json'
+PRIVATE_KEYS_DIR = '.private_keys'
+INVENTORY_SCRIPT = 'inventory.py'
+INVENTORY_TOKEN = '.inventory_token'
+SHARDS_DIR = '.shards'
+RUNTIME_BLOBS_DIR = '.runtime_properties'
+RUNTIME_BLOB = '___RUNTIME_BLOB'
+RUNTIME_BLOB_THRESHOLD = 4096
+SUPERSEDED_RUNTIME_BLOBS = 'superseded_runtime_blobs'
+WORKERS_DIR = 'cloudify-ansible-workers-{uid}'
+WORKER_IDLE_TIMEOUT = 300
+WORKER_START_TIMEOUT = 30
 INSTALLED_ROLES = 'installed_roles'
 KEY = 'ansible_ssh_private_key_file'
 COMPLETED_TAGS = '___COMPLETED_TAGS'
@@ -30,6 +51,7 @@ AVAILABLE_TAGS = '___AVAILABLE_STEPS'
 ANSIBLE_TO_INSTALL = 'ansible==4.10.0'
 SSH_COMMON = 'ansible_ssh_common_args'
 COMPLETED_STEPS = '___COMPLETED_STEPS'
+PROVISIONING_PLAN = '___PROVISIONING_PLAN'
 AVAILABLE_STEPS = '___AVAILABLE_STEPS'
 NUMBER_OF_ATTEMPTS = 'number_of_attempts'
 MODULE_NAME = 'cloudify_runtime_property.py'
@@ -38,5 +60,13 @@ OPTION_HOST_CHECKING = 'ANSIBLE_HOST_KEY_CHECKING'
 INSTALLED_PACKAGES = 'installed_ansible_venv_packages'
 INSTALLED_COLLECTIONS = 'installed_galaxy_collections'
 OPTION_TASK_FAILED_ATTRIBUTE = 'ANSIBLE_INVALID_TASK_ATTRIBUTE_FAILED'
+CONNECTIVITY_CACHE_TTL = 300
+GC_MIN_AGE = 3600
+DOWNLOAD_ATTEMPTS = 3
+DEFAULT_PIP_INDEX_URL = 'https://pypi.org/simple/'
+DEFAULT_GALAXY_SERVER_URL = 'https://galaxy.ansible.com'
+MANAGER_RESOURCES_PATH = '/opt/manager/resources/'
 BP_INCLUDES_PATH = '/opt/manager/resources/blueprints/' \
                    '{tenant}/{blueprint}/{relative_path}'
+UNREACHABLE_CODES = [None, 2, 4]
+SUCCESS_CODES = [0]
@@ -0,0 +1,156 @@
+# Copyright (c) 2019 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A dynamic inventory for ansible, built from the sources of a node
+instance and, when the sources are remerged, the compute instances it has
+relationships to.
+
+Ansible runs the script written by utils.write_inventory_script with
+--list, and gets the hostvars of all hosts in the same call.
+"""
+
+import os
+import sys
+import json
+import argparse
+
+from cloudify_rest_client import CloudifyClient
+
+from cloudify_ansible.constants import SOURCES
+from cloudify_ansible.utils import (
+    load_runtime_blob,
+    handle_key_data,
+    get_compute_host_config,
+    get_deployment_node_groups)
+from cloudify_ansible_sdk.sources import AnsibleSource
+
+COMPUTE_TYPE = 'cloudify.nodes.Compute'
+
+
+def get_client_from_env(env=None, token_file=None):
+    """A REST client for the manager of the agent that runs ansible.
+
+    :param env: The environment, os.environ by default.
+    :param token_file: The file of utils.write_inventory_token, which has
+        the REST token. REST_TOKEN of the environment is used without it.
+    """
+    env = env or os.environ
+    token = env.get('REST_TOKEN')
+    if token_file and os.path.isfile(token_file):
+        with open(token_file) as infile:
+            token = infile.read().strip() or token
+    return CloudifyClient(
+        host=env['REST_HOST'].split(',')[0],
+        port=int(env.get('REST_PORT') or 443),
+        protocol=env.get('REST_PROTOCOL', 'https'),
+        cert=env.get('LOCAL_REST_CERT_FILE'),
+        token=token,
+        tenant=env.get('REST_TENANT'))
+
+
+def get_target_sources(client, instance, groups_cache=None):
+    """The hosts of the compute instances that the instance has
+    relationships to, as they would be merged by remerge_sources.
+
+    :param client: A REST client.
+    :param instance: The instance that runs the playbook.
+    :param groups_cache: The node groups cache of the deployment of the
+        instance, see utils.get_deployment_node_groups.
+    """
+    target_sources = AnsibleSource(None)
+    nodes = {}
+    node_groups = {}
+    for relationship in instance.relationships:
+        target = client.node_instances.get(relationship['target_id'])
+        if target.node_id not in nodes:
+            nodes[target.node_id] = client.nodes.get(
+                target.deployment_id, target.node_id)
+        node = nodes[target.node_id]
+        if COMPUTE_TYPE not in node.type_hierarchy:
+            continue
+        target_sources.add_host(
+            node.type,
+            target.id,
+            get_compute_host_config(
+                node.properties, target.runtime_properties))
+        if target.deployment_id not in node_groups:
+            # The cache is the one of the deployment of the instance.
+            if target.deployment_id == instance.deployment_id:
+                execution_id = groups_cache and os.environ.get('EXECUTION_ID')
+            else:
+                execution_id = None
+            node_groups[target.deployment_id] = get_deployment_node_groups(
+                client,
+                target.deployment_id,
+                execution_id=execution_id,
+                cache_file=groups_cache)
+        for group_name in node_groups[target.deployment_id].get(
+                node.id, []):
+            target_sources.add_host(group_name, target.id)
+    return target_sources
+
+
+def get_inventory(client,
+                  node_instance_id,
+                  workspace_dir=None,
+                  remerge_sources=False,
+                  groups_cache=None):
+    """The inventory of a node instance, in the JSON form of inventory
+    scripts.
+
+    :param client: A REST client.
+    :param node_instance_id: The instance that runs the playbook.
+    :param workspace_dir: Where inline private keys are stored.
+    :param remerge_sources: Add the hosts of the related compute instances.
+    :param groups_cache: The node groups cache of the deployment.
+    :return: The inventory dict, with the hostvars under _meta.
+    """
+    instance = client.node_instances.get(node_instance_id)
+    sources = load_runtime_blob(instance.runtime_properties.get(SOURCES))
+    ansible_source = AnsibleSource(
+        sources if isinstance(sources, dict) else None)
+    if remerge_sources:
+        ansible_source.merge_source(
+            get_target_sources(client, instance, groups_cache))
+    inventory = ansible_source.dynamic_inventory
+    if workspace_dir:
+        inventory['_meta']['hostvars'] = handle_key_data(
+            inventory['_meta']['hostvars'], workspace_dir)
+    return inventory
+
+
+def main(argv=None,
+         node_instance_id=None,
+         workspace_dir=None,
+         remerge_sources=False,
+         groups_cache=None,
+         token_file=None):
+    parser = argparse.ArgumentParser(
+        description='Cloudify dynamic inventory for ansible.')
+    parser.add_argument('--list', action='store_true')
+    parser.add_argument('--host')
+    args = parser.parse_args(argv)
+    if args.host:
+        # The hostvars of every host are in _meta of --list.
+        inventory = {}
+    else:
+        inventory = get_inventory(
+            get_client_from_env(token_file=token_file),
+            node_instance_id or os.environ['CTX_NODE_INSTANCE_ID'],
+            workspace_dir,
+            remerge_sources,
+            groups_cache)
+    json.dump(inventory, sys.stdout)
+    sys.stdout.write('\n')
+    return 0
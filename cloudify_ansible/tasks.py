@@ -18,7 +18,6 @@ import sys
 from cloudify.decorators import operation
 from script_runner.tasks import ProcessException
 from cloudify.utils import exception_to_error_cause
-from cloudify_common_sdk.processes import general_executor
 from cloudify_common_sdk.filters import (
     obfuscate_passwords,
     OBFUSCATION_KEYWORDS)
@@ -29,6 +28,7 @@ from cloudify.exceptions import (
 )
 
 from . import (
+    materialize_venv,
     prepare_ansible_node,
     ansible_playbook_node,
     ansible_relationship_source,
@@ -40,8 +40,8 @@ from cloudify_ansible_sdk import (
     CloudifyAnsibleSDKError
 )
 
-UNREACHABLE_CODES = [None, 2, 4]
-SUCCESS_CODES = [0]
+UNREACHABLE_CODES = constants.UNREACHABLE_CODES
+SUCCESS_CODES = constants.SUCCESS_CODES
 
 
 @operation(resumable=True)
@@ -104,6 +104,38 @@ def secure_log_playbook_args(_ctx, args, **_):
     _ctx.logger.debug("playbook_args: \n {0}".format(log_message))
 
 
+def _shard_process(_ctx, playbook_args, process):
+    """Split the process into one per shard of the inventory, when
+    playbook_shards is more than 1, and run it in the resident worker of
+    the venv when resident_worker is set.
+
+    :return: The script_func that runs the process.
+    """
+    _node = utils.get_node(_ctx)
+
+    def _get(key, default=None):
+        return playbook_args.get(key, _node.properties.get(key, default))
+
+    if _get('resident_worker', False):
+        process['worker_idle_timeout'] = _get(
+            'worker_idle_timeout', constants.WORKER_IDLE_TIMEOUT)
+    shards = _get('playbook_shards', 1)
+    if not shards or shards < 2:
+        return utils.get_executor(process)
+    limit_files = utils.write_shard_limits(
+        _ctx,
+        shards,
+        _get('shard_by', 'hash'),
+        utils.load_inventory(playbook_args.get('sources'), process['env']))
+    if not limit_files:
+        return utils.get_executor(process)
+    _ctx.logger.info('Running in {0} shards.'.format(len(limit_files)))
+    process['shard_args'] = AnsiblePlaybookFromFile.shard_args(
+        process['args'], limit_files)
+    process['shard_concurrency'] = _get('shard_concurrency')
+    return utils.sharded_executor
+
+
 @operation(resumable=True)
 @ansible_playbook_node
 def run(playbook_args, ansible_env_vars, _ctx, **kwargs):
@@ -158,6 +190,7 @@ def run(playbook_args, ansible_env_vars, _ctx, **kwargs):
     process = dict()
     process['env'] = ansible_env_vars
     process['args'] = playbook.process_args
+    script_func = _shard_process(_ctx, playbook_args, process)
     log_stdout = playbook_args.pop(
         'log_stdout',
         _node.properties.get('log_stdout', True))
@@ -170,7 +203,7 @@ def run(playbook_args, ansible_env_vars, _ctx, **kwargs):
     try:
         playbook.execute(
             utils.process_execution,
-            script_func=general_executor,
+            script_func=script_func,
             script_path=script_path,
             ctx=_ctx,
             process=process
@@ -244,6 +277,8 @@ def _store_facts(playbook,
     process = dict()
     process['env'] = ansible_env_vars
     process['args'] = playbook.facts_args
+    process['shard_output'] = 'facts'
+    script_func = _shard_process(_ctx, playbook_args, process)
     if not log_stdout:
         _ctx.logger.warn(
             'The parameter log_stdout is set to False, '
@@ -253,7 +288,7 @@ def _store_facts(playbook,
     try:
         facts = playbook.get_facts(
             utils.process_execution,
-            script_func=general_executor,
+            script_func=script_func,
             script_path=utils.get_executable_path(
                 executable="ansible",
                 venv=utils.get_instance(
@@ -274,7 +309,7 @@ def _store_facts(playbook,
             raise RecoverableError('Retrying...')
     facts = utils.get_facts(facts)
     _instance.refresh(force=True)
-    _instance.runtime_properties['facts'] = facts
+    utils.store_runtime_property(_ctx, 'facts', facts)
 
 
 @operation(resumable=True)
@@ -329,8 +364,10 @@ def precreate(ctx=None, **_):
 
 def _precreate(ctx=None, **_):
     ctx.logger.info('Checking Ansible installation.')
-    if not utils.get_instance().runtime_properties.get(
-            constants.PLAYBOOK_VENV):
+    runtime_properties = utils.get_instance().runtime_properties
+    if constants.PROVISIONING_PLAN in runtime_properties:
+        return
+    if not runtime_properties.get(constants.PLAYBOOK_VENV):
         ctx.logger.error('Ansible will need to be installed. '
                          'This may cause problems if Ansible is installed in '
                          'a relationship operation.')
@@ -339,7 +376,17 @@ def _precreate(ctx=None, **_):
 @operation
 def install(ctx=None, **_):
     install_config = ctx.node.properties
-    utils.create_playbook_venv(ctx)
+    if install_config.get('lazy_venv'):
+        utils.record_provisioning_plan(
+            ctx,
+            install_config.get('extra_packages', []),
+            install_config.get('galaxy_collections', []),
+            install_config.get('roles', []))
+        return
+    utils.create_playbook_venv(
+        ctx,
+        install_config.get('extra_packages', [])
+    )
     utils.create_playbook_workspace(ctx)
     utils.install_extra_packages(
         ctx,
@@ -353,10 +400,12 @@ def install(ctx=None, **_):
         ctx,
         install_config.get('roles', [])
     )
+    utils.install_galaxy_requirements(ctx)
 
 
 @operation
 def uninstall(ctx=None, **_):
+    utils.delete_private_keys(ctx)
     if ctx.node.properties.get('ansible_external_venv'):
         ctx.logger.info("Not deleting external venv")
         return
@@ -372,6 +421,8 @@ def update_venv(galaxy_collections, extra_packages, roles, ctx=None, **_):
     ctx.logger.info(
         "Updating venv with extra_packages {}, collections {} and roles {}"
         .format(str(extra_packages), str(galaxy_collections), str(roles)))
+    if constants.PROVISIONING_PLAN in ctx.instance.runtime_properties:
+        materialize_venv(ctx)
     utils.install_galaxy_collections(ctx, galaxy_collections)
     utils.install_extra_packages(ctx, extra_packages)
     utils.install_roles(ctx, roles)
@@ -0,0 +1,96 @@
+# Copyright (c) 2019 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare the latency of a short playbook run as a new ansible-playbook
+process with general_executor, and in a resident worker with
+worker_executor.
+
+    python -m cloudify_ansible.tests.benchmark_worker --runs 10
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import statistics
+from tempfile import mkdtemp
+
+from cloudify.mocks import MockCloudifyContext
+
+from cloudify_ansible import utils
+
+PLAYBOOK = """- hosts: localhost
+  connection: local
+  gather_facts: false
+  tasks:
+    - debug:
+        msg: "{{ lookup('env', 'RUN') }}"
+"""
+
+
+def run(executor, script_path, playbook_path, number, idle_timeout=None):
+    ctx = MockCloudifyContext('benchmark')
+    process = {
+        'env': {'RUN': str(number)},
+        'args': ['-i localhost,', playbook_path],
+        'ctx_proxy_type': 'none',
+        'log_stdout': False,
+    }
+    if idle_timeout:
+        process['worker_idle_timeout'] = idle_timeout
+    start = time.time()
+    utils.process_execution(executor, script_path, ctx, process)
+    return time.time() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument(
+        '--script',
+        default=os.path.join(
+            os.path.dirname(sys.executable), 'ansible-playbook'),
+        help='The ansible-playbook of a venv.')
+    args = parser.parse_args(argv)
+
+    workspace = mkdtemp()
+    playbook_path = os.path.join(workspace, 'playbook.yaml')
+    with open(playbook_path, 'w') as f:
+        f.write(PLAYBOOK)
+    try:
+        results = {
+            'process': [
+                run(utils.general_executor, args.script, playbook_path, i)
+                for i in range(args.runs)],
+            'worker': [
+                run(utils.worker_executor, args.script, playbook_path, i, 10)
+                for i in range(args.runs)],
+        }
+    finally:
+        shutil.rmtree(workspace)
+
+    print('{0:<8} {1:>8} {2:>8} {3:>8}'.format(
+        '', 'first', 'median', 'mean'))
+    for name, times in results.items():
+        print('{0:<8} {1:>7.3f}s {2:>7.3f}s {3:>7.3f}s'.format(
+            name, times[0], statistics.median(times), statistics.mean(times)))
+    saved = statistics.median(results['process']) - \
+        statistics.median(results['worker'])
+    print('Saved {0:.3f}s per run.'.format(saved))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
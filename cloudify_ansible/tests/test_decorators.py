@@ -12,11 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import shutil
 from tempfile import mkdtemp
 
 from mock import Mock, patch, mock_open
 from cloudify_ansible import (
     constants,
+    handle_venv,
+    materialize_venv,
     ansible_playbook_node
 )
 
@@ -104,13 +107,16 @@ class TestDecorator(AnsibleTestBase):
             Mock(return_value="Check")
         ):
             fake_file = mock_open()
+            write_inventory = Mock(return_value=True)
             with patch(
                 builtins_open, fake_file
+            ), patch(
+                'cloudify_ansible.utils.write_inventory', write_inventory
             ):
                 with patch('cloudify_ansible.create_playbook_venv'):
                     ansible_playbook_node(func)(
                         playbook_path=self.playbook_path)
-            fake_file.assert_called_with("hosts", "w")
+            self.assertEqual(write_inventory.call_args[0][1], "hosts")
         func.assert_called_with(
             {
                 'playbook_path': 'Check',
@@ -147,15 +153,18 @@ class TestDecorator(AnsibleTestBase):
             Mock(return_value="Check")
         ):
             fake_file = mock_open()
+            write_inventory = Mock(return_value=True)
             with patch(
                 builtins_open, fake_file
+            ), patch(
+                'cloudify_ansible.utils.write_inventory', write_inventory
             ):
                 with patch('cloudify_ansible.create_playbook_venv'):
                     ansible_playbook_node(func)(
                         playbook_path=self.playbook_path,
                         group_name="name_of_group",
                         remerge_sources=True)
-            fake_file.assert_called_with("hosts", "w")
+            self.assertEqual(write_inventory.call_args[0][1], "hosts")
         func.assert_called_with(
             {
                 'playbook_path': 'Check',
@@ -172,3 +181,44 @@ class TestDecorator(AnsibleTestBase):
                 constants.OPTION_STDOUT_FORMAT: "json"
             },
             ctx)
+
+    @patch('cloudify_ansible.utils.get_deployment_dir')
+    @patch('cloudify_ansible.handle_venv')
+    def test_materialize_venv(self, handle_venv, get_deployment_dir):
+        deployment_dir = mkdtemp()
+        self.addCleanup(shutil.rmtree, deployment_dir, True)
+        get_deployment_dir.return_value = deployment_dir
+        ctx = self._get_ctx()
+        current_ctx.set(ctx)
+        instance = ctx.source.instance
+        instance.refresh = Mock()
+        instance.update = Mock()
+        instance.runtime_properties[constants.PROVISIONING_PLAN] = {
+            'extra_packages': ['pywinrm'],
+            'galaxy_collections': [],
+            'roles': [],
+            'module_path': None,
+        }
+        materialize_venv(ctx)
+        handle_venv.assert_called_once_with(
+            ctx, ['pywinrm'], [], [], None, materialize=True)
+        self.assertNotIn(constants.PROVISIONING_PLAN,
+                         instance.runtime_properties)
+        instance.update.assert_called_once_with()
+
+        # Without a plan the venv is handled as before.
+        handle_venv.reset_mock()
+        materialize_venv(ctx)
+        handle_venv.assert_called_once_with(
+            ctx, None, None, None, None, materialize=True)
+
+    @patch('cloudify_ansible.run_provisioning_pipeline')
+    def test_handle_venv_steps(self, run_provisioning_pipeline):
+        ctx = self._get_ctx()
+        current_ctx.set(ctx)
+        handle_venv(ctx)
+        steps = run_provisioning_pipeline.call_args[0][1]
+        requires = dict((name, deps) for name, _, deps in steps)
+        # ansible-galaxy may come from the extra packages.
+        for name in ('galaxy_collections', 'roles', 'galaxy_requirements'):
+            self.assertEqual(requires[name], ['workspace', 'extra_packages'])
@@ -0,0 +1,209 @@
+# Copyright (c) 2019 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import shutil
+import unittest
+import threading
+from io import StringIO
+from tempfile import mkdtemp
+from mock import patch
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from cloudify_ansible import inventory
+
+SOURCES = {
+    'all': {
+        'hosts': {},
+        'children': {
+            'webservers': {
+                'hosts': {
+                    'web': {
+                        'ansible_host': '10.0.0.1',
+                        'ansible_user': 'centos',
+                        'ansible_ssh_private_key_file': 'key data',
+                    },
+                },
+            },
+        },
+    },
+}
+
+NODE_INSTANCES = {
+    'playbook_1': {
+        'id': 'playbook_1',
+        'node_id': 'playbook',
+        'deployment_id': 'dep',
+        'runtime_properties': {'sources': SOURCES},
+        'relationships': [
+            {'target_id': 'vm_1', 'target_name': 'vm',
+             'type': 'cloudify.ansible.relationships.connected_to_host'},
+            {'target_id': 'network_1', 'target_name': 'network',
+             'type': 'cloudify.relationships.depends_on'},
+        ],
+    },
+    'vm_1': {
+        'id': 'vm_1',
+        'node_id': 'vm',
+        'deployment_id': 'dep',
+        'runtime_properties': {'ip': '10.0.0.2'},
+        'relationships': [],
+    },
+    'network_1': {
+        'id': 'network_1',
+        'node_id': 'network',
+        'deployment_id': 'dep',
+        'runtime_properties': {},
+        'relationships': [],
+    },
+}
+
+NODES = {
+    'vm': {
+        'id': 'vm',
+        'type': 'cloudify.nodes.Compute',
+        'type_hierarchy': ['cloudify.nodes.Root', 'cloudify.nodes.Compute'],
+        'properties': {'agent_config': {'user': 'ubuntu'}},
+    },
+    'network': {
+        'id': 'network',
+        'type': 'cloudify.nodes.Network',
+        'type_hierarchy': ['cloudify.nodes.Root', 'cloudify.nodes.Network'],
+        'properties': {},
+    },
+}
+
+DEPLOYMENT = {
+    'id': 'dep',
+    'groups': {'monitored': {'members': ['vm']}},
+}
+
+
+class RESTHandler(BaseHTTPRequestHandler):
+    """Stands in for the node instances, nodes and deployments REST API."""
+
+    requests = []
+    tokens = []
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        self.requests.append(path)
+        self.tokens.append(self.headers.get('Authentication-Token'))
+        parts = path.split('/')[3:]
+        if parts[0] == 'node-instances':
+            body = NODE_INSTANCES[parts[1]]
+        elif parts[0] == 'nodes':
+            params = dict(param.split('=') for param in query.split('&'))
+            body = {'items': [NODES[params['id']]],
+                    'metadata': {'pagination': {
+                        'total': 1, 'size': 1, 'offset': 0}}}
+        else:
+            body = DEPLOYMENT
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *_):
+        pass
+
+
+class InventoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), RESTHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.workspace = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workspace)
+        RESTHandler.requests = []
+        RESTHandler.tokens = []
+
+    def _env(self):
+        return {
+            'REST_HOST': '127.0.0.1',
+            'REST_PORT': str(self.server.server_port),
+            'REST_PROTOCOL': 'http',
+            'REST_TOKEN': 'token',
+            'REST_TENANT': 'default_tenant',
+        }
+
+    def test_get_inventory(self):
+        client = inventory.get_client_from_env(self._env())
+        result = inventory.get_inventory(client, 'playbook_1', self.workspace)
+        # Without remerge_sources, only the stored sources.
+        self.assertEqual(sorted(result['all']['children']), ['webservers'])
+        self.assertEqual(RESTHandler.requests,
+                         ['/api/v3.1/node-instances/playbook_1'])
+
+        RESTHandler.requests = []
+        groups_cache = os.path.join(self.workspace, 'groups.json')
+        with patch.dict(os.environ, {'EXECUTION_ID': 'exec'}):
+            for _ in range(2):
+                result = inventory.get_inventory(
+                    client, 'playbook_1', self.workspace, True, groups_cache)
+        hostvars = result['_meta']['hostvars']
+        self.assertEqual(result['webservers'], {'hosts': ['web']})
+        self.assertEqual(result['cloudify.nodes.Compute'],
+                         {'hosts': ['vm-1']})
+        self.assertEqual(result['monitored'], {'hosts': ['vm-1']})
+        self.assertEqual(sorted(result['all']['children']),
+                         ['cloudify.nodes.Compute', 'monitored',
+                          'webservers'])
+        self.assertEqual(hostvars['vm-1'], {
+            'ansible_host': '10.0.0.2',
+            'ansible_user': 'ubuntu',
+            'ansible_become': True,
+            'ansible_ssh_common_args': '-o StrictHostKeyChecking=no',
+        })
+        key_file = hostvars['web']['ansible_ssh_private_key_file']
+        self.assertTrue(key_file.startswith(self.workspace))
+        with open(key_file) as f:
+            self.assertEqual(f.read(), 'key data')
+        # Nodes are fetched once per call, and the groups once per
+        # execution, through the groups cache.
+        self.assertEqual(RESTHandler.requests.count('/api/v3.1/nodes'), 4)
+        self.assertEqual(
+            RESTHandler.requests.count('/api/v3.1/deployments/dep'), 1)
+        with open(groups_cache) as f:
+            self.assertEqual(json.load(f), {
+                'execution_id': 'exec',
+                'node_groups': {'vm': ['monitored']}})
+
+    def test_main(self):
+        env = self._env()
+        del env['REST_TOKEN']
+        token_file = os.path.join(self.workspace, '.inventory_token')
+        with open(token_file, 'w') as f:
+            f.write('file token')
+        stdout = StringIO()
+        with patch.dict(os.environ, env), \
+                patch('sys.stdout', stdout):
+            self.assertEqual(
+                inventory.main(['--list'], 'playbook_1', self.workspace,
+                               token_file=token_file), 0)
+        self.assertIn('web', json.loads(stdout.getvalue())['_meta'][
+            'hostvars'])
+        self.assertEqual(set(RESTHandler.tokens), {'file token'})
+
+        stdout = StringIO()
+        with patch('sys.stdout', stdout):
+            inventory.main(['--host', 'web'])
+        self.assertEqual(json.loads(stdout.getvalue()), {})
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import yaml
 import shutil
 from mock import patch
 from unittest import skipUnless
@@ -31,8 +32,9 @@ from cloudify_ansible_sdk.tests import AnsibleTestBase, mock_sources_dict
 import cloudify_ansible_sdk
 
 from cloudify_ansible.constants import WORKSPACE
+from cloudify_ansible import utils
 from cloudify_ansible.tasks import (
-    run, ansible_requires_host, ansible_remove_host, cleanup)
+    run, ansible_requires_host, ansible_remove_host, cleanup, _shard_process)
 from cloudify_ansible.utils import (
     handle_file_path, handle_key_data, handle_source_from_string)
 
@@ -152,9 +154,12 @@ class TestPluginTasks(AnsibleTestBase):
         self.assertTrue(deleteme, path.dirname(output))
         shutil.rmtree(deleteme)
 
+    @patch('cloudify_ansible.utils.get_deployment_dir')
     @patch('cloudify_ansible.utils.get_blueprint_dir')
     @patch('cloudify_common_sdk.utils.get_blueprint_dir')
-    def test_handle_file_path(self, _, mock_bp_dir, *__):
+    def test_handle_file_path(self, _, mock_bp_dir, mock_dir, *__):
+        mock_dir.return_value = mkdtemp()
+        self.addCleanup(shutil.rmtree, mock_dir.return_value)
         with patch('cloudify_ansible.utils.get_rest_client'):
             setattr(ctx, '_local', False)
             mock_bp_dir.return_value = \
@@ -342,3 +347,38 @@ class TestPluginTasks(AnsibleTestBase):
                           'bad/file/path',
                           ctx,
                           f1.name)
+
+    def test_shard_process_workflow_override(self):
+        current_ctx.set(ctx)
+        self.addCleanup(current_ctx.clear)
+        process = {'env': {}, 'args': ['site.yaml']}
+        playbook_args = {
+            'sources': 'hosts',
+            'playbook_shards': 2,
+            'resident_worker': True,
+            'worker_idle_timeout': 7,
+        }
+        # The node properties are not set, the workflow kwargs win.
+        with patch('cloudify_ansible.utils.load_inventory'), \
+                patch('cloudify_ansible.utils.write_shard_limits',
+                      return_value=['shard-0', 'shard-1']) as limits:
+            self.assertIs(
+                _shard_process(ctx, playbook_args, process),
+                utils.sharded_executor)
+        self.assertEqual(limits.call_args[0][1], 2)
+        self.assertEqual(process['worker_idle_timeout'], 7)
+        self.assertEqual(len(process['shard_args']), 2)
+
+    def test_workflow_parameters(self):
+        # Node properties that are only read from the node are not
+        # parameters of reload_ansible_playbook.
+        node_only = ['use_shared_venv', 'lazy_venv', 'dynamic_inventory',
+                     'offload_runtime_properties', 'galaxy_requirements']
+        for name in ('plugin.yaml', 'v2_plugin.yaml',
+                     'plugin_1_4.yaml', 'plugin_1_5.yaml'):
+            with open(path.join(work_dir, name)) as f:
+                plugin = yaml.safe_load(f)
+            parameters = plugin['workflows']['reload_ansible_playbook'][
+                'parameters']
+            for key in node_only:
+                self.assertNotIn(key, parameters)
@@ -0,0 +1,132 @@
+# Copyright (c) 2019 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import time
+import shutil
+import unittest
+from mock import patch
+from tempfile import mkdtemp
+
+from cloudify.mocks import MockCloudifyContext
+from cloudify.exceptions import NonRecoverableError
+from script_runner.tasks import ProcessException
+
+from cloudify_ansible import utils
+
+SCRIPT = """import os
+import sys
+print('argv=' + ' '.join(sys.argv[1:]))
+print('foo=' + os.environ.get('FOO', ''))
+print('cwd=' + os.getcwd())
+print('worker={0}'.format(os.getppid()))
+sys.stderr.write('to stderr\\n')
+sys.exit(int(os.environ.get('EXIT_CODE', '0')))
+"""
+
+
+class WorkerTests(unittest.TestCase):
+
+    def setUp(self):
+        # A venv with a python and a script, like ansible-playbook.
+        self.venv_bin = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.venv_bin)
+        os.symlink(sys.executable, os.path.join(self.venv_bin, 'python'))
+        self.script_path = os.path.join(self.venv_bin, 'ansible-playbook')
+        with open(self.script_path, 'w') as f:
+            f.write(SCRIPT)
+        self.ctx = MockCloudifyContext('test')
+
+    def _run(self, env=None, cwd=None, idle_timeout=5, args=None):
+        process = {
+            'env': env or {},
+            'args': args or [
+                '-i "localhost,"', "--extra-vars='@vars.json'"],
+            'cwd': cwd or self.venv_bin,
+            'ctx_proxy_type': 'none',
+            'worker_idle_timeout': idle_timeout,
+        }
+        return utils.process_execution(
+            utils.get_executor(process), self.script_path, self.ctx, process)
+
+    def _output(self, output):
+        return dict(line.split('=', 1) for line in output.splitlines())
+
+    def test_worker_executor(self):
+        first = self._output(self._run({'FOO': 'bar'}))
+        second = self._output(self._run({'FOO': 'baz'}))
+        self.assertEqual(first['argv'],
+                         '-i localhost, --extra-vars=@vars.json')
+        self.assertEqual(first['foo'], 'bar')
+        self.assertEqual(second['foo'], 'baz')
+        self.assertEqual(first['cwd'], os.path.realpath(self.venv_bin))
+        # Both runs were forked by the same worker.
+        self.assertEqual(first['worker'], second['worker'])
+        self.assertNotEqual(int(first['worker']), os.getpid())
+
+        with self.assertRaises(ProcessException) as e:
+            self._run({'EXIT_CODE': '2'})
+        self.assertEqual(e.exception.exit_code, 2)
+        self.assertEqual(e.exception.stderr, 'to stderr')
+
+        # Another ansible configuration is another worker.
+        other = self._output(self._run({'ANSIBLE_FORKS': '1'}))
+        self.assertNotEqual(other['worker'], first['worker'])
+
+    def test_worker_idle_timeout(self):
+        self._run(idle_timeout=0.5)
+        socket_path = utils.get_worker_socket_path(
+            self.script_path, dict(os.environ), self.venv_bin)
+        self.assertTrue(os.path.exists(socket_path))
+        deadline = time.time() + 10
+        while os.path.exists(socket_path) and time.time() < deadline:
+            time.sleep(0.1)
+        self.assertFalse(os.path.exists(socket_path))
+        # The next run starts a new worker.
+        self.assertEqual(self._output(self._run())['foo'], '')
+
+    @patch('cloudify_ansible.utils.general_executor')
+    def test_worker_executor_fallback(self, general_executor):
+        general_executor.return_value = 'output'
+        os.unlink(os.path.join(self.venv_bin, 'python'))
+        self.assertEqual(self._run(), 'output')
+        with patch('cloudify_ansible.utils.start_worker',
+                   side_effect=OSError('no worker')):
+            os.symlink(sys.executable, os.path.join(self.venv_bin, 'python'))
+            self.assertEqual(self._run(), 'output')
+        self.assertEqual(general_executor.call_count, 2)
+        # The shell reports unbalanced quotes.
+        self.assertEqual(self._run(args=['--tags="a']), 'output')
+        self.assertEqual(general_executor.call_count, 3)
+
+    def test_get_process_argv(self):
+        self.assertEqual(
+            utils.get_process_argv('ansible-playbook', [
+                '-vv',
+                '-i hosts',
+                '',
+                '--start-at-task="Install nginx" --diff="true" ',
+                '--tags "a,b"',
+            ]),
+            ['ansible-playbook', '-vv', '-i', 'hosts',
+             '--start-at-task=Install nginx', '--diff=true',
+             '--tags', 'a,b'])
+
+    def test_lost_worker(self):
+        execution = utils.WorkerExecution('ansible-playbook site.yaml',
+                                          self.ctx)
+        self.ctx._return_value = None
+        with self.assertRaises(NonRecoverableError):
+            execution.check_exception()
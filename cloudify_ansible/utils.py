@@ -15,20 +15,36 @@
 import os
 import re
 import sys
+import gzip
 import json
+import time
+import stat
+import shlex
+import fcntl
+import hashlib
+import socket
+import tarfile
+import zipfile
 import tempfile
+import selectors
+import threading
+import subprocess
+from concurrent.futures import (
+    FIRST_COMPLETED, ThreadPoolExecutor, wait)
 
 import yaml
 import errno
 import shutil
 import pathlib
-from uuid import uuid1
 from copy import deepcopy
 from tempfile import mkdtemp
-from distutils.dir_util import copy_tree
+from contextlib import closing, contextmanager
 from distutils.version import StrictVersion
+from packaging.utils import canonicalize_name
+from packaging.requirements import Requirement, InvalidRequirement
 
 from cloudify import ctx, exceptions
+from cloudify.state import current_ctx
 from ansible.playbook import Playbook
 from cloudify.manager import get_rest_client
 from cloudify.utils import LocalCommandRunner
@@ -37,15 +53,25 @@ from ansible.vars.manager import VariableManager
 from ansible.parsing.dataloader import DataLoader
 from cloudify_rest_client.constants import VisibilityState
 from cloudify_ansible_sdk._compat import (
-    text_type, urlopen, URLError)
+    text_type, urlopen, Request, HTTPError)
 from cloudify_common_sdk.utils import (
     get_blueprint_dir,
     get_deployment_dir,
     get_node_instance_dir)
-from cloudify_common_sdk.resource_downloader import get_shared_resource
+from cloudify_common_sdk.filters import obfuscate_passwords
+from cloudify_common_sdk.processes import (
+    general_executor,
+    GeneralExecutor,
+    POLL_LOOP_INTERVAL)
+from cloudify_common_sdk.resource_downloader import (
+    get_shared_resource,
+    TAR_FILE_EXTENSTIONS)
 from script_runner.tasks import (
     ILLEGAL_CTX_OPERATION_ERROR,
-    UNSUPPORTED_SCRIPT_FEATURE_ERROR
+    UNSUPPORTED_SCRIPT_FEATURE_ERROR,
+    process_ctx_request,
+    start_ctx_proxy,
+    _get_process_environment,
 )
 from cloudify.exceptions import (NonRecoverableError,
                                  OperationRetry,
@@ -57,21 +83,74 @@ from cloudify_ansible.constants import (
     SOURCES,
     WORKSPACE,
     LOCAL_VENV,
+    SHARED_VENV,
+    GC_MIN_AGE,
     MODULE_NAME,
     MODULE_PATH,
     PLAYBOOK_VENV,
     COMPLETED_TAGS,
+    PLAYBOOK_MANIFEST,
+    PLAYBOOK_SOURCES_DIR,
+    BLUEPRINT_DIR_CACHE,
+    DEPLOYMENT_GROUPS_CACHE,
+    PRIVATE_KEYS_DIR,
+    INVENTORY_SCRIPT,
+    INVENTORY_TOKEN,
+    SHARDS_DIR,
+    RUNTIME_BLOB,
+    RUNTIME_BLOBS_DIR,
+    RUNTIME_BLOB_THRESHOLD,
+    SUPERSEDED_RUNTIME_BLOBS,
+    WORKERS_DIR,
+    WORKER_START_TIMEOUT,
+    UNREACHABLE_CODES,
+    MANAGER_RESOURCES_PATH,
+    PROVISIONING_PLAN,
     AVAILABLE_TAGS,
     INSTALLED_ROLES,
     SUPPORTED_PYTHON,
+    SHARED_VENVS_DIR,
+    GALAXY_STORE_DIR,
+    GALAXY_REQUIREMENTS_FILE,
+    GALAXY_REQUIREMENTS_LOCK,
+    TEMPLATE_VENVS_DIR,
     ANSIBLE_TO_INSTALL,
     INSTALLED_PACKAGES,
     INSTALLED_COLLECTIONS,
+    DEFAULT_PIP_INDEX_URL,
+    CONNECTIVITY_CACHE_TTL,
+    DOWNLOAD_ATTEMPTS,
+    DEFAULT_GALAXY_SERVER_URL,
 )
-from cloudify_ansible_sdk.sources import AnsibleSource
+from cloudify_ansible_sdk import CloudifyAnsibleSDKError
+from cloudify_ansible_sdk.sources import (
+    AnsibleSource,
+    shard_inventory_hosts)
+from cloudify_ansible import worker
+
+INVENTORY_SCRIPT_TEMPLATE = """#!{python}
+import sys
+
+from cloudify_ansible.inventory import main
+
+sys.exit(main(node_instance_id={node_instance_id!r},
+              workspace_dir={workspace_dir!r},
+              remerge_sources={remerge_sources!r},
+              groups_cache={groups_cache!r},
+              token_file={token_file!r}))
+"""
 
 
 runner = LocalCommandRunner()
+# url: (time of probe, connected), shared by all operations in the process.
+_connectivity_cache = {}
+_connectivity_lock = threading.Lock()
+# (install dir, kind): (mtimes, content), see scan_galaxy_content.
+_galaxy_scan_cache = {}
+_galaxy_scan_lock = threading.Lock()
+# node instance id: (sources runtime property, AnsibleSource), see
+# load_sources.
+_sources_cache = {}
 
 try:
     from cloudify.proxy.client import ScriptException
@@ -88,7 +167,9 @@ except ImportError:
 
 def handle_key_data(_data, workspace_dir):
     """Take Key Data from ansible_ssh_private_key_file and
-    replace with a temp file.
+    replace with a temp file. The dicts of _data are not changed, since
+    they can be the cached config of an AnsibleSource: the dicts on the
+    way to a replaced key are copied.
 
     :param _data: The hosts dict (from YAML).
     :param workspace_dir: The temp dir where we are putting everything.
@@ -96,10 +177,14 @@ def handle_key_data(_data, workspace_dir):
     """
 
     def recurse_dictionary(existing_dict, key='ansible_ssh_private_key_file'):
+        new_dict = None
         if key not in existing_dict:
             for k, v in existing_dict.items():
                 if isinstance(v, dict):
-                    existing_dict[k] = recurse_dictionary(v)
+                    new_v = recurse_dictionary(v)
+                    if new_v is not v:
+                        new_dict = new_dict or dict(existing_dict)
+                        new_dict[k] = new_v
         elif key in existing_dict:
             # If is_file_path is True, this has already been done.
             try:
@@ -107,18 +192,53 @@ def handle_key_data(_data, workspace_dir):
             except TypeError:
                 is_file_path = False
             if not is_file_path:
-                private_key_file = os.path.join(workspace_dir, str(uuid1()))
-                with open(private_key_file, 'w') as outfile:
-                    if isinstance(existing_dict[key], (dict, list)):
-                        existing_dict[key] = json.dumps(existing_dict[key])
-                    if existing_dict[key]:
-                        outfile.write(existing_dict[key])
-                os.chmod(private_key_file, 0o600)
-                existing_dict[key] = private_key_file
-        return existing_dict
+                new_dict = dict(existing_dict)
+                new_dict[key] = store_private_key(
+                    existing_dict[key], workspace_dir)
+        return existing_dict if new_dict is None else new_dict
     return recurse_dictionary(_data)
 
 
+def store_private_key(key_data, workspace_dir):
+    """Put key data in the key store of the workspace. The key file is
+    named by the sha256 of the key, so hosts and runs that share a key
+    share one file.
+
+    :param key_data: The private key.
+    :param workspace_dir: The temp dir where we are putting everything.
+    :return: The path of the key file.
+    """
+
+    if isinstance(key_data, (dict, list)):
+        key_data = json.dumps(key_data)
+    content = (key_data or '').encode('utf-8')
+    keys_dir = os.path.join(workspace_dir, PRIVATE_KEYS_DIR)
+    private_key_file = os.path.join(
+        keys_dir, hashlib.sha256(content).hexdigest())
+    if os.path.isfile(private_key_file):
+        return private_key_file
+    if not os.path.isdir(keys_dir):
+        os.makedirs(keys_dir, mode=0o700, exist_ok=True)
+    # mkstemp creates the file with mode 0600.
+    fd, temp_path = tempfile.mkstemp(dir=keys_dir)
+    with os.fdopen(fd, 'wb') as outfile:
+        outfile.write(content)
+    os.rename(temp_path, private_key_file)
+    return private_key_file
+
+
+def delete_private_keys(ctx):
+    """Delete the key store of the workspace.
+
+    :param ctx: The Cloudify context.
+    :return:
+    """
+
+    workspace_dir = get_instance(ctx).runtime_properties.get(WORKSPACE)
+    if workspace_dir:
+        delete_temp_folder(os.path.join(workspace_dir, PRIVATE_KEYS_DIR))
+
+
 def download_nested_file_to_new_nested_temp_file(file_path, new_root, _ctx):
     """ Download a file to a similar folder system with a new root directory.
 
@@ -190,6 +310,10 @@ def get_site_packages(path_base, instance=None):
 
 def _get_collections_location(instance):
     runtime_properties = instance.runtime_properties
+    # A shared venv is used by other deployments, and its key does not
+    # have the collections, so they go to our workspace.
+    if runtime_properties.get(SHARED_VENV):
+        return runtime_properties.get(WORKSPACE)
     if not is_local_venv() and \
             (get_node(ctx).properties.get('galaxy_collections')
              or runtime_properties.get('galaxy_collections')):
@@ -207,6 +331,61 @@ def _get_roles_location(instance):
     return roles_location
 
 
+def _get_deployment_blueprint(deployment_id):
+    try:
+        # get the latest deployment update to get the new blueprint id
+        client = get_rest_client()
+        dep_upd = \
+            client.deployment_updates.list(deployment_id=deployment_id,
+                                           sort='created_at')[-1]
+        return client.deployment_updates.get(
+            dep_upd.id)["new_blueprint_id"]
+    except KeyError:
+        raise NonRecoverableError(
+            "can't get blueprint for deployment {0}".format(deployment_id))
+
+
+def get_cached_blueprint_dir(_ctx):
+    """Get the blueprint directory of the deployment. It is looked up once
+    and shared by the node instances of the deployment, through a file in
+    the deployment dir. It is looked up again when the blueprint ID
+    changes. In the update workflow, the new blueprint ID comes from the
+    latest deployment update, fetched once per execution.
+
+    :param _ctx: The Cloudify context.
+    :return: The path to the blueprint directory.
+    """
+    cache_file = os.path.join(
+        get_deployment_dir(_ctx.deployment.id), BLUEPRINT_DIR_CACHE)
+    with lock_file(cache_file + '.lock'):
+        cached = {}
+        if os.path.isfile(cache_file):
+            with open(cache_file) as f:
+                cached = json.load(f)
+        blueprint_dir = cached.get('path')
+        is_cached = bool(blueprint_dir) and os.path.isdir(blueprint_dir)
+        if _ctx.workflow_id == 'update':
+            # a deployment can have multiple updates, so the blueprint
+            # is taken from the latest one.
+            if is_cached and cached.get('update_execution_id') == \
+                    _ctx.execution_id:
+                return blueprint_dir
+            blueprint_id = _get_deployment_blueprint(_ctx.deployment.id)
+            cached['update_execution_id'] = _ctx.execution_id
+        else:
+            blueprint_id = _ctx.blueprint.id
+        if not is_cached or cached.get('blueprint_id') != blueprint_id:
+            if is_cached and not blueprint_dir.startswith(
+                    MANAGER_RESOURCES_PATH):
+                # The previous blueprint was downloaded for the deployment.
+                delete_temp_folder(blueprint_dir)
+            blueprint_dir = get_blueprint_dir(blueprint_id)
+        cached.update(blueprint_id=blueprint_id, path=blueprint_dir)
+        with open(cache_file, 'w') as f:
+            json.dump(cached, f)
+    return blueprint_dir
+
+
 def handle_file_path(file_path, additional_playbook_files, _ctx):
     """Get the path to a file.
 
@@ -223,19 +402,6 @@ def handle_file_path(file_path, additional_playbook_files, _ctx):
     :return: The absolute path on the manager to the file.
     """
 
-    def _get_deployment_blueprint(deployment_id):
-        try:
-            # get the latest deployment update to get the new blueprint id
-            client = get_rest_client()
-            dep_upd = \
-                client.deployment_updates.list(deployment_id=deployment_id,
-                                               sort='created_at')[-1]
-            return client.deployment_updates.get(
-                dep_upd.id)["new_blueprint_id"]
-        except KeyError:
-            raise NonRecoverableError(
-                "can't get blueprint for deployment {0}".format(deployment_id))
-
     if not isinstance(file_path, (text_type, bytes)):
         raise NonRecoverableError(
             'The variable file_path {0} is a {1},'
@@ -249,44 +415,14 @@ def handle_file_path(file_path, additional_playbook_files, _ctx):
             # enabling downloading the playbook to a remote host.
             playbook_file_dir = mkdtemp()
             os.chmod(playbook_file_dir, 0o755)
-            new_file_path = download_nested_file_to_new_nested_temp_file(
-                file_path,
+            return download_nested_files(
+                [file_path] + list(additional_playbook_files),
                 playbook_file_dir,
-                _ctx
-            )
-            for additional_file in additional_playbook_files:
-                download_nested_file_to_new_nested_temp_file(
-                    additional_file,
-                    playbook_file_dir,
-                    _ctx
-                )
-            return new_file_path
+                _ctx,
+                get_node(_ctx).properties.get('download_concurrency', 4))[0]
         else:
-            # in update case , we always need to fetch the new blueprint
-            # because a deployment can have multiple updates
-            # unlike first creation blueprint files would be the same.
-            is_update = _ctx.workflow_id == 'update'
-            _ctx_instance = get_instance(_ctx)
-            downloaded = \
-                _ctx_instance.runtime_properties.get('_blueprint_dir')
-            dir_exists = os.path.exists(downloaded) if downloaded else False
-            if downloaded and dir_exists and not is_update:
-                file_path = os.path.join(downloaded, file_path)
-            else:
-                # handle update deployment different blueprint playbook name
-                blueprint_id = _ctx.blueprint.id
-                if is_update:
-                    if downloaded:
-                        delete_temp_folder(downloaded)
-                        _ctx_instance.runtime_properties.pop('_blueprint_dir')
-                        _ctx_instance.update()
-                    blueprint_id = \
-                        _get_deployment_blueprint(_ctx.deployment.id)
-                blueprint_path = get_blueprint_dir(blueprint_id)
-                _ctx_instance.runtime_properties['_blueprint_dir'] = \
-                    blueprint_path
-                _ctx_instance.update()
-                file_path = os.path.join(blueprint_path, file_path)
+            file_path = os.path.join(
+                get_cached_blueprint_dir(_ctx), file_path)
     if os.path.exists(file_path):
         return file_path
     raise NonRecoverableError(
@@ -314,6 +450,632 @@ def get_node(_ctx=None, target=False):
         return _ctx.node
 
 
+def summarize_runtime_property(key, value):
+    """A small description of a runtime property that is stored out of
+    line, for people looking at the node instance.
+    """
+    if key == SOURCES and isinstance(value, dict):
+        source = AnsibleSource(value)
+        hostnames = set(source.hosts)
+        for group in source.children.values():
+            hostnames.update(group.hosts)
+        return {'groups': sorted(source.children), 'hosts': len(hostnames)}
+    if isinstance(value, dict):
+        summary = {'keys': len(value)}
+        for name in ('ansible_hostname', 'ansible_distribution',
+                     'ansible_distribution_version'):
+            if name in value:
+                summary[name] = value[name]
+        return summary
+    if isinstance(value, list):
+        return {'items': len(value)}
+    return {}
+
+
+def store_runtime_property(_ctx, key, value):
+    """Set a runtime property of the instance. With the
+    offload_runtime_properties property, a large value is written gzipped
+    to the node instance dir, named by its sha256, and the runtime property
+    only keeps the digest, the path and a summary of it.
+
+    A blob that the runtime property stops referring to is only listed,
+    since the manager may still have the update that refers to it. Cleanup
+    and collect_runtime_blobs remove it.
+
+    :param _ctx: The Cloudify context.
+    :param key: The runtime property.
+    :param value: Any JSON value.
+    """
+
+    instance = get_instance(_ctx)
+    cached = _sources_cache.get(instance.id) if key == SOURCES else None
+    if cached and cached[0] is instance.runtime_properties.get(key) and \
+            cached[1].config == value:
+        # The stored sources, from load_sources.
+        return
+    if value is not None and \
+            get_node(_ctx).properties.get('offload_runtime_properties'):
+        content = json.dumps(value).encode('utf-8')
+        if len(content) > RUNTIME_BLOB_THRESHOLD:
+            digest = hashlib.sha256(content).hexdigest()
+            blobs_dir = get_node_instance_dir(source_path=RUNTIME_BLOBS_DIR)
+            path = os.path.join(blobs_dir, '{0}.json.gz'.format(digest))
+            if os.path.isfile(path):
+                # Not garbage while the update is in progress.
+                os.utime(path, None)
+            else:
+                write_file_if_changed(
+                    path, gzip.compress(content, mtime=0), 0o600)
+            value = {RUNTIME_BLOB: {
+                'sha256': digest,
+                'path': path,
+                'size': len(content),
+                'summary': summarize_runtime_property(key, value),
+            }}
+    previous = instance.runtime_properties.get(key)
+    instance.runtime_properties[key] = value
+    superseded = list(
+        instance.runtime_properties.get(SUPERSEDED_RUNTIME_BLOBS) or [])
+    if _is_runtime_blob(previous) and previous != value and \
+            previous[RUNTIME_BLOB]['path'] not in superseded:
+        superseded.append(previous[RUNTIME_BLOB]['path'])
+    # Drop the blobs that are referred to again, or that garbage
+    # collection removed.
+    referenced = _get_runtime_blob_paths(instance.runtime_properties)
+    superseded = [path for path in superseded
+                  if path not in referenced and os.path.isfile(path)]
+    if superseded:
+        instance.runtime_properties[SUPERSEDED_RUNTIME_BLOBS] = superseded
+    else:
+        instance.runtime_properties.pop(SUPERSEDED_RUNTIME_BLOBS, None)
+
+
+def _get_runtime_blob_paths(runtime_properties):
+    return set(value[RUNTIME_BLOB].get('path')
+               for value in (runtime_properties or {}).values()
+               if _is_runtime_blob(value))
+
+
+def load_runtime_property(instance, key, default=None):
+    """Get a runtime property of the instance, reading it from the node
+    instance dir if store_runtime_property stored it out of line.
+
+    :param instance: The node instance.
+    :param key: The runtime property.
+    :param default: The value if the runtime property is not set.
+    :return: The value of the runtime property.
+    """
+
+    return load_runtime_blob(instance.runtime_properties.get(key, default))
+
+
+def load_runtime_blob(value):
+    if not _is_runtime_blob(value):
+        return value
+    record = value[RUNTIME_BLOB]
+    try:
+        with gzip.open(record['path'], 'rb') as f:
+            content = f.read()
+    except (IOError, OSError) as e:
+        raise NonRecoverableError(
+            'Unable to read the runtime property stored in {0}: {1}'.format(
+                record['path'], e))
+    if hashlib.sha256(content).hexdigest() != record['sha256']:
+        raise NonRecoverableError(
+            'The runtime property stored in {0} does not match its '
+            'sha256.'.format(record['path']))
+    return json.loads(content.decode('utf-8'))
+
+
+def _is_runtime_blob(value):
+    return isinstance(value, dict) and RUNTIME_BLOB in value
+
+
+def _delete_runtime_blob(value):
+    path = value[RUNTIME_BLOB].get('path')
+    if path and os.path.isfile(path):
+        os.remove(path)
+
+
+def download_nested_files(file_paths,
+                          new_root,
+                          _ctx,
+                          max_workers=1,
+                          attempts=DOWNLOAD_ATTEMPTS):
+    """ Download files to a similar folder system with a new root directory,
+    on a thread pool. Each file is tried up to attempts times. After a file
+    failed, the downloads that did not start are cancelled.
+
+    :param file_paths: The resource paths for download resource source.
+    :param new_root: Like a temporary directory
+    :param _ctx: The Cloudify context.
+    :param max_workers: how many files are downloaded at the same time.
+    :param attempts: how many times to try each file.
+    :return: list of the new paths, in the order of file_paths.
+    """
+    # The ctx proxy is thread local, so pass the object behind it.
+    _ctx = getattr(_ctx, '_get_current_object', lambda: _ctx)()
+
+    def _download(file_path):
+        current_ctx.set(_ctx)
+        try:
+            for attempt in range(1, attempts + 1):
+                try:
+                    return download_nested_file_to_new_nested_temp_file(
+                        file_path, new_root, _ctx)
+                except Exception as e:
+                    if attempt == attempts:
+                        raise
+                    _ctx.logger.debug(
+                        'Failed to download {0} ({1}), attempt {2} of '
+                        '{3}.'.format(file_path, e, attempt, attempts))
+                    time.sleep(attempt)
+        finally:
+            current_ctx.clear()
+
+    failures = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = dict((executor.submit(_download, file_path), file_path)
+                       for file_path in file_paths)
+        pending = set(futures)
+        while pending and not failures:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception():
+                    failures[futures[future]] = future.exception()
+        for future in pending:
+            future.cancel()
+        for future in pending:
+            if not future.cancelled() and future.exception():
+                failures[futures[future]] = future.exception()
+    if failures:
+        raise NonRecoverableError(
+            'Failed to download {0}: {1}'.format(
+                sorted(failures),
+                '; '.join('{0}: {1}'.format(file_path, failures[file_path])
+                          for file_path in sorted(failures))))
+    return [future.result() for future in futures]
+
+
+def get_file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sync_tree(source_dir, target_dir, manifest_path):
+    """Make target_dir contain the files of source_dir, transferring only
+    the files that were added or changed since the last sync. The manifest
+    keeps the size, mtime and sha256 of every synced file, so unchanged
+    files are found without reading them. Files are hard linked when
+    possible, so they must be replaced and not written into. Files of the
+    manager resources are copied, so nothing in the workspace can change
+    them. Files that were synced before and removed from source_dir are
+    removed, with the directories they leave empty. Other files in
+    target_dir are kept.
+
+    :param source_dir: The directory to sync from.
+    :param target_dir: The directory to sync to.
+    :param manifest_path: The manifest of the previous sync.
+    :return: the number of files and bytes transferred, and the number of
+     files removed.
+    """
+    manifest = {}
+    if os.path.isfile(manifest_path):
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except ValueError:
+            pass
+    new_manifest = {}
+    transferred = transferred_bytes = 0
+    manager_resources = (
+        MANAGER_RESOURCES_PATH,
+        os.path.join(os.path.realpath(MANAGER_RESOURCES_PATH), ''))
+    for root, _, files in os.walk(source_dir, followlinks=True):
+        relative_root = os.path.relpath(root, source_dir)
+        target_root = os.path.normpath(os.path.join(target_dir, relative_root))
+        if not os.path.isdir(target_root):
+            if os.path.lexists(target_root):
+                os.remove(target_root)
+            os.makedirs(target_root)
+        for name in files:
+            source = os.path.join(root, name)
+            target = os.path.join(target_root, name)
+            relative_path = os.path.normpath(os.path.join(relative_root, name))
+            file_stat = os.stat(source)
+            entry = {'size': file_stat.st_size, 'mtime': file_stat.st_mtime_ns}
+            previous = manifest.get(relative_path) or {}
+            target_exists = os.path.isfile(target) and \
+                os.path.getsize(target) == file_stat.st_size
+            if target_exists and previous.get('size') == entry['size'] and \
+                    previous.get('mtime') == entry['mtime']:
+                entry['sha256'] = previous.get('sha256')
+            else:
+                entry['sha256'] = get_file_digest(source)
+                if not target_exists or \
+                        previous.get('sha256') != entry['sha256']:
+                    if os.path.lexists(target):
+                        os.remove(target)
+                    if os.path.realpath(source).startswith(
+                            manager_resources):
+                        shutil.copy2(source, target)
+                    else:
+                        _link_or_copy(source, target)
+                    transferred += 1
+                    transferred_bytes += file_stat.st_size
+            new_manifest[relative_path] = entry
+    removed = 0
+    emptied_dirs = set()
+    for relative_path in set(manifest) - set(new_manifest):
+        target = os.path.join(target_dir, relative_path)
+        if os.path.isfile(target) or os.path.islink(target):
+            os.remove(target)
+            removed += 1
+        relative_dir = os.path.dirname(relative_path)
+        while relative_dir:
+            emptied_dirs.add(relative_dir)
+            relative_dir = os.path.dirname(relative_dir)
+    # Deepest first, so a parent is empty once its children are removed.
+    for relative_dir in sorted(emptied_dirs, key=len, reverse=True):
+        target = os.path.join(target_dir, relative_dir)
+        if not os.path.isdir(os.path.join(source_dir, relative_dir)) and \
+                os.path.isdir(target) and not os.path.islink(target) and \
+                not os.listdir(target):
+            os.rmdir(target)
+    temp_manifest = manifest_path + '.tmp'
+    with open(temp_manifest, 'w') as f:
+        json.dump(new_manifest, f)
+    os.replace(temp_manifest, manifest_path)
+    return transferred, transferred_bytes, removed
+
+
+def _get_archive_type(source_path):
+    file_name = source_path.split('?')[0].rsplit('/', 1)[-1]
+    file_type = file_name.rsplit('.', 1)[-1] if '.' in file_name else ''
+    if file_type == 'zip':
+        return 'zip'
+    if file_type in TAR_FILE_EXTENSTIONS:
+        return 'tar'
+
+
+class HashingReader(object):
+    """A file object wrapper that computes the sha256 of what is read."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        return data
+
+    def hexdigest(self):
+        # Whatever the reader did not consume is part of the content.
+        for chunk in iter(lambda: self.read(1024 * 1024), b''):
+            pass
+        return self.digest.hexdigest()
+
+
+def _get_member_path(target_dir, name, subtree=None):
+    # Where an archive member goes, or None if it is outside subtree.
+    # subtree may be below the top directory that archives often have.
+    if name.startswith('/') or re.match(r'^[a-zA-Z]:', name):
+        raise NonRecoverableError(
+            'Archive member {0} has an absolute path.'.format(name))
+    parts = [part for part in name.replace('\\', '/').split('/')
+             if part not in ('', '.')]
+    if '..' in parts:
+        raise NonRecoverableError(
+            'Archive member {0} is outside of the archive.'.format(name))
+    if not parts:
+        return
+    if subtree:
+        subtree_parts = [part for part in subtree.split('/') if part]
+        size = len(subtree_parts)
+        if parts[:size] != subtree_parts and \
+                parts[1:size + 1] != subtree_parts:
+            return
+    return os.path.join(target_dir, *parts)
+
+
+def _is_within(real_target_dir, path):
+    real_path = os.path.realpath(path)
+    return real_path == real_target_dir or real_path.startswith(
+        os.path.join(real_target_dir, ''))
+
+
+def _check_member(target_dir, path):
+    # Links are not followed while extracting: the parent of a member
+    # must be a real directory under target_dir, and a member can not
+    # replace a link that an earlier member created.
+    real_target_dir = os.path.realpath(target_dir)
+    parent = os.path.dirname(path)
+    expected = os.path.normpath(os.path.join(
+        real_target_dir, os.path.relpath(parent, target_dir)))
+    if os.path.realpath(parent) != expected or os.path.islink(path):
+        raise NonRecoverableError(
+            'Archive member {0} is under or replaces a link.'.format(path))
+
+
+def _check_link(target_dir, path, link):
+    resolved = os.path.join(os.path.dirname(path), link)
+    if os.path.isabs(link) or not _is_within(
+            os.path.realpath(target_dir), resolved):
+        raise NonRecoverableError(
+            'Archive link {0} -> {1} is outside of the archive.'.format(
+                path, link))
+
+
+def make_tree_read_only(path):
+    """Remove the write permissions of the files under path. Directories
+    stay writable, so that the tree can be removed.
+    """
+    for root, _, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if not os.path.islink(file_path):
+                mode = os.stat(file_path).st_mode
+                os.chmod(file_path, (mode & 0o555) | 0o444)
+
+
+def _write_member(source, path, mode):
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    with open(path, 'wb') as f:
+        shutil.copyfileobj(source, f, 1024 * 1024)
+    # Trees are shared by operations, so they are kept read only.
+    os.chmod(path, (mode & 0o555) | 0o444)
+
+
+def _write_zip_member(archive, info, path, mode):
+    with archive.open(info) as source:
+        _write_member(source, path, mode or 0o644)
+
+
+def _extract_member(target_dir, path, links, is_dir=False, link=None,
+                    hardlink=None, write=None):
+    _check_member(target_dir, path)
+    if is_dir:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    elif link is not None:
+        _check_link(target_dir, path, link)
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        os.symlink(link, path)
+        links.append(path)
+    elif hardlink is not None:
+        if not _is_within(os.path.realpath(target_dir), hardlink) or \
+                os.path.islink(hardlink) or not os.path.isfile(hardlink):
+            raise NonRecoverableError(
+                'Archive link {0} -> {1} is outside of the archive.'.format(
+                    path, hardlink))
+        os.link(hardlink, path)
+    else:
+        write()
+
+
+def _check_extracted_links(target_dir, links):
+    # A link can point elsewhere once the members after it are extracted,
+    # e.g. l -> d/../x followed by d -> ., so check them again at the end.
+    real_target_dir = os.path.realpath(target_dir)
+    for path in links:
+        if not _is_within(real_target_dir, path):
+            raise NonRecoverableError(
+                'Archive link {0} -> {1} is outside of the archive.'.format(
+                    path, os.readlink(path)))
+
+
+def extract_archive(fileobj, archive_type, target_dir, subtree=None):
+    """Extract an archive member by member into target_dir, without a
+    temporary copy. Tar archives are read as a stream, so fileobj can be
+    an HTTP response. Zip archives need a seekable file. Members with
+    absolute paths, paths and links that really point outside of
+    target_dir, or members under links, fail the extraction. Devices and
+    fifos are skipped.
+
+    :param fileobj: The archive file object, or path for zip archives.
+    :param archive_type: 'zip' or 'tar'.
+    :param target_dir: The directory to extract into.
+    :param subtree: Only extract the members under this relative path.
+    """
+    target_dir = os.path.abspath(target_dir)
+    links = []
+    if archive_type == 'zip':
+        with zipfile.ZipFile(fileobj) as archive:
+            for info in archive.infolist():
+                path = _get_member_path(target_dir, info.filename, subtree)
+                mode = info.external_attr >> 16
+                if not path:
+                    continue
+                if info.filename.endswith('/'):
+                    _extract_member(target_dir, path, links, is_dir=True)
+                elif stat.S_ISLNK(mode):
+                    _extract_member(target_dir, path, links,
+                                    link=archive.read(info).decode())
+                else:
+                    _extract_member(
+                        target_dir, path, links,
+                        write=lambda: _write_zip_member(
+                            archive, info, path, mode))
+        _check_extracted_links(target_dir, links)
+        return
+    with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+        for member in archive:
+            path = _get_member_path(target_dir, member.name, subtree)
+            if not path:
+                continue
+            if member.isdir():
+                _extract_member(target_dir, path, links, is_dir=True)
+            elif member.isfile():
+                _extract_member(
+                    target_dir, path, links,
+                    write=lambda: _write_member(
+                        archive.extractfile(member), path, member.mode))
+            elif member.issym():
+                _extract_member(
+                    target_dir, path, links, link=member.linkname)
+            elif member.islnk():
+                link_path = _get_member_path(
+                    target_dir, member.linkname, subtree)
+                if link_path and os.path.lexists(link_path):
+                    _extract_member(
+                        target_dir, path, links, hardlink=link_path)
+    _check_extracted_links(target_dir, links)
+
+
+def _get_archive_root(tree_dir, subtree=None):
+    # Skip the top directory that archives often have, like unzip_archive.
+    if subtree and os.path.exists(os.path.join(tree_dir, subtree)):
+        return tree_dir
+    entries = os.listdir(tree_dir)
+    if len(entries) == 1 and \
+            os.path.isdir(os.path.join(tree_dir, entries[0])):
+        return os.path.join(tree_dir, entries[0])
+    return tree_dir
+
+
+def _fetch_playbook_source(source_path,
+                           archive_type,
+                           staging_dir,
+                           metadata,
+                           cached,
+                           subtree=None):
+    # Extract source_path into staging_dir, unless the cached tree is
+    # still valid. Updates metadata, and returns the sha256 of the archive
+    # or None if it was not fetched.
+    if not source_path.startswith(('http://', 'https://')):
+        file_stat = os.stat(source_path)
+        if cached and metadata.get('size') == file_stat.st_size and \
+                metadata.get('mtime') == file_stat.st_mtime_ns:
+            return
+        metadata.update(size=file_stat.st_size, mtime=file_stat.st_mtime_ns)
+        if archive_type == 'zip':
+            extract_archive(source_path, archive_type, staging_dir, subtree)
+            return get_file_digest(source_path)
+        with open(source_path, 'rb') as f:
+            reader = HashingReader(f)
+            extract_archive(reader, archive_type, staging_dir, subtree)
+            return reader.hexdigest()
+    request = Request(source_path)
+    if cached and metadata.get('etag'):
+        request.add_header('If-None-Match', metadata['etag'])
+    if cached and metadata.get('last_modified'):
+        request.add_header('If-Modified-Since', metadata['last_modified'])
+    try:
+        response = urlopen(request, timeout=60)
+    except HTTPError as e:
+        if e.code == 304:
+            return
+        raise
+    metadata.update(etag=response.headers.get('ETag'),
+                    last_modified=response.headers.get('Last-Modified'))
+    reader = HashingReader(response)
+    if archive_type == 'tar':
+        extract_archive(reader, archive_type, staging_dir, subtree)
+        return reader.hexdigest()
+    # The zip directory is at the end, so the archive is spooled first.
+    with tempfile.TemporaryFile(dir=os.path.dirname(staging_dir)) as f:
+        shutil.copyfileobj(reader, f, 1024 * 1024)
+        extract_archive(f, archive_type, staging_dir, subtree)
+    return reader.hexdigest()
+
+
+def get_playbook_source(_ctx, playbook_source_path, subtree=None):
+    """Get the extracted playbook_source_path archive from a cache in the
+    deployment dir. Archives are extracted while they are read, URLs are
+    revalidated with ETag and Last-Modified, local files by size and
+    mtime, and an unchanged sha256 reuses the existing tree. Within an
+    execution, e.g. on retries, the cached tree is used without
+    revalidation. Other sources, such as git, are handled by
+    get_shared_resource.
+
+    :param _ctx: The Cloudify context.
+    :param playbook_source_path: URL or absolute path of an archive.
+    :param subtree: Only extract this relative path of the archive.
+    :return: The directory of the extracted archive.
+    """
+    archive_type = _get_archive_type(playbook_source_path)
+    is_url = playbook_source_path.startswith(('http://', 'https://'))
+    if not archive_type or playbook_source_path.endswith('.git') or \
+            not (is_url or os.path.isabs(playbook_source_path) and
+                 os.path.isfile(playbook_source_path)):
+        return get_shared_resource(playbook_source_path)
+    key = hashlib.sha256(json.dumps(
+        [playbook_source_path, subtree]).encode()).hexdigest()
+    cache_dir = os.path.join(
+        get_deployment_dir(_ctx.deployment.id), PLAYBOOK_SOURCES_DIR, key)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    metadata_file = os.path.join(cache_dir, 'metadata.json')
+    with lock_file(os.path.join(cache_dir, '.lock')):
+        metadata = {}
+        if os.path.isfile(metadata_file):
+            with open(metadata_file) as f:
+                metadata = json.load(f)
+        tree_dir = os.path.join(cache_dir, metadata.get('sha256', ''))
+        cached = bool(metadata.get('sha256')) and os.path.isdir(tree_dir)
+        if cached and metadata.get('execution_id') == _ctx.execution_id:
+            return _get_archive_root(tree_dir, subtree)
+        staging_dir = mkdtemp(dir=cache_dir)
+        try:
+            digest = _fetch_playbook_source(playbook_source_path,
+                                            archive_type,
+                                            staging_dir,
+                                            metadata,
+                                            cached,
+                                            subtree)
+            if digest:
+                tree_dir = os.path.join(cache_dir, digest)
+                if os.path.isdir(tree_dir):
+                    delete_temp_folder(staging_dir)
+                else:
+                    _ctx.logger.info('Extracted {0}.'.format(
+                        playbook_source_path))
+                    os.chmod(staging_dir, 0o755)
+                    os.rename(staging_dir, tree_dir)
+                if digest != metadata.get('sha256'):
+                    # Operations may still use the previous tree.
+                    for name in os.listdir(cache_dir):
+                        if name not in (digest, metadata.get('sha256')) and \
+                                len(name) == len(digest):
+                            delete_temp_folder(os.path.join(cache_dir, name))
+                    metadata['sha256'] = digest
+            else:
+                _ctx.logger.debug('Using the cached {0}.'.format(
+                    playbook_source_path))
+        finally:
+            delete_temp_folder(staging_dir)
+        metadata['execution_id'] = _ctx.execution_id
+        with open(metadata_file, 'w') as f:
+            json.dump(metadata, f)
+    return _get_archive_root(tree_dir, subtree)
+
+
+def sync_playbook_dir(playbook_dir, _ctx):
+    """Sync a playbook directory into the workspace, see sync_tree.
+
+    :return: The playbook directory in the workspace.
+    """
+    workspace = get_instance(_ctx).runtime_properties[WORKSPACE]
+    new_playbook_dir = os.path.join(workspace, 'playbook')
+    transferred, transferred_bytes, removed = sync_tree(
+        playbook_dir,
+        new_playbook_dir,
+        os.path.join(workspace, PLAYBOOK_MANIFEST))
+    _ctx.logger.info(
+        'Synced {0} to {1}: {2} files ({3} bytes) transferred, '
+        '{4} removed.'.format(playbook_dir, new_playbook_dir,
+                              transferred, transferred_bytes, removed))
+    return new_playbook_dir
+
+
 def handle_site_yaml(site_yaml_path, additional_playbook_files, _ctx):
     """ Create an absolute local path to the site.yaml.
 
@@ -328,13 +1090,125 @@ def handle_site_yaml(site_yaml_path, additional_playbook_files, _ctx):
         handle_file_path(site_yaml_path, additional_playbook_files, _ctx))
     site_yaml_real_dir = os.path.dirname(site_yaml_real_path)
     site_yaml_real_name = os.path.basename(site_yaml_real_path)
-    site_yaml_new_dir = os.path.join(
-        get_instance(_ctx).runtime_properties[WORKSPACE], 'playbook')
-    copy_tree(site_yaml_real_dir, site_yaml_new_dir)
+    site_yaml_new_dir = sync_playbook_dir(site_yaml_real_dir, _ctx)
     site_yaml_final_path = os.path.join(site_yaml_new_dir, site_yaml_real_name)
     return u'{0}'.format(site_yaml_final_path)
 
 
+def write_file_if_changed(path, content, mode=0o644):
+    """Replace a file atomically with new content, unless it already has
+    that content.
+
+    :param path: The path of the file.
+    :param content: The new content, in bytes.
+    :param mode: The mode of the new file.
+    :return: True if the file was written.
+    """
+
+    if os.path.isfile(path) and os.path.getsize(path) == len(content) and \
+            get_file_digest(path) == hashlib.sha256(content).hexdigest():
+        return False
+    # Renaming over the file also breaks a hard link to the playbook
+    # source, which must not change.
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix='.{0}.'.format(
+            os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'wb') as outfile:
+            outfile.write(content)
+        os.chmod(temp_path, mode)
+        os.rename(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    return True
+
+
+def write_inventory(data, hosts_abspath):
+    """Write a hosts dict as a JSON inventory, which ansible reads with
+    its YAML inventory plugin and which is much faster to dump than YAML.
+
+    :param data: The hosts dict.
+    :param hosts_abspath: The path of the hosts file.
+    :return: True if the file was written.
+    """
+
+    return write_file_if_changed(
+        hosts_abspath, json.dumps(data, indent=2).encode('utf-8'))
+
+
+def write_inventory_script(_ctx, remerge_sources=False):
+    """Write the dynamic inventory script of the instance to its workspace.
+    The script gets the sources and the related compute instances from
+    the manager when ansible runs it, so nothing is rendered before a run.
+
+    :param _ctx: The Cloudify context.
+    :param remerge_sources: Add the hosts of the related compute instances
+        to the sources, like get_remerged_config_sources.
+    :return: The path of the script.
+    """
+
+    instance = get_instance(_ctx)
+    workspace_dir = instance.runtime_properties[WORKSPACE]
+    script_path = os.path.join(workspace_dir, INVENTORY_SCRIPT)
+    groups_cache = None
+    if remerge_sources:
+        groups_cache = os.path.join(
+            get_deployment_dir(_ctx.deployment.id), DEPLOYMENT_GROUPS_CACHE)
+    content = INVENTORY_SCRIPT_TEMPLATE.format(
+        python=sys.executable,
+        node_instance_id=instance.id,
+        workspace_dir=workspace_dir,
+        remerge_sources=bool(remerge_sources),
+        groups_cache=groups_cache,
+        token_file=os.path.join(workspace_dir, INVENTORY_TOKEN))
+    write_file_if_changed(script_path, content.encode('utf-8'), 0o700)
+    return script_path
+
+
+def write_inventory_token(_ctx):
+    """Write the REST token of the operation for the inventory script, to a
+    file that only the agent user can read. The token is not passed in the
+    environment, since the playbook and its modules get that environment.
+    Remove it with delete_inventory_token after the run.
+
+    :param _ctx: The Cloudify context.
+    :return: The path of the token file.
+    """
+
+    token_file = os.path.join(
+        get_instance(_ctx).runtime_properties[WORKSPACE], INVENTORY_TOKEN)
+    write_file_if_changed(
+        token_file,
+        (getattr(_ctx, 'rest_token', None) or '').encode('utf-8'),
+        0o600)
+    return token_file
+
+
+def delete_inventory_token(_ctx):
+    workspace_dir = get_instance(_ctx).runtime_properties.get(WORKSPACE)
+    if workspace_dir:
+        token_file = os.path.join(workspace_dir, INVENTORY_TOKEN)
+        if os.path.isfile(token_file):
+            os.remove(token_file)
+
+
+def get_inventory_env(_ctx):
+    """The environment the inventory script needs to call the manager.
+    The REST token is in the file of write_inventory_token.
+
+    :param _ctx: The Cloudify context.
+    :return: A dict of environment variables.
+    """
+
+    env = {}
+    for key, value in (('REST_TENANT', getattr(_ctx, 'tenant_name', None)),
+                       ('EXECUTION_ID', getattr(_ctx, 'execution_id', None))):
+        if value:
+            env[key] = value
+    return env
+
+
 def handle_sources(data, site_yaml_abspath, _ctx):
     """Allow users to provide a path to a hosts file
     or to generate hosts dynamically,
@@ -352,12 +1226,8 @@ def handle_sources(data, site_yaml_abspath, _ctx):
     if isinstance(data, dict):
         data = handle_key_data(
             data, get_instance(_ctx).runtime_properties[WORKSPACE])
-        if os.path.exists(hosts_abspath):
-            _ctx.logger.error(
-                'Hosts data was provided but {0} already exists. '
-                'Overwriting existing file.'.format(hosts_abspath))
-        with open(hosts_abspath, 'w') as outfile:
-            yaml.safe_dump(data, outfile, default_flow_style=False)
+        if write_inventory(data, hosts_abspath):
+            _ctx.logger.debug('Wrote hosts file {0}.'.format(hosts_abspath))
     elif isinstance(data, text_type):
         hosts_abspath = handle_source_from_string(data, _ctx, hosts_abspath)
     return hosts_abspath
@@ -393,6 +1263,11 @@ def get_inventory_file(filepath, _ctx, new_inventory_path):
 
 
 def handle_source_from_string(filepath, _ctx, new_inventory_path):
+    if new_inventory_path and os.path.isfile(new_inventory_path) and \
+            os.stat(new_inventory_path).st_nlink > 1 and \
+            os.path.abspath(filepath) != os.path.abspath(new_inventory_path):
+        # Hard linked to the playbook source, which must not change.
+        os.remove(new_inventory_path)
     inventory_file = get_inventory_file(filepath, _ctx, new_inventory_path)
     if inventory_file != new_inventory_path and new_inventory_path:
         try:
@@ -448,12 +1323,18 @@ def delete_playbook_workspace(ctx):
 
 def delete_playbook_environment(ctx):
     """Delete the temporary folder.
+    If the venv is taken from the shared venv store, only drop our reference.
 
     :param ctx: The Cloudify context.
     :return:
     """
 
-    directory = get_instance(ctx).runtime_properties.get(PLAYBOOK_VENV)
+    instance = get_instance(ctx)
+    instance.runtime_properties.pop(INSTALLED_PACKAGES, None)
+    if instance.runtime_properties.get(SHARED_VENV):
+        release_shared_venv(ctx)
+        return
+    directory = instance.runtime_properties.get(PLAYBOOK_VENV)
     delete_temp_folder(directory)
 
 
@@ -480,13 +1361,13 @@ def get_source_config_from_ctx(_ctx,
     if _ctx.type == NODE_INSTANCE and \
             'cloudify.nodes.Compute' not in _ctx.node.type_hierarchy and \
             _ctx.instance.runtime_properties.get(SOURCES):
-        if isinstance(_ctx.instance.runtime_properties[SOURCES], text_type):
-            if os.path.exists(_ctx.instance.runtime_properties[SOURCES]):
-                return _ctx.instance.runtime_properties[SOURCES]
+        stored_sources = _ctx.instance.runtime_properties[SOURCES]
+        if isinstance(stored_sources, text_type):
+            if os.path.exists(stored_sources):
+                return stored_sources
             else:
-                return _ctx.download_resource(
-                    _ctx.instance.runtime_properties[SOURCES])
-        return AnsibleSource(_ctx.instance.runtime_properties[SOURCES]).config
+                return _ctx.download_resource(stored_sources)
+        return load_sources(_ctx.instance).config
     elif _ctx.type == RELATIONSHIP_INSTANCE:
         host_config = host_config or \
             get_host_config_from_compute_node(_ctx.target)
@@ -494,7 +1375,7 @@ def get_source_config_from_ctx(_ctx,
             get_group_name_and_hostname(
                 _ctx.target, group_name, hostname)
         additional_node_groups = get_additional_node_groups(
-            _ctx.target.node.name, _ctx.deployment.id)
+            _ctx.target.node.name, _ctx.deployment.id, _ctx)
     else:
         host_config = host_config or \
             get_host_config_from_compute_node(_ctx)
@@ -502,7 +1383,7 @@ def get_source_config_from_ctx(_ctx,
             get_group_name_and_hostname(
                 _ctx, group_name, hostname)
         additional_node_groups = get_additional_node_groups(
-            get_node(_ctx).name, _ctx.deployment.id)
+            get_node(_ctx).name, _ctx.deployment.id, _ctx)
     if '-o StrictHostKeyChecking=no' not in \
             host_config.get('ansible_ssh_common_args', ''):
         _ctx.logger.warn(
@@ -520,32 +1401,64 @@ def get_source_config_from_ctx(_ctx,
     return AnsibleSource(sources).config
 
 
+def load_sources(instance, for_update=False):
+    """The sources stored on the instance, as an AnsibleSource. The source
+    is parsed once, and reused by the operations of the instance while the
+    runtime property is unchanged. It is shared, so it must not be changed
+    unless for_update is set.
+
+    :param instance: The node instance.
+    :param for_update: The source is changed and stored by the caller with
+        store_sources, so it is taken out of the cache until then.
+    :return: An AnsibleSource.
+    """
+
+    value = instance.runtime_properties.get(SOURCES)
+    if for_update:
+        cached = _sources_cache.pop(instance.id, None)
+    else:
+        cached = _sources_cache.get(instance.id)
+    if cached and (cached[0] is value or cached[0] == value):
+        return cached[1]
+    sources = load_runtime_blob(value)
+    source = AnsibleSource(sources if isinstance(sources, dict) else None)
+    if not for_update:
+        _sources_cache[instance.id] = (value, source)
+    return source
+
+
+def store_sources(_ctx, source):
+    """Store an AnsibleSource as the sources of the instance, and keep it
+    for load_sources.
+    """
+    instance = get_instance(_ctx)
+    config = source.config
+    store_runtime_property(_ctx, SOURCES, config)
+    _sources_cache[instance.id] = (
+        instance.runtime_properties[SOURCES], source)
+    return config
+
+
 def update_sources_from_target(new_sources_dict, _ctx):
     # get source sources
-    current_sources_dict = _ctx.source.instance.runtime_properties.get(
-        SOURCES, {})
-    current_sources = AnsibleSource(current_sources_dict)
+    current_sources = load_sources(_ctx.source.instance, for_update=True)
     # get target sources
     new_sources = AnsibleSource(new_sources_dict)
     # merge sources
     current_sources.merge_source(new_sources)
     # save sources to source node
-    _ctx.source.instance.runtime_properties[SOURCES] = current_sources.config
-    return current_sources.config
+    return store_sources(_ctx, current_sources)
 
 
 def cleanup_sources_from_target(new_sources_dict, _ctx):
     # get source sources
-    current_sources_dict = _ctx.source.instance.runtime_properties.get(
-        SOURCES, {})
-    current_sources = AnsibleSource(current_sources_dict)
+    current_sources = load_sources(_ctx.source.instance, for_update=True)
     # get target sources
     new_sources = AnsibleSource(new_sources_dict)
     # merge sources
     current_sources.remove_source(new_sources)
     # save sources to source node
-    _ctx.source.instance.runtime_properties[SOURCES] = current_sources.config
-    return current_sources.config
+    return store_sources(_ctx, current_sources)
 
 
 def get_remerged_config_sources(_ctx, kwargs):
@@ -557,8 +1470,7 @@ def get_remerged_config_sources(_ctx, kwargs):
         new_sources_dict = get_source_config_from_ctx(
             _ctx, group_name, hostname, host_config)
         # merged sources
-        merged_sources = update_sources_from_target(new_sources_dict, _ctx)
-        return AnsibleSource(merged_sources).config
+        return update_sources_from_target(new_sources_dict, _ctx)
     else:
         return get_source_config_from_ctx(_ctx)
 
@@ -586,23 +1498,26 @@ def get_group_name_and_hostname(_ctx, group_name=None, hostname=None):
 
 
 def get_host_config_from_compute_node(_ctx):
+    return get_compute_host_config(_ctx.node.properties,
+                                   _ctx.instance.runtime_properties)
+
+
+def get_compute_host_config(node_properties, runtime_properties):
+    agent_config = node_properties.get('agent_config') or {}
     return {
-        'ansible_host': _ctx.instance.runtime_properties.get(
-            'ip', _ctx.node.properties.get('ip')),
-        'ansible_user': _ctx.node.properties.get(
-            'agent_config', {}).get('user'),
-        'ansible_ssh_pass': _ctx.node.properties.get(
-            'agent_config', {}).get('password'),
-        'ansible_ssh_private_key_file':
-            _ctx.node.properties.get('agent_config', {}).get('key'),
+        'ansible_host': runtime_properties.get(
+            'ip', node_properties.get('ip')),
+        'ansible_user': agent_config.get('user'),
+        'ansible_ssh_pass': agent_config.get('password'),
+        'ansible_ssh_private_key_file': agent_config.get('key'),
         'ansible_ssh_common_args': '-o StrictHostKeyChecking=no',
-        'ansible_become': _ctx.node.properties.get('ansible_become', True)
+        'ansible_become': node_properties.get('ansible_become', True)
     }
 
 
 def handle_result(result, _ctx, ignore_failures=False, ignore_dark=False):
     _ctx.logger.debug('result: {0}'.format(result))
-    get_instance(_ctx).runtime_properties['result'] = result
+    store_runtime_property(_ctx, 'result', result)
     failures = result.get('failures')
     dark = result.get('dark')
     if failures and not ignore_failures:
@@ -623,18 +1538,61 @@ def unassign_environ(_vars):
         del os.environ[key]
 
 
-def get_additional_node_groups(node_name, deployment_id):
+def get_additional_node_groups(node_name, deployment_id, _ctx=None):
     """This enables users to reuse hosts in multiple groups."""
-    groups = []
     try:
         client = get_rest_client()
     except KeyError:
-        return groups
-    deployment = client.deployments.get(deployment_id)
-    for group_name, group in deployment.get('groups', {}).items():
-        if node_name in group.get('members', []) and group_name:
-            groups.append(group_name)
-    return groups
+        return []
+    return get_deployment_node_groups(
+        client, deployment_id, _ctx or ctx).get(node_name, [])
+
+
+def _get_node_groups_index(client, deployment_id):
+    deployment = client.deployments.get(
+        deployment_id, _include=['id', 'groups'])
+    node_groups = {}
+    for group_name, group in (deployment.get('groups') or {}).items():
+        if not group_name:
+            continue
+        for node_name in group.get('members', []):
+            node_groups.setdefault(node_name, []).append(group_name)
+    return node_groups
+
+
+def get_deployment_node_groups(client,
+                               deployment_id,
+                               _ctx=None,
+                               execution_id=None,
+                               cache_file=None):
+    """Get the groups of every node of the deployment. The groups are
+    fetched once per execution, and shared by the operations of the
+    execution through a file in the deployment dir.
+
+    :param client: A REST client.
+    :param deployment_id: The deployment ID.
+    :param _ctx: The Cloudify context.
+    :param execution_id: The execution, by default the one of _ctx.
+    :param cache_file: The cache, by default in the deployment dir.
+    :return: A dict of node name to the names of its groups.
+    """
+    execution_id = execution_id or getattr(_ctx, 'execution_id', None)
+    if not execution_id:
+        return _get_node_groups_index(client, deployment_id)
+    cache_file = cache_file or os.path.join(
+        get_deployment_dir(deployment_id), DEPLOYMENT_GROUPS_CACHE)
+    with lock_file(cache_file + '.lock'):
+        if os.path.isfile(cache_file):
+            with open(cache_file) as f:
+                cached = json.load(f)
+            if cached.get('execution_id') == execution_id:
+                return cached['node_groups']
+        node_groups = _get_node_groups_index(client, deployment_id)
+        write_file_if_changed(cache_file, json.dumps({
+            'execution_id': execution_id,
+            'node_groups': node_groups,
+        }).encode('utf-8'))
+    return node_groups
 
 
 def cleanup(ctx):
@@ -645,7 +1603,14 @@ def cleanup(ctx):
     RelationshipSubjectContext or CloudifyContext
     """
     instance = get_instance(ctx)
-    for key, _ in list(instance.runtime_properties.items()):
+    if instance.runtime_properties.get(SHARED_VENV):
+        release_shared_venv(ctx)
+    for path in instance.runtime_properties.get(
+            SUPERSEDED_RUNTIME_BLOBS) or []:
+        _delete_runtime_blob({RUNTIME_BLOB: {'path': path}})
+    for key, value in list(instance.runtime_properties.items()):
+        if _is_runtime_blob(value):
+            _delete_runtime_blob(value)
         del instance.runtime_properties[key]
 
 
@@ -682,9 +1647,46 @@ def set_playbook_config_as_runtime_properties(_ctx, config):
             _ctx.instance.runtime_properties[key] = value
 
 
-def make_virtualenv(path):
+def get_offline_path(_ctx, property_name):
+    """Get a local directory that provisioning should use instead of
+    the network, like wheelhouse_path or galaxy_artifacts_path.
+
+    :param _ctx: cloudify context.
+    :param property_name: the node property with the directory.
+    :return: The directory or None if not configured.
+    """
+    path = get_node(_ctx).properties.get(property_name)
+    if not path:
+        return
+    if not os.path.isdir(path):
+        raise NonRecoverableError(
+            'The {0} {1} is not a directory.'.format(property_name, path))
+    return path
+
+
+def get_pip_index_url(_ctx):
+    return get_node(_ctx).properties.get('pip_index_url') or \
+        DEFAULT_PIP_INDEX_URL
+
+
+def get_galaxy_server_url(_ctx):
+    return get_node(_ctx).properties.get('galaxy_server_url') or \
+        DEFAULT_GALAXY_SERVER_URL
+
+
+def get_pip_index_args(wheelhouse=None, index_url=None):
+    if wheelhouse:
+        return ['--no-index', '--find-links', wheelhouse]
+    if index_url and index_url != DEFAULT_PIP_INDEX_URL:
+        return ['--index-url', index_url]
+    return []
+
+
+def make_virtualenv(path, wheelhouse=None):
     """
         Make a venv for installing ansible module inside.
+        :param path: where to create the venv.
+        :param wheelhouse: local directory to install virtualenv from.
     """
     if hasattr(exceptions, 'CommandExecutionException') and \
             hasattr(exceptions, 'CommandExecutionError'):
@@ -705,14 +1707,14 @@ def make_virtualenv(path):
         try:
             runner.run([
                 sys.executable, '-m', 'pip', 'install', 'virtualenv'
-            ])
+            ] + get_pip_index_args(wheelhouse))
             runner.run([
                 sys.executable, '-m', 'virtualenv', path
             ])
         except exception:
             runner.run([
                 sys.executable, '-m', 'pip', 'install', 'venv'
-            ])
+            ] + get_pip_index_args(wheelhouse))
             runner.run([
                 sys.executable, '-m', 'venv', path
             ])
@@ -729,14 +1731,98 @@ def set_installed_packages(venv):
         installed_packages
 
 
-def install_packages_to_venv(venv, packages_list):
-    # Force reinstall in playbook venv in order to make sure
-    # they being installed on specified environment .
+def parse_installed_packages(freeze_output):
+    """Parse pip freeze output.
+
+    :param freeze_output: the output of pip freeze.
+    :return: dict of canonical package name to version, or None for
+      packages installed from a URL or path.
+    """
+    installed = {}
+    for line in (freeze_output or '').splitlines():
+        line = line.strip()
+        if not line or line.startswith(('#', '-')):
+            continue
+        if '==' in line:
+            name, version = line.split('==', 1)
+            installed[canonicalize_name(name.strip())] = version.strip()
+        elif ' @ ' in line:
+            name = line.split(' @ ', 1)[0]
+            installed[canonicalize_name(name.strip())] = None
+    return installed
+
+
+def get_recorded_packages(venv):
+    """The packages recorded by the last pip freeze of venv.
+    Only trusted if venv is the venv of the instance, otherwise
+    the recorded packages may belong to a venv that no longer exists.
+
+    :param venv: the venv path.
+    :return: dict of canonical package name to version.
+    """
+    runtime_properties = get_instance(ctx).runtime_properties
+    if not venv or runtime_properties.get(PLAYBOOK_VENV) != venv:
+        return {}
+    return parse_installed_packages(
+        runtime_properties.get(INSTALLED_PACKAGES))
+
+
+def resolve_packages_to_install(packages_list, installed):
+    """Compare the requested packages to the installed packages.
+
+    :param packages_list: list of pip requirements.
+    :param installed: dict from parse_installed_packages.
+    :return: tuple of the requirements that need to be installed, and
+      a dict of requirement to 'skipped', 'installed' or 'upgraded'.
+    """
+    packages_to_install = []
+    summary = {}
+    for package in packages_list:
+        try:
+            requirement = Requirement(package)
+        except InvalidRequirement:
+            # A URL or a path, we can not tell what is in it.
+            requirement = None
+        if not requirement or requirement.url or requirement.extras:
+            state = 'installed'
+        else:
+            name = canonicalize_name(requirement.name)
+            version = installed.get(name)
+            if name not in installed:
+                state = 'installed'
+            elif version and requirement.specifier.contains(
+                    version, prereleases=True):
+                state = 'skipped'
+            else:
+                state = 'upgraded'
+        summary[package] = state
+        if state != 'skipped':
+            packages_to_install.append(package)
+    return packages_to_install, summary
+
+
+def install_packages_to_venv(venv,
+                             packages_list,
+                             wheelhouse=None,
+                             index_url=None):
+    # With a wheelhouse, packages are installed only from local disk.
+    # Packages that the recorded pip freeze satisfies are skipped, and pip
+    # replaces the installed version of the others that do not match.
+    installed = get_recorded_packages(venv)
+    summary = dict((package, 'installed') for package in packages_list)
+    if packages_list and installed:
+        packages_list, summary = resolve_packages_to_install(
+            packages_list, installed)
+        ctx.logger.info("Packages on playbook`s venv: {summary}".format(
+            summary=', '.join('{0}: {1}'.format(package, state)
+                              for package, state in summary.items())))
+        if not packages_list:
+            return summary
     if packages_list:
         ctx.logger.debug("venv = {path}".format(path=venv))
         command = [get_executable_path('pip', venv=venv), 'install',
-                   '--force-reinstall', '--retries=2',
-                   '--timeout=15'] + packages_list
+                   '--retries=2', '--timeout=15'] + \
+            get_pip_index_args(wheelhouse, index_url) + packages_list
         ctx.logger.debug("cmd:{command}".format(command=command))
         ctx.logger.info("Installing {packages} on playbook`s venv.".format(
             packages=packages_list))
@@ -749,83 +1835,622 @@ def install_packages_to_venv(venv, packages_list):
                                       " playbook`s venv. Error message: "
                                       "{err}".format(err=e))
     set_installed_packages(venv)
-
-
-def install_collections_to_venv(venv, collections_list, collections_dir):
+    return summary
+
+
+def _get_galaxy_install_command(venv,
+                                kind,
+                                items,
+                                target_dir,
+                                offline=False,
+                                galaxy_server=None):
+    command = [get_executable_path('ansible-galaxy', venv=venv)]
+    if kind == 'collection':
+        command.append('collection')
+    command += ['install', '--force', '-p', target_dir]
+    if offline:
+        command.append('--no-deps')
+    elif galaxy_server and galaxy_server != DEFAULT_GALAXY_SERVER_URL:
+        command += ['-s', galaxy_server]
+    return command + list(items)
+
+
+def install_collections_to_venv(venv,
+                                collections_list,
+                                collections_dir,
+                                offline=False,
+                                galaxy_server=None,
+                                store_dir=None):
     # Force reinstall in playbook venv in order to make sure
     # they being installed on specified environment .
+    # Offline, collections_list is a list of local tarballs, and
+    # dependencies can not be resolved from galaxy.
+    # With a shared galaxy store, collections are linked from the store.
     if collections_list:
         ctx.logger.debug("venv = {path}".format(path=venv))
-        command = [get_executable_path('ansible-galaxy', venv=venv),
-                   'collection',
-                   'install',
-                   '--force',
-                   '-p',
-                   collections_dir] + collections_list
+        command = _get_galaxy_install_command(
+            venv, 'collection', collections_list, collections_dir,
+            offline, galaxy_server)
         ctx.logger.debug("cmd:{command}".format(command=command))
         ctx.logger.info("Installing {packages} on playbook`s venv.".format(
             packages=collections_list))
-        get_command = [get_executable_path('ansible-galaxy', venv=venv),
-                       'collection',
-                       'list',
-                       '-p',
-                       collections_dir]
         try:
-            runner.run(command=command,
-                       cwd=venv,
-                       execution_env={'LANG': 'en_US.UTF-8', 'PYTHONPATH': ''})
-            installed_collections = \
-                runner.run(command=get_command,
+            if store_dir:
+                install_from_galaxy_store(store_dir, venv, 'collection',
+                                          collections_list, collections_dir,
+                                          offline, galaxy_server)
+            else:
+                runner.run(command=command,
                            cwd=venv,
-                           execution_env={
-                               'LANG': 'en_US.UTF-8',
-                               'PYTHONPATH': ''}
-                           )
+                           execution_env={'LANG': 'en_US.UTF-8',
+                                          'PYTHONPATH': ''})
             get_instance(ctx).runtime_properties[INSTALLED_COLLECTIONS] = \
-                installed_collections.std_out
+                scan_galaxy_content(collections_dir, 'collection')
         except CommandExecutionException as e:
             raise NonRecoverableError("Can't install galaxy_collections on"
                                       " playbook`s venv. Error message: "
                                       "{err}".format(err=e))
 
 
-def install_roles_to_venv(venv, roles_list, roles_dir):
+def install_roles_to_venv(venv,
+                          roles_list,
+                          roles_dir,
+                          offline=False,
+                          galaxy_server=None,
+                          store_dir=None):
     # Force reinstall in playbook venv in order to make sure
     # they being installed on specified environment .
+    # Offline, roles_list is a list of local tarballs, and
+    # dependencies can not be resolved from galaxy.
+    # With a shared galaxy store, roles are linked from the store.
     if roles_list:
         ctx.logger.debug("venv = {path}".format(path=venv))
-        command = [get_executable_path('ansible-galaxy', venv=venv),
-                   'install',
-                   '--force',
-                   '-p',
-                   roles_dir] + roles_list
+        command = _get_galaxy_install_command(
+            venv, 'role', roles_list, roles_dir, offline, galaxy_server)
         ctx.logger.debug("cmd:{command}".format(command=command))
         ctx.logger.info("Installing {packages} in location {location}.".format(
             packages=roles_list,
             location=roles_dir))
-        get_command = [get_executable_path('ansible-galaxy', venv=venv),
-                       'list',
-                       '-p',
-                       roles_dir]
         try:
-            runner.run(command=command,
-                       cwd=venv,
-                       execution_env={'LANG': 'en_US.UTF-8', 'PYTHONPATH': ''})
-            installed_roles = \
-                runner.run(command=get_command,
+            if store_dir:
+                install_from_galaxy_store(store_dir, venv, 'role',
+                                          roles_list, roles_dir,
+                                          offline, galaxy_server)
+            else:
+                runner.run(command=command,
                            cwd=venv,
-                           execution_env={
-                               'LANG': 'en_US.UTF-8',
-                               'PYTHONPATH': ''}
-                           )
+                           execution_env={'LANG': 'en_US.UTF-8',
+                                          'PYTHONPATH': ''})
             get_instance(ctx).runtime_properties[INSTALLED_ROLES] = \
-                installed_roles.std_out
+                scan_galaxy_content(roles_dir, 'role')
         except CommandExecutionException as e:
             raise NonRecoverableError("Can't install roles on"
                                       " playbook`s venv. Error message: "
                                       "{err}".format(err=e))
 
 
+def get_tree_digest(path, exclude=('.galaxy_install_info',)):
+    """sha256 of the relative paths and the content of the files under
+    path. Files named in exclude, such as install timestamps, are skipped.
+    """
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name in exclude:
+                continue
+            file_path = os.path.join(root, name)
+            digest.update(os.path.relpath(file_path, path).encode())
+            digest.update(b'\0')
+            if os.path.islink(file_path):
+                digest.update(os.readlink(file_path).encode())
+                continue
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_galaxy_metadata(path):
+    """Read the name and version of an installed collection or role from
+    MANIFEST.json or galaxy.yml, or from meta/.galaxy_install_info.
+
+    :param path: The collection or role directory.
+    :return: dict with name and version, or None if path is neither.
+    """
+    manifest = os.path.join(path, 'MANIFEST.json')
+    galaxy_yml = os.path.join(path, 'galaxy.yml')
+    info = None
+    if os.path.isfile(manifest):
+        with open(manifest) as f:
+            info = json.load(f).get('collection_info') or {}
+    elif os.path.isfile(galaxy_yml):
+        with open(galaxy_yml) as f:
+            info = yaml.safe_load(f) or {}
+    if info is not None:
+        return {'name': '{0}.{1}'.format(info.get('namespace'),
+                                         info.get('name')),
+                'version': info.get('version')}
+    meta_dir = os.path.join(path, 'meta')
+    info_file = os.path.join(meta_dir, '.galaxy_install_info')
+    if os.path.isfile(info_file):
+        with open(info_file) as f:
+            return {'name': os.path.basename(path),
+                    'version': (yaml.safe_load(f) or {}).get('version')}
+    if os.path.isfile(os.path.join(meta_dir, 'main.yml')) or \
+            os.path.isfile(os.path.join(meta_dir, 'main.yaml')):
+        return {'name': os.path.basename(path), 'version': None}
+
+
+def _get_galaxy_content_dirs(install_dir, kind):
+    if kind == 'collection':
+        collections_dir = os.path.join(install_dir, 'ansible_collections')
+        namespaces = [os.path.join(collections_dir, namespace) for namespace
+                      in sorted(os.listdir(collections_dir))]
+        return [collections_dir] + namespaces, [
+            os.path.join(namespace, name) for namespace in namespaces
+            if os.path.isdir(namespace)
+            for name in sorted(os.listdir(namespace))]
+    return [install_dir], [os.path.join(install_dir, role)
+                           for role in sorted(os.listdir(install_dir))]
+
+
+def scan_galaxy_content(install_dir, kind):
+    """List the collections or roles installed in install_dir, without
+    running ansible-galaxy list. Results are cached until the mtime of
+    the directories that hold them changes.
+
+    :param install_dir: A collections path or a roles path.
+    :param kind: 'collection' or 'role'.
+    :return: list of dicts with name and version.
+    """
+    try:
+        parents, candidates = _get_galaxy_content_dirs(install_dir, kind)
+        signature = [(path, os.lstat(path).st_mtime)
+                     for path in parents + candidates]
+    except OSError:
+        return []
+    cache_key = (os.path.realpath(install_dir), kind)
+    with _galaxy_scan_lock:
+        cached = _galaxy_scan_cache.get(cache_key)
+        if cached and cached[0] == signature:
+            return deepcopy(cached[1])
+    content = []
+    for path in candidates:
+        if os.path.isdir(path):
+            metadata = read_galaxy_metadata(path)
+            if metadata:
+                content.append(metadata)
+    with _galaxy_scan_lock:
+        _galaxy_scan_cache[cache_key] = (signature, content)
+    return deepcopy(content)
+
+
+def get_galaxy_versions(install_dir, kind):
+    """Read the versions of the collections or roles in install_dir.
+
+    :return: dict of collection or role name to version.
+    """
+    return {content['name']: content['version']
+            for content in scan_galaxy_content(install_dir, kind)}
+
+
+def _get_galaxy_request_key(kind, item, offline, galaxy_server):
+    if offline:
+        # item is a local tarball, roles as 'tarball,version,name'.
+        with open(item.split(',', 1)[0], 'rb') as f:
+            source = hashlib.sha256(f.read()).hexdigest()
+    else:
+        source = galaxy_server or DEFAULT_GALAXY_SERVER_URL
+    return hashlib.sha256(
+        json.dumps([kind, item, source]).encode()).hexdigest()
+
+
+def get_galaxy_store_entry(store_dir,
+                           venv,
+                           kind,
+                           item,
+                           offline=False,
+                           galaxy_server=None):
+    """Get the store entry with a collection or role and its dependencies,
+    installing it on first use. Entries are named by the digest of their
+    content, so requests that resolve to the same versions share one.
+    A request is installed again only when the requested version changes.
+
+    :param store_dir: The shared galaxy store.
+    :param venv: The venv with ansible-galaxy.
+    :param kind: 'collection' or 'role'.
+    :param item: a collection or role as passed to ansible-galaxy install.
+    :return: The path to the entry.
+    """
+    requests_dir = os.path.join(store_dir, 'requests')
+    entries_dir = os.path.join(store_dir, kind + 's')
+    for directory in (requests_dir, entries_dir):
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+    key = _get_galaxy_request_key(kind, item, offline, galaxy_server)
+    request_file = os.path.join(requests_dir, key + '.json')
+    with lock_file(os.path.join(requests_dir, key + '.lock')):
+        if os.path.isfile(request_file):
+            with open(request_file) as f:
+                entry_dir = os.path.join(entries_dir, json.load(f)['entry'])
+            if os.path.isdir(entry_dir):
+                ctx.logger.debug('Using {0} from the galaxy store.'.format(
+                    item))
+                return entry_dir
+        staging_dir = mkdtemp(dir=store_dir)
+        try:
+            runner.run(command=_get_galaxy_install_command(
+                venv, kind, [item], staging_dir, offline, galaxy_server),
+                cwd=venv,
+                execution_env={'LANG': 'en_US.UTF-8', 'PYTHONPATH': ''})
+            versions = get_galaxy_versions(staging_dir, kind)
+            entry = get_tree_digest(staging_dir)
+            entry_dir = os.path.join(entries_dir, entry)
+            with lock_file(entry_dir + '.lock'):
+                if os.path.isdir(entry_dir):
+                    delete_temp_folder(staging_dir)
+                else:
+                    # Entries are shared by deployments, so they are kept
+                    # read only.
+                    make_tree_read_only(staging_dir)
+                    os.chmod(staging_dir, 0o755)
+                    os.rename(staging_dir, entry_dir)
+        except BaseException:
+            delete_temp_folder(staging_dir)
+            raise
+        with open(request_file, 'w') as f:
+            json.dump({'item': item, 'entry': entry, 'versions': versions},
+                      f)
+        ctx.logger.info('Added {0} {1} to the galaxy store.'.format(
+            kind, versions))
+    return entry_dir
+
+
+def _replace_with_symlink(source, destination):
+    if os.path.islink(destination):
+        if os.readlink(destination) == source:
+            return
+        os.unlink(destination)
+    elif os.path.isdir(destination):
+        shutil.rmtree(destination)
+    elif os.path.exists(destination):
+        os.unlink(destination)
+    parent = os.path.dirname(destination)
+    if not os.path.isdir(parent):
+        os.makedirs(parent, exist_ok=True)
+    os.symlink(source, destination)
+
+
+def _get_galaxy_store_links(entry_dir, target_dir, kind):
+    """The content of a store entry, and where it is linked in target_dir.
+    """
+    if kind == 'collection':
+        entry_collections = os.path.join(entry_dir, 'ansible_collections')
+        for namespace in os.listdir(entry_collections):
+            namespace_dir = os.path.join(entry_collections, namespace)
+            for name in os.listdir(namespace_dir):
+                yield (os.path.join(namespace_dir, name),
+                       os.path.join(target_dir, 'ansible_collections',
+                                    namespace, name))
+    else:
+        for role in os.listdir(entry_dir):
+            yield os.path.join(entry_dir, role), os.path.join(target_dir, role)
+
+
+def link_galaxy_store_entry(entry_dir, target_dir, kind):
+    """Symlink the collections or roles of a store entry into target_dir,
+    a collections path or a roles path.
+    """
+    for source, destination in _get_galaxy_store_links(
+            entry_dir, target_dir, kind):
+        _replace_with_symlink(source, destination)
+
+
+def _is_galaxy_store_entry_linked(entry_dir, target_dir, kind):
+    try:
+        return any(os.path.islink(destination) and
+                   os.readlink(destination) == source
+                   for source, destination in _get_galaxy_store_links(
+                       entry_dir, target_dir, kind))
+    except OSError:
+        return False
+
+
+def install_from_galaxy_store(store_dir,
+                              venv,
+                              kind,
+                              items,
+                              target_dir,
+                              offline=False,
+                              galaxy_server=None):
+    """Link collections or roles from the galaxy store into target_dir.
+    target_dir is recorded in the refs of each entry, for
+    collect_galaxy_store.
+    """
+    target_key = hashlib.sha256(target_dir.encode('utf-8')).hexdigest()
+    for item in items:
+        for _ in range(2):
+            entry_dir = get_galaxy_store_entry(
+                store_dir, venv, kind, item, offline, galaxy_server)
+            with lock_file(entry_dir + '.lock'):
+                # Unless collect_galaxy_store just removed it.
+                if not os.path.isdir(entry_dir):
+                    continue
+                refs_dir = entry_dir + '.refs'
+                if not os.path.isdir(refs_dir):
+                    os.makedirs(refs_dir, exist_ok=True)
+                with open(os.path.join(refs_dir, target_key), 'w') as f:
+                    f.write(target_dir)
+                link_galaxy_store_entry(entry_dir, target_dir, kind)
+                break
+        else:
+            raise NonRecoverableError(
+                'The galaxy store entry of {0} was removed.'.format(item))
+
+
+def collect_galaxy_store(store_dir, dry_run=True, min_age=GC_MIN_AGE):
+    """Remove the entries of the galaxy store that are not linked from
+    any of the collections or roles paths they were installed to.
+
+    :param store_dir: The shared galaxy store.
+    :param dry_run: Only report what would be removed.
+    :param min_age: Skip entries used in the last min_age seconds.
+    :return: dict of the removed entries to their size in bytes.
+    """
+    report = {}
+    now = time.time()
+    for kind in ('collection', 'role'):
+        entries_dir = os.path.join(store_dir, kind + 's')
+        if not os.path.isdir(entries_dir):
+            continue
+        for name in sorted(os.listdir(entries_dir)):
+            entry_dir = os.path.join(entries_dir, name)
+            if os.path.islink(entry_dir) or not os.path.isdir(entry_dir) or \
+                    name.endswith('.refs'):
+                continue
+            with lock_file(entry_dir + '.lock'):
+                refs_dir = entry_dir + '.refs'
+                refs = []
+                if os.path.isdir(refs_dir):
+                    refs = [os.path.join(refs_dir, ref)
+                            for ref in os.listdir(refs_dir)]
+                last_used = max([os.path.getmtime(entry_dir)] +
+                                [os.path.getmtime(ref) for ref in refs])
+                if now - last_used < min_age:
+                    continue
+                live = False
+                for ref in refs:
+                    with open(ref) as f:
+                        target_dir = f.read()
+                    if _is_galaxy_store_entry_linked(
+                            entry_dir, target_dir, kind):
+                        live = True
+                    elif not dry_run:
+                        os.remove(ref)
+                if live:
+                    continue
+                report[entry_dir] = collect_dir(entry_dir, dry_run)
+                if not dry_run:
+                    delete_temp_folder(refs_dir)
+    return report
+
+
+def _split_galaxy_requirement(requirement):
+    """Split 'namespace.name:==1.0.0' or 'name,1.0.0' to name and version.
+    Version ranges are ignored, and the newest artifact is used.
+    """
+    for separator in (':', ','):
+        if separator in requirement:
+            name, version = requirement.split(separator, 1)
+            version = version.strip()
+            if version.startswith('=='):
+                version = version[2:]
+            elif not version[:1].isdigit():
+                version = None
+            return name.strip(), version
+    return requirement.strip(), None
+
+
+def _get_version_key(version):
+    return [int(number) for number in re.findall(r'\d+', version)]
+
+
+def get_offline_galaxy_artifacts(requirements, artifacts_dir, role=False):
+    """Find the local tarballs for galaxy collections or roles.
+    Tarballs are expected to be named like the ones that
+    `ansible-galaxy collection download` creates:
+    namespace-name-version.tar.gz (or namespace.name-version.tar.gz).
+
+    :param requirements: list of collections or roles, as given by the user.
+    :param artifacts_dir: the directory with the tarballs.
+    :param role: whether these are roles.
+    :return: list of arguments for ansible-galaxy install.
+    """
+    artifacts = []
+    missing = []
+    tarballs = [f for f in os.listdir(artifacts_dir)
+                if f.endswith('.tar.gz')]
+    for requirement in requirements:
+        name, version = _split_galaxy_requirement(requirement)
+        candidates = []
+        for tarball in tarballs:
+            base = tarball[:-len('.tar.gz')]
+            for prefix in {name, name.replace('.', '-')}:
+                if not base.startswith(prefix + '-'):
+                    continue
+                tarball_version = base[len(prefix) + 1:]
+                if not version or tarball_version == version:
+                    candidates.append((tarball_version, tarball))
+        if not candidates:
+            missing.append(requirement)
+            continue
+        tarball_version, tarball = max(
+            candidates, key=lambda c: _get_version_key(c[0]))
+        tarball = os.path.join(artifacts_dir, tarball)
+        if role:
+            # ansible-galaxy role format: src,version,name
+            artifacts.append(
+                '{0},{1},{2}'.format(tarball, tarball_version, name))
+        else:
+            artifacts.append(tarball)
+    if missing:
+        raise NonRecoverableError(
+            'No artifacts for {0} in {1}.'.format(missing, artifacts_dir))
+    return artifacts
+
+
+def parse_galaxy_requirements(requirements_file):
+    """Read the collections and roles of a galaxy requirements.yml.
+    Both the current format and the legacy list of roles are supported.
+
+    :return: two lists of dicts with name and version, for collections
+     and roles.
+    """
+    with open(requirements_file) as f:
+        requirements = yaml.safe_load(f) or {}
+    if isinstance(requirements, list):
+        requirements = {'roles': requirements}
+    parsed = []
+    for section in ('collections', 'roles'):
+        entries = []
+        for entry in requirements.get(section) or []:
+            if not isinstance(entry, dict):
+                entry = {'name': entry}
+            name = entry.get('name') or entry.get('src') or ''
+            if section == 'roles' and '://' in name:
+                name = os.path.basename(name)
+                for extension in ('.git', '.tar.gz'):
+                    if name.endswith(extension):
+                        name = name[:-len(extension)]
+            entries.append({'name': name,
+                            'version': entry.get('version')})
+        parsed.append(entries)
+    return parsed[0], parsed[1]
+
+
+def _get_galaxy_locations(instance, collections, roles):
+    # The directories of the requirements, from the galaxy install paths.
+    locations = {}
+    if collections:
+        collections_location = _get_collections_location(instance)
+        for entry in collections:
+            namespace, _, name = entry['name'].partition('.')
+            locations[entry['name']] = os.path.join(
+                collections_location, 'ansible_collections', namespace, name)
+    if roles:
+        roles_location = _get_roles_location(instance)
+        for entry in roles:
+            locations[entry['name']] = os.path.join(
+                roles_location, entry['name'])
+    return locations
+
+
+def _get_requirements_lock(requirements_digest, locations):
+    lock = {'requirements': requirements_digest, 'content': {}}
+    for name, path in locations.items():
+        if not os.path.isdir(path):
+            return
+        lock['content'][name] = {'path': path,
+                                 'version': (read_galaxy_metadata(path)
+                                             or {}).get('version'),
+                                 'sha256': get_tree_digest(path)}
+    return lock
+
+
+def download_galaxy_requirements(_ctx, requirements, workspace):
+    """Copy the requirements.yml from the blueprint or a URL to the
+    workspace.
+    """
+    requirements_file = os.path.join(workspace, GALAXY_REQUIREMENTS_FILE)
+    if requirements.split('://')[0] in ('http', 'https'):
+        shutil.copy(get_shared_resource(requirements), requirements_file)
+    else:
+        _ctx.download_resource(requirements, requirements_file)
+    return requirements_file
+
+
+def install_galaxy_requirements(_ctx, requirements=None):
+    """Install the collections and roles of a galaxy requirements.yml.
+    The digests of what was installed are kept in a lockfile in the
+    workspace, and the installation is skipped while the requirements
+    and the installed directories match the lockfile. Dependencies that
+    are not listed in the requirements are not locked.
+
+    :param _ctx: cloudify context.
+    :param requirements: blueprint path or URL of the requirements.yml.
+    """
+    requirements = requirements or get_node(_ctx).properties.get(
+        'galaxy_requirements')
+    if not requirements:
+        return
+    if not is_local_venv():
+        raise NonRecoverableError(
+            'Do not use galaxy_requirements when working on the plugin '
+            'virtualenv, galaxy_requirements are installed in a playbook '
+            'virtualenv.')
+    instance = get_instance(_ctx)
+    workspace = instance.runtime_properties.get(WORKSPACE)
+    venv = instance.runtime_properties.get(PLAYBOOK_VENV)
+    requirements_file = download_galaxy_requirements(
+        _ctx, requirements, workspace)
+    with open(requirements_file, 'rb') as f:
+        requirements_digest = hashlib.sha256(f.read()).hexdigest()
+    collections, roles = parse_galaxy_requirements(requirements_file)
+    locations = _get_galaxy_locations(instance, collections, roles)
+    lock_path = os.path.join(workspace, GALAXY_REQUIREMENTS_LOCK)
+    if os.path.isfile(lock_path):
+        with open(lock_path) as f:
+            lock = json.load(f)
+        if lock == _get_requirements_lock(requirements_digest, locations):
+            _ctx.logger.info(
+                'The galaxy requirements match {0}, skipping the '
+                'installation.'.format(lock_path))
+            return
+
+    artifacts_dir = get_offline_path(_ctx, 'galaxy_artifacts_path')
+    galaxy_server = get_galaxy_server_url(_ctx)
+    if not artifacts_dir and not is_connected_to_internet(galaxy_server):
+        raise NonRecoverableError('No internet connection.'
+                                  'Do not use galaxy_requirements when'
+                                  ' working on the plugin virtualenv.')
+    execution_env = {'LANG': 'en_US.UTF-8', 'PYTHONPATH': ''}
+    for kind, entries, location in (
+            ('collection', collections,
+             collections and _get_collections_location(instance)),
+            ('role', roles, roles and _get_roles_location(instance))):
+        if not entries:
+            continue
+        if artifacts_dir:
+            items = get_offline_galaxy_artifacts(
+                ['{0}:=={1}'.format(e['name'], e['version'])
+                 if e['version'] else e['name'] for e in entries],
+                artifacts_dir, role=kind == 'role')
+        else:
+            items = ['-r', requirements_file]
+        command = _get_galaxy_install_command(
+            venv, kind, items, location, bool(artifacts_dir), galaxy_server)
+        if kind == 'role' and not artifacts_dir:
+            command.insert(1, 'role')
+        _ctx.logger.info('Installing the {0}s of {1}.'.format(
+            kind, requirements))
+        try:
+            runner.run(command=command, cwd=venv, execution_env=execution_env)
+        except CommandExecutionException as e:
+            raise NonRecoverableError(
+                "Can't install the galaxy requirements. "
+                "Error message: {err}".format(err=e))
+
+    lock = _get_requirements_lock(requirements_digest, locations)
+    if lock:
+        with open(lock_path, 'w') as f:
+            json.dump(lock, f, indent=2, sort_keys=True)
+    else:
+        _ctx.logger.error('Not all galaxy requirements were found after '
+                          'the installation, not writing {0}.'.format(
+                              lock_path))
+
+
 def get_executable_path(executable, venv):
     """
     :param executable: the name of the executable
@@ -876,7 +2501,7 @@ def install_galaxy_collections(_ctx,
         inside venv.
        """
 
-    def _install_galaxy_collections(instance=None):
+    def _install_galaxy_collections(instance=None, artifacts_dir=None):
         venv_path = instance.runtime_properties.get(PLAYBOOK_VENV)
         collections_location = _get_collections_location(instance)
         _ctx.logger.info(
@@ -885,15 +2510,25 @@ def install_galaxy_collections(_ctx,
                 collections_location
             )
         )
+        collections_list = collections_to_install
+        if artifacts_dir:
+            collections_list = get_offline_galaxy_artifacts(
+                collections_to_install, artifacts_dir)
         install_collections_to_venv(venv_path,
-                                    collections_to_install,
-                                    collections_location)
+                                    collections_list,
+                                    collections_location,
+                                    offline=bool(artifacts_dir),
+                                    galaxy_server=galaxy_server,
+                                    store_dir=get_galaxy_store_dir(_ctx))
 
     if collections_to_install:
         instance = get_instance(ctx)
-        if is_connected_to_internet():
+        artifacts_dir = get_offline_path(_ctx, 'galaxy_artifacts_path')
+        galaxy_server = get_galaxy_server_url(_ctx)
+        if artifacts_dir or is_connected_to_internet(galaxy_server):
             if is_local_venv():
-                _install_galaxy_collections(instance=instance)
+                _install_galaxy_collections(instance=instance,
+                                            artifacts_dir=artifacts_dir)
         else:
             raise NonRecoverableError('No internet connection.'
                                       'Do not use galaxy_collections when'
@@ -909,7 +2544,7 @@ def install_roles(_ctx,
        :param roles_to_install: list of roles to install
        """
 
-    def _install_roles(instance=None):
+    def _install_roles(instance=None, artifacts_dir=None):
         venv_path = instance.runtime_properties.get(PLAYBOOK_VENV)
         roles_location = _get_roles_location(instance)
         _ctx.logger.info(
@@ -918,15 +2553,24 @@ def install_roles(_ctx,
                 roles_location
             )
         )
+        roles_list = roles_to_install
+        if artifacts_dir:
+            roles_list = get_offline_galaxy_artifacts(
+                roles_to_install, artifacts_dir, role=True)
         install_roles_to_venv(venv_path,
-                              roles_to_install,
-                              roles_location)
+                              roles_list,
+                              roles_location,
+                              offline=bool(artifacts_dir),
+                              galaxy_server=galaxy_server,
+                              store_dir=get_galaxy_store_dir(_ctx))
 
     if roles_to_install:
         instance = get_instance(_ctx)
-        if is_connected_to_internet():
+        artifacts_dir = get_offline_path(_ctx, 'galaxy_artifacts_path')
+        galaxy_server = get_galaxy_server_url(_ctx)
+        if artifacts_dir or is_connected_to_internet(galaxy_server):
             if is_local_venv():
-                _install_roles(instance=instance)
+                _install_roles(instance=instance, artifacts_dir=artifacts_dir)
         else:
             raise NonRecoverableError('No internet connection.'
                                       'Do not use roles when'
@@ -944,7 +2588,24 @@ def install_extra_packages(_ctx,
        """
 
     if packages_to_install:
-        if is_connected_to_internet():
+        shared_venv = get_instance(_ctx).runtime_properties.get(SHARED_VENV)
+        if shared_venv:
+            missing = [package for package in packages_to_install
+                       if package not in shared_venv['extra_packages']]
+            if not missing:
+                _ctx.logger.info(
+                    "extra_packages {} already in shared venv".format(
+                        str(packages_to_install)))
+                return
+            # Never change a venv that others may use, move to the
+            # venv that has all the packages instead.
+            acquire_shared_venv(_ctx,
+                                shared_venv['ansible'],
+                                shared_venv['extra_packages'] + missing)
+            return
+        wheelhouse = get_offline_path(_ctx, 'wheelhouse_path')
+        index_url = get_pip_index_url(_ctx)
+        if wheelhouse or is_connected_to_internet(index_url):
             if is_local_venv():
                 venv_path = \
                     get_instance(_ctx).runtime_properties.get(PLAYBOOK_VENV)
@@ -953,7 +2614,8 @@ def install_extra_packages(_ctx,
                         str(packages_to_install),
                         venv_path)
                 )
-                install_packages_to_venv(venv_path, packages_to_install)
+                install_packages_to_venv(
+                    venv_path, packages_to_install, wheelhouse, index_url)
         else:
             raise NonRecoverableError('No internet connection.'
                                       'Do not use extra_packages when'
@@ -961,6 +2623,11 @@ def install_extra_packages(_ctx,
 
 
 def setup_kerberos(_ctx):
+    setup_kerberos_config(_ctx)
+    patch_winrm_connection(_ctx)
+
+
+def setup_kerberos_config(_ctx):
 
     _ctx_node = get_node(_ctx)
     _ctx_instance = get_instance(_ctx)
@@ -996,18 +2663,34 @@ def setup_kerberos(_ctx):
                 'The kerberos_config was provided, '
                 'but it is not in string or dict format.')
 
+
+WINRM_CONNECTION_PATCH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'ansible/plugins/connection/winrm.py')
+
+
+def _patch_winrm_connection(venv, logger):
+    rel_path = 'ansible/plugins/connection/winrm.py'
+    for file in sorted(pathlib.Path(venv).rglob('*/' + rel_path)):
+        logger.debug('Replacing {} with {}'.format(
+            WINRM_CONNECTION_PATCH, file))
+        if os.path.samefile(WINRM_CONNECTION_PATCH, file.as_posix()):
+            continue
+        # Remove first, the file may be hard linked to a template venv.
+        os.remove(file.as_posix())
+        shutil.copy2(WINRM_CONNECTION_PATCH, os.path.dirname(file.as_posix()))
+
+
+def patch_winrm_connection(_ctx):
+
+    _ctx_instance = get_instance(_ctx)
     venv = _ctx_instance.runtime_properties.get(PLAYBOOK_VENV)
     if not _ctx_instance.runtime_properties.get('__UPDATE_WINRM'):
-        _ctx.logger.debug('Patching WinRM Ansible connection module.')
-        REL_PATH = 'ansible/plugins/connection/winrm.py'
-        abs_path = os.path.join(
-            os.path.dirname(os.path.abspath(__file__)), REL_PATH)
-        for file in sorted(pathlib.Path(venv).rglob('*/' + REL_PATH)):
-            _ctx.logger.debug('Replacing {} with {}'.format(abs_path, file))
-            try:
-                shutil.copy2(abs_path, os.path.dirname(file.as_posix()))
-            except shutil.SameFileError:
-                pass
+        # Shared venvs are patched when they are created, and the patch is
+        # part of their key, so they are never changed afterwards.
+        if not _ctx_instance.runtime_properties.get(SHARED_VENV):
+            _ctx.logger.debug('Patching WinRM Ansible connection module.')
+            _patch_winrm_connection(venv, _ctx.logger)
         _ctx_instance.runtime_properties['__UPDATE_WINRM'] = True
 
 
@@ -1030,27 +2713,621 @@ def setup_modules(_ctx, module_path=None):
             outfile.write(infile.read())
 
 
-def create_playbook_venv(_ctx):
+@contextmanager
+def lock_file(path):
+    """Hold an exclusive lock on path for the duration of the block.
+    Used to serialize work between operations running in parallel.
+
+    :param path: The lock file, created if it does not exist.
+    """
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def record_provisioning_plan(_ctx,
+                             extra_packages=None,
+                             galaxy_collections=None,
+                             roles=None,
+                             module_path=None):
+    """Store what the venv should contain instead of building it now.
+    The plan is materialized by the first operation that needs the venv.
+    """
+    _ctx_instance = get_instance(_ctx)
+    _ctx_instance.runtime_properties[PROVISIONING_PLAN] = {
+        'extra_packages': extra_packages or [],
+        'galaxy_collections': galaxy_collections or [],
+        'roles': roles or [],
+        'module_path': module_path,
+    }
+    _ctx.logger.info(
+        'Deferring the Ansible venv creation to the first playbook run.')
+
+
+@contextmanager
+def provisioning_lock(_ctx):
+    """Serialize venv materialization between the operations of a node
+    instance, e.g. relationship operations to several targets.
+    """
+    _ctx_instance = get_instance(_ctx)
+    lock_path = os.path.join(
+        get_deployment_dir(_ctx.deployment.id),
+        '.{0}.provisioning.lock'.format(_ctx_instance.id))
+    with lock_file(lock_path):
+        yield
+
+
+def get_shared_venvs_dir(_ctx, store_name=SHARED_VENVS_DIR):
+    """The shared venv store lives next to the tenant's deployment
+    directories, so that all deployments of a tenant can use it.
+
+    :param _ctx: cloudify context.
+    :param store_name: SHARED_VENVS_DIR, TEMPLATE_VENVS_DIR or
+     GALAXY_STORE_DIR.
+    :return: The path to the store.
+    """
+    deployment_dir = get_deployment_dir(_ctx.deployment.id)
+    store_dir = os.path.join(os.path.dirname(deployment_dir), store_name)
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir, exist_ok=True)
+        os.chmod(store_dir, 0o755)
+    return store_dir
+
+
+def get_galaxy_store_dir(_ctx):
+    """The shared galaxy store, if use_shared_galaxy_store is set."""
+    if get_node(_ctx).properties.get('use_shared_galaxy_store'):
+        return get_shared_venvs_dir(_ctx, GALAXY_STORE_DIR)
+
+
+def get_shared_venv_key(ansible_to_install, extra_packages=None):
+    """Venvs with the same python version, ansible, extra packages and
+    WinRM connection patch are identical, so the key is a hash of those
+    values.
+
+    :param ansible_to_install: ANSIBLE_TO_INSTALL or installation_source.
+    :param extra_packages: list of python packages to install.
+    :return: sha256 hex digest.
+    """
+    key_data = {
+        'python': '{0}.{1}'.format(*sys.version_info[:2]),
+        'ansible': ansible_to_install,
+        'extra_packages': sorted(set(extra_packages or [])),
+    }
+    if os.path.isfile(WINRM_CONNECTION_PATCH):
+        key_data['winrm_patch'] = get_file_digest(WINRM_CONNECTION_PATCH)
+    return hashlib.sha256(
+        json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+
+def _get_shared_venv_reference(_ctx):
+    return '{0}.{1}'.format(_ctx.deployment.id, get_instance(_ctx).id)
+
+
+def acquire_shared_venv(_ctx, ansible_to_install, extra_packages=None):
+    """Get a venv from the shared venv store, creating it if no other
+    deployment created it already, and record our reference to it. The
+    reference to the venv we used before, if any, is released.
+
+    :param _ctx: cloudify context.
+    :param ansible_to_install: ANSIBLE_TO_INSTALL or installation_source.
+    :param extra_packages: list of python packages to install.
+    :return: The path to the venv.
+    """
+    instance = get_instance(_ctx)
+    extra_packages = sorted(set(extra_packages or []))
+    store_dir = get_shared_venvs_dir(_ctx)
+    key = get_shared_venv_key(ansible_to_install, extra_packages)
+    entry_dir = os.path.join(store_dir, key)
+    venv_path = os.path.join(entry_dir, 'venv')
+    refs_dir = os.path.join(entry_dir, 'refs')
+    metadata_file = os.path.join(entry_dir, 'metadata.json')
+    with lock_file(os.path.join(store_dir, key + '.lock')):
+        if os.path.isfile(metadata_file):
+            _ctx.logger.info(
+                "Using shared python venv: {}".format(venv_path))
+            with open(metadata_file) as f:
+                metadata = json.load(f)
+            instance.runtime_properties[INSTALLED_PACKAGES] = \
+                metadata.get('installed_packages')
+        else:
+            _ctx.logger.info(
+                "Installing new shared python venv: {}".format(venv_path))
+            # Leftovers of a failed installation.
+            delete_temp_folder(entry_dir)
+            os.makedirs(refs_dir)
+            os.chmod(entry_dir, 0o755)
+            wheelhouse = get_offline_path(_ctx, 'wheelhouse_path')
+            make_virtualenv(path=venv_path, wheelhouse=wheelhouse)
+            install_packages_to_venv(venv_path,
+                                     [ansible_to_install] + extra_packages,
+                                     wheelhouse,
+                                     get_pip_index_url(_ctx))
+            _patch_winrm_connection(venv_path, _ctx.logger)
+            metadata = {
+                'ansible': ansible_to_install,
+                'extra_packages': extra_packages,
+                'installed_packages':
+                    instance.runtime_properties.get(INSTALLED_PACKAGES),
+            }
+            with open(metadata_file, 'w') as f:
+                json.dump(metadata, f)
+        pathlib.Path(
+            os.path.join(refs_dir, _get_shared_venv_reference(_ctx))).touch()
+    previous_key = (instance.runtime_properties.get(SHARED_VENV) or {}).get(
+        'key')
+    instance.runtime_properties[SHARED_VENV] = {
+        'key': key,
+        'ansible': ansible_to_install,
+        'extra_packages': extra_packages,
+    }
+    instance.runtime_properties[PLAYBOOK_VENV] = venv_path
+    instance.runtime_properties[LOCAL_VENV] = True
+    if previous_key and previous_key != key:
+        release_shared_venv(_ctx, previous_key)
+    return venv_path
+
+
+def release_shared_venv(_ctx, key=None):
+    """Drop our reference to a shared venv, and remove any venvs in the
+    store that nobody references any more.
+
+    :param _ctx: cloudify context.
+    :param key: The venv to release, by default the one we use now.
+    """
+    instance = get_instance(_ctx)
+    shared_venv = instance.runtime_properties.get(SHARED_VENV) or {}
+    key = key or shared_venv.get('key')
+    if not key:
+        return
+    store_dir = get_shared_venvs_dir(_ctx)
+    reference = os.path.join(
+        store_dir, key, 'refs', _get_shared_venv_reference(_ctx))
+    with lock_file(os.path.join(store_dir, key + '.lock')):
+        if os.path.exists(reference):
+            os.remove(reference)
+    if key == shared_venv.get('key'):
+        instance.runtime_properties.pop(SHARED_VENV, None)
+        instance.runtime_properties.pop(PLAYBOOK_VENV, None)
+        instance.runtime_properties.pop(LOCAL_VENV, None)
+    collect_shared_venvs(store_dir)
+
+
+def collect_shared_venvs(store_dir, dry_run=False, min_age=0):
+    """Remove the venvs in the shared venv store without references.
+
+    :param store_dir: The shared venv store.
+    :param dry_run: Only report what would be removed.
+    :param min_age: Skip venvs created in the last min_age seconds.
+    :return: dict of the removed venvs to their size in bytes.
+    """
+    report = {}
+    now = time.time()
+    for key in sorted(os.listdir(store_dir)):
+        entry_dir = os.path.join(store_dir, key)
+        if not os.path.isdir(entry_dir):
+            continue
+        with lock_file(os.path.join(store_dir, key + '.lock')):
+            refs_dir = os.path.join(entry_dir, 'refs')
+            if os.path.isdir(refs_dir) and os.listdir(refs_dir) or \
+                    now - os.path.getmtime(entry_dir) < min_age:
+                continue
+            report[entry_dir] = collect_dir(entry_dir, dry_run)
+    return report
+
+
+def collect_template_venvs(store_dir, dry_run=True, min_age=GC_MIN_AGE):
+    """Remove the template venvs that were not cloned in the last min_age
+    seconds. Clones do not depend on their template.
+
+    :param store_dir: The template venv store.
+    :param dry_run: Only report what would be removed.
+    :param min_age: Skip templates used in the last min_age seconds.
+    :return: dict of the removed templates to their size in bytes.
+    """
+    report = {}
+    now = time.time()
+    for key in sorted(os.listdir(store_dir)):
+        template_dir = os.path.join(store_dir, key)
+        if os.path.islink(template_dir) or not os.path.isdir(template_dir):
+            continue
+        with lock_file(os.path.join(store_dir, key + '.lock')):
+            metadata_file = os.path.join(template_dir, 'metadata.json')
+            if os.path.isfile(metadata_file):
+                last_used = os.path.getmtime(metadata_file)
+            else:
+                last_used = os.path.getmtime(template_dir)
+            if now - last_used < min_age:
+                continue
+            report[template_dir] = collect_dir(template_dir, dry_run)
+    return report
+
+
+def get_referenced_dirs(node_instances):
+    """The venvs, workspaces and module dirs in use by node instances.
+
+    :param node_instances: node instances with runtime_properties.
+    :return: set of normalized paths.
+    """
+    referenced = set()
+    for node_instance in node_instances:
+        runtime_properties = node_instance.runtime_properties or {}
+        for key in (PLAYBOOK_VENV, WORKSPACE, MODULE_PATH):
+            path = runtime_properties.get(key)
+            if path:
+                referenced.add(os.path.realpath(path))
+    return referenced
+
+
+def _is_plugin_dir(path):
+    # mkdtemp names are not unique to this plugin, look at the content.
+    return any(os.path.exists(os.path.join(path, marker)) for marker in (
+        'pyvenv.cfg', 'ansible.cfg', MODULE_NAME))
+
+
+def get_dir_size(path):
+    """Bytes used by the files under path, hard links counted once."""
+    size = 0
+    seen = set()
+    for root, _, files in os.walk(path):
+        for name in files:
+            file_stat = os.lstat(os.path.join(root, name))
+            if (file_stat.st_dev, file_stat.st_ino) in seen:
+                continue
+            seen.add((file_stat.st_dev, file_stat.st_ino))
+            size += file_stat.st_size
+    return size
+
+
+def find_orphaned_dirs(deployment_dir, referenced, min_age=GC_MIN_AGE):
+    """Find the plugin temp dirs of a deployment that no node instance uses.
+    Venvs and module dirs are created in the deployment dir, workspaces in
+    the node instance dirs.
+
+    :param deployment_dir: The deployment dir.
+    :param referenced: The paths in use, see get_referenced_dirs.
+    :param min_age: Skip dirs modified in the last min_age seconds, they
+     may belong to an operation that did not store its runtime properties.
+    :return: list of paths.
+    """
+    orphaned = []
+    parents = [deployment_dir]
+    for name in sorted(os.listdir(deployment_dir)):
+        path = os.path.join(deployment_dir, name)
+        if not name.startswith('tmp') and os.path.isdir(path) and \
+                not os.path.islink(path):
+            parents.append(path)
+    now = time.time()
+    for parent in parents:
+        for name in sorted(os.listdir(parent)):
+            path = os.path.join(parent, name)
+            if not name.startswith('tmp') or os.path.islink(path) or \
+                    not os.path.isdir(path):
+                continue
+            if os.path.realpath(path) in referenced or \
+                    not _is_plugin_dir(path) or \
+                    now - os.path.getmtime(path) < min_age:
+                continue
+            orphaned.append(path)
+    return orphaned
+
+
+def collect_orphaned_dirs(deployment_dir,
+                          node_instances,
+                          dry_run=True,
+                          min_age=GC_MIN_AGE):
+    """Remove the venvs, workspaces and module dirs of a deployment that
+    are not referenced by any of its node instances.
+
+    :param deployment_dir: The deployment dir.
+    :param node_instances: All node instances of the deployment.
+    :param dry_run: Only report what would be removed.
+    :param min_age: See find_orphaned_dirs.
+    :return: dict of the orphaned paths to their size in bytes.
+    """
+    referenced = get_referenced_dirs(node_instances)
+    report = {}
+    for path in find_orphaned_dirs(deployment_dir, referenced, min_age):
+        report[path] = collect_dir(path, dry_run)
+    log_garbage_report(report, dry_run, 'orphaned directories')
+    return report
+
+
+def collect_dir(path, dry_run=True):
+    """Remove a directory that garbage collection found, unless dry_run.
+
+    :return: The size of the directory in bytes.
+    """
+    size = get_dir_size(path)
+    if dry_run:
+        ctx.logger.info('Would remove {0} ({1} bytes).'.format(path, size))
+    else:
+        ctx.logger.info('Removing {0} ({1} bytes).'.format(path, size))
+        delete_temp_folder(path)
+    return size
+
+
+def log_garbage_report(report, dry_run, description='directories'):
+    ctx.logger.info('{0} {1} bytes in {2} {3}.'.format(
+        'Would free' if dry_run else 'Freed',
+        sum(report.values()), len(report), description))
+
+
+def collect_runtime_blobs(deployment_dir,
+                          node_instances,
+                          dry_run=True,
+                          min_age=GC_MIN_AGE):
+    """Remove the runtime property blobs of a deployment that the
+    persisted runtime properties of their node instance do not refer to,
+    like the ones that store_runtime_property superseded.
+
+    :param deployment_dir: The deployment dir.
+    :param node_instances: All node instances of the deployment.
+    :param dry_run: Only report what would be removed.
+    :param min_age: Skip blobs written in the last min_age seconds, which
+        may belong to an update in progress.
+    :return: dict of the removed paths to their size in bytes.
+    """
+    report = {}
+    now = time.time()
+    for node_instance in node_instances:
+        blobs_dir = os.path.join(
+            deployment_dir, node_instance.id, RUNTIME_BLOBS_DIR)
+        if not os.path.isdir(blobs_dir):
+            continue
+        referenced = _get_runtime_blob_paths(node_instance.runtime_properties)
+        for name in sorted(os.listdir(blobs_dir)):
+            path = os.path.join(blobs_dir, name)
+            if path in referenced or not os.path.isfile(path) or \
+                    now - os.path.getmtime(path) < min_age:
+                continue
+            report[path] = os.path.getsize(path)
+            if dry_run:
+                ctx.logger.info('Would remove {0} ({1} bytes).'.format(
+                    path, report[path]))
+            else:
+                ctx.logger.info('Removing {0} ({1} bytes).'.format(
+                    path, report[path]))
+                os.remove(path)
+    log_garbage_report(report, dry_run, 'runtime property blobs')
+    return report
+
+
+def collect_playbook_sources(deployment_dir,
+                             dry_run=True,
+                             min_age=GC_MIN_AGE):
+    """Remove the cached playbook sources of a deployment that were not
+    used in the last min_age seconds. Playbooks run from a copy in the
+    workspace, so a source that is used again is just fetched again.
+
+    :param deployment_dir: The deployment dir.
+    :param dry_run: Only report what would be removed.
+    :param min_age: Skip sources used in the last min_age seconds.
+    :return: dict of the removed paths to their size in bytes.
+    """
+    report = {}
+    sources_dir = os.path.join(deployment_dir, PLAYBOOK_SOURCES_DIR)
+    if not os.path.isdir(sources_dir):
+        return report
+    now = time.time()
+    for key in sorted(os.listdir(sources_dir)):
+        cache_dir = os.path.join(sources_dir, key)
+        if os.path.islink(cache_dir) or not os.path.isdir(cache_dir):
+            continue
+        with lock_file(os.path.join(cache_dir, '.lock')):
+            metadata_file = os.path.join(cache_dir, 'metadata.json')
+            if os.path.isfile(metadata_file):
+                last_used = os.path.getmtime(metadata_file)
+            else:
+                last_used = os.path.getmtime(cache_dir)
+            if now - last_used < min_age:
+                continue
+            report[cache_dir] = collect_dir(cache_dir, dry_run)
+    return report
+
+
+def get_template_venv(_ctx, ansible_to_install):
+    """Get the template venv with ansible installed, building it once
+    for all deployments of the tenant.
+
+    :param _ctx: cloudify context.
+    :param ansible_to_install: ANSIBLE_TO_INSTALL or installation_source.
+    :return: The path to the template venv and the recorded pip freeze.
+    """
+    instance = get_instance(_ctx)
+    templates_dir = get_shared_venvs_dir(_ctx, TEMPLATE_VENVS_DIR)
+    key = get_shared_venv_key(ansible_to_install)
+    template_dir = os.path.join(templates_dir, key)
+    venv_path = os.path.join(template_dir, 'venv')
+    metadata_file = os.path.join(template_dir, 'metadata.json')
+    with lock_file(os.path.join(templates_dir, key + '.lock')):
+        if not os.path.isfile(metadata_file):
+            _ctx.logger.info(
+                "Installing new template python venv: {}".format(venv_path))
+            delete_temp_folder(template_dir)
+            os.makedirs(template_dir)
+            os.chmod(template_dir, 0o755)
+            wheelhouse = get_offline_path(_ctx, 'wheelhouse_path')
+            make_virtualenv(path=venv_path, wheelhouse=wheelhouse)
+            install_packages_to_venv(venv_path,
+                                     [ansible_to_install],
+                                     wheelhouse,
+                                     get_pip_index_url(_ctx))
+            with open(metadata_file, 'w') as f:
+                json.dump({
+                    'ansible': ansible_to_install,
+                    'installed_packages':
+                        instance.runtime_properties.get(INSTALLED_PACKAGES),
+                }, f)
+        with open(metadata_file) as f:
+            metadata = json.load(f)
+        # The last use, for collect_template_venvs.
+        os.utime(metadata_file)
+    return venv_path, metadata.get('installed_packages')
+
+
+def _link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        # Not on the same file system.
+        shutil.copy2(source, destination)
+
+
+def clone_venv(template_path, venv_path):
+    """Clone a venv by hard linking its files, and rewriting the files
+    that refer to the template location: scripts in bin and pyvenv.cfg.
+    Rewritten files are new files, so the template is never changed.
+    Since the files are shared, anything that changes files in the venv
+    must replace them and not write into them.
+
+    :param template_path: The venv to clone.
+    :param venv_path: The new venv location, an empty or missing directory.
+    """
+    old_location = template_path.encode()
+    new_location = venv_path.encode()
+    for root, dirs, files in os.walk(template_path):
+        relative_root = os.path.relpath(root, template_path)
+        target_root = os.path.normpath(os.path.join(venv_path, relative_root))
+        if not os.path.isdir(target_root):
+            os.makedirs(target_root)
+        for name in list(dirs):
+            source = os.path.join(root, name)
+            if os.path.islink(source):
+                # Like lib64 -> lib, os.walk does not enter these.
+                os.symlink(os.readlink(source),
+                           os.path.join(target_root, name))
+                dirs.remove(name)
+        for name in files:
+            source = os.path.join(root, name)
+            destination = os.path.join(target_root, name)
+            if os.path.islink(source):
+                link = os.readlink(source)
+                if link.startswith(template_path):
+                    link = venv_path + link[len(template_path):]
+                os.symlink(link, destination)
+                continue
+            if relative_root == 'bin' or name == 'pyvenv.cfg':
+                with open(source, 'rb') as f:
+                    content = f.read()
+                is_text = content.startswith(b'#!') or \
+                    name.startswith('activate') or name == 'pyvenv.cfg'
+                if is_text and old_location in content:
+                    with open(destination, 'wb') as f:
+                        f.write(content.replace(old_location, new_location))
+                    shutil.copymode(source, destination)
+                    continue
+            _link_or_copy(source, destination)
+
+
+def run_provisioning_pipeline(_ctx, steps, max_workers=1):
+    """Run provisioning steps on a thread pool. A step starts when all
+    the steps it depends on succeeded, and steps that depend on a failed
+    step are skipped.
+
+    :param _ctx: cloudify context, set as the current context of each step.
+    :param steps: list of (name, function, list of dependency names).
+    :param max_workers: how many steps may run at the same time.
+    """
+    # The ctx proxy is thread local, so pass the object behind it.
+    _ctx = getattr(_ctx, '_get_current_object', lambda: _ctx)()
+
+    def _run_step(func):
+        current_ctx.set(_ctx)
+        try:
+            return func()
+        finally:
+            current_ctx.clear()
+
+    pending = dict((name, (func, dependencies))
+                   for name, func, dependencies in steps)
+    succeeded = set()
+    skipped = set()
+    failures = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        while pending or running:
+            for name, (func, dependencies) in list(pending.items()):
+                if any(d in failures or d in skipped for d in dependencies):
+                    del pending[name]
+                    skipped.add(name)
+                    _ctx.logger.error(
+                        'Skipping provisioning step {0}, because a step it '
+                        'depends on failed.'.format(name))
+                elif all(d in succeeded for d in dependencies):
+                    del pending[name]
+                    _ctx.logger.debug(
+                        'Starting provisioning step {0}.'.format(name))
+                    running[executor.submit(_run_step, func)] = name
+            if not running:
+                if not pending:
+                    break
+                raise NonRecoverableError(
+                    'Provisioning steps {0} depend on unknown steps.'.format(
+                        sorted(pending)))
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if future.exception():
+                    failures[name] = future.exception()
+                    _ctx.logger.error('Provisioning step {0} failed: '
+                                      '{1}'.format(name, failures[name]))
+                else:
+                    succeeded.add(name)
+    if len(failures) == 1:
+        # Keep the error type, so that retries still work.
+        raise list(failures.values())[0]
+    if failures:
+        raise NonRecoverableError(
+            'Provisioning steps failed: {0}'.format(
+                '; '.join('{0}: {1}'.format(name, failures[name])
+                          for name in sorted(failures))))
+
+
+def create_playbook_venv(_ctx, extra_packages=None):
     """
         Handle creation of virtual environments for running playbooks.
-        The virtual environments will be created at the deployment directory.
+        The virtual environments will be created at the deployment directory,
+        or taken from the shared venv store if use_shared_venv is set.
        :param _ctx: cloudify context.
+       :param extra_packages: list of python packages that will be installed
+        inside venv, part of the shared venv key.
        """
     node = get_node(_ctx)
     instance = get_instance(_ctx)
-    if is_connected_to_internet():
+    wheelhouse = get_offline_path(_ctx, 'wheelhouse_path')
+    index_url = get_pip_index_url(_ctx)
+    if wheelhouse or is_connected_to_internet(index_url):
         if install_new_venv_condition(_ctx):
-            _ctx.logger.info("Installing new python venv")
-            deployment_dir = get_deployment_dir(_ctx.deployment.id)
-            venv_path = mkdtemp(dir=deployment_dir)
-            os.chmod(venv_path, 0o755)
-            make_virtualenv(path=venv_path)
             ansible_to_install = [ANSIBLE_TO_INSTALL]
             if node.properties.get('installation_source'):
                 ansible_to_install = [
                     node.properties['installation_source']
                 ]
-            install_packages_to_venv(venv_path, ansible_to_install)
+            if node.properties.get('use_shared_venv'):
+                acquire_shared_venv(
+                    _ctx, ansible_to_install[0], extra_packages)
+                return
+            deployment_dir = get_deployment_dir(_ctx.deployment.id)
+            venv_path = mkdtemp(dir=deployment_dir)
+            os.chmod(venv_path, 0o755)
+            if node.properties.get('use_template_venv'):
+                template_path, installed_packages = get_template_venv(
+                    _ctx, ansible_to_install[0])
+                _ctx.logger.info("Cloning python venv {} from {}".format(
+                    venv_path, template_path))
+                clone_venv(template_path, venv_path)
+                # extra_packages are installed on top of these.
+                instance.runtime_properties[INSTALLED_PACKAGES] = \
+                    installed_packages
+            else:
+                _ctx.logger.info("Installing new python venv")
+                make_virtualenv(path=venv_path, wheelhouse=wheelhouse)
+                install_packages_to_venv(
+                    venv_path, ansible_to_install, wheelhouse, index_url)
             instance.runtime_properties[PLAYBOOK_VENV] = venv_path
             instance.runtime_properties[LOCAL_VENV] = True
 
@@ -1058,14 +3335,37 @@ def create_playbook_venv(_ctx):
         instance.runtime_properties[PLAYBOOK_VENV] = ''
 
 
-def is_connected_to_internet():
+def is_connected_to_internet(url=None):
+    """Check that the index we install from is reachable.
+    The result is cached for CONNECTIVITY_CACHE_TTL seconds, so that
+    a single operation does not pay for the timeout more than once.
+    The probe is a HEAD request, made without holding the cache lock.
+
+    :param url: the pip index or galaxy server to probe.
+    :return: bool
+    """
+    url = url or DEFAULT_PIP_INDEX_URL
+    with _connectivity_lock:
+        probe_time, connected = _connectivity_cache.get(url, (None, None))
+    if probe_time and time.time() - probe_time < CONNECTIVITY_CACHE_TTL:
+        return connected
+    request = Request(url)
+    request.get_method = lambda: 'HEAD'
     try:
-        urlopen('http://google.com', timeout=5)
-        ctx.logger.debug("Connected to internet.")
-        return True
-    except URLError:
-        ctx.logger.debug("No Internet connection.")
-        return False
+        with closing(urlopen(request, timeout=5)):
+            connected = True
+    except HTTPError:
+        # The server answered, so it is reachable.
+        connected = True
+    except (OSError, ValueError):
+        connected = False
+    with _connectivity_lock:
+        _connectivity_cache[url] = (time.time(), connected)
+    if connected:
+        ctx.logger.debug("Connected to {0}.".format(url))
+    else:
+        ctx.logger.debug("No connection to {0}.".format(url))
+    return connected
 
 
 def process_execution(script_func, script_path, ctx, process=None):
@@ -1136,6 +3436,460 @@ def process_execution(script_func, script_path, ctx, process=None):
         return actual_result
 
 
+def load_inventory(inventory_path, env=None):
+    """The inventory written by handle_sources, or the output of the
+    inventory script written by write_inventory_script, to shard it.
+
+    :param inventory_path: The inventory ansible runs with.
+    :param env: The environment ansible runs the inventory script with.
+    :return: The inventory dict, or None for an inventory that is not
+        JSON, like an INI file provided by the user.
+    """
+    try:
+        if os.path.basename(inventory_path) == INVENTORY_SCRIPT:
+            inventory = json.loads(subprocess.check_output(
+                [inventory_path, '--list'],
+                env=dict(os.environ, **(env or {}))).decode('utf-8'))
+        else:
+            with open(inventory_path) as f:
+                inventory = json.load(f)
+    except (IOError, OSError, ValueError, TypeError,
+            subprocess.CalledProcessError):
+        return
+    return inventory if isinstance(inventory, dict) else None
+
+
+def write_shard_limits(_ctx, shards, shard_by='hash', inventory=None):
+    """Split the hosts of the inventory the playbook runs with into
+    shards, and write the --limit file of each shard to the workspace.
+
+    :param _ctx: The Cloudify context.
+    :param shards: The number of shards.
+    :param shard_by: hash or group, see shard_inventory_hosts.
+    :param inventory: The inventory dict, with the hostnames exactly as
+        ansible gets them.
+    :return: The paths of the limit files. Empty when there is no
+        inventory dict, or it has hosts for only one shard.
+    """
+
+    instance = get_instance(_ctx)
+    if not shards or shards < 2 or not isinstance(inventory, dict):
+        return []
+    try:
+        host_shards = shard_inventory_hosts(inventory, shards, shard_by)
+    except CloudifyAnsibleSDKError as e:
+        raise NonRecoverableError(str(e))
+    if len(host_shards) < 2:
+        return []
+    shards_dir = os.path.join(
+        instance.runtime_properties[WORKSPACE], SHARDS_DIR)
+    if not os.path.isdir(shards_dir):
+        os.makedirs(shards_dir)
+    limit_files = []
+    for index, hostnames in enumerate(host_shards):
+        limit_file = os.path.join(shards_dir, 'limit-{0}'.format(index))
+        write_file_if_changed(
+            limit_file, '\n'.join(hostnames + ['']).encode('utf-8'))
+        limit_files.append(limit_file)
+    return limit_files
+
+
+def merge_playbook_outputs(outputs):
+    """Merge the JSON outputs of playbook shards. The shards have no hosts
+    in common, so their plays are concatenated and their stats joined.
+
+    :param outputs: The stdout of each shard.
+    :return: The merged result, or None if an output is not JSON.
+    """
+
+    merged = {'plays': [], 'stats': {}}
+    for output in outputs:
+        try:
+            result = json.loads((output or '').split('META: ran handlers')[-1])
+        except ValueError:
+            return
+        if not isinstance(result, dict):
+            return
+        merged['plays'].extend(result.get('plays') or [])
+        merged['stats'].update(result.get('stats') or {})
+    return merged
+
+
+HOST_RESULT_RE = re.compile(r'^(\S+) \| [A-Z!]+(?: \| rc=-?\d+)? => ', re.M)
+
+
+def get_hosts_facts(string):
+    """The facts of each host in the output of the ansible setup module.
+
+    :param string: The output, with a "host | SUCCESS => {...}" result
+        per host.
+    :return: A dict of hostnames to facts.
+    """
+    decoder = json.JSONDecoder(strict=False)
+    hosts_facts = {}
+    for match in HOST_RESULT_RE.finditer(string or ''):
+        try:
+            result, _ = decoder.raw_decode(string, match.end())
+        except ValueError:
+            continue
+        if isinstance(result, dict) and 'ansible_facts' in result:
+            hosts_facts[match.group(1)] = result['ansible_facts']
+    return hosts_facts
+
+
+def merge_facts_outputs(outputs):
+    """Merge the facts in the outputs of the setup module of each shard.
+
+    :return: A dict of hostnames to facts.
+    """
+    hosts_facts = {}
+    for output in outputs:
+        hosts_facts.update(get_hosts_facts(output))
+    return hosts_facts
+
+
+def render_hosts_facts(hosts_facts):
+    # The output of the setup module for these facts, for get_facts.
+    return '\n'.join(
+        '{0} | SUCCESS => {1}'.format(
+            hostname, json.dumps({'ansible_facts': facts}))
+        for hostname, facts in hosts_facts.items())
+
+
+def sharded_executor(script_path, ctx, process):
+    """A script_func for process_execution, that runs a process per shard
+    with the args in process['shard_args'], at most
+    process['shard_concurrency'] at a time. The shards fail together like
+    one process: the exception has the exit code of the worst shard, and
+    the merged output of all of them. The outputs are merged as playbook
+    JSON outputs, or as facts when process['shard_output'] is 'facts'.
+
+    :param script_path:
+    :param ctx:
+    :param process:
+    :return: stdout string
+    """
+
+    # The ctx proxy is thread local, so pass the object behind it.
+    ctx = getattr(ctx, '_get_current_object', lambda: ctx)()
+    process = dict(process)
+    shard_args = process.pop('shard_args')
+    shard_output = process.pop('shard_output', None)
+    max_workers = process.pop('shard_concurrency', None) or len(shard_args)
+    script_func = get_executor(process)
+
+    def _run_shard(args):
+        current_ctx.set(ctx)
+        try:
+            return script_func(
+                script_path, ctx, dict(process, args=args)), None
+        except ProcessException as e:
+            return e.stdout, e
+        finally:
+            current_ctx.clear()
+
+    with ThreadPoolExecutor(
+            max_workers=max(1, min(max_workers, len(shard_args)))) as executor:
+        results = list(executor.map(_run_shard, shard_args))
+    outputs = [output for output, _ in results]
+    errors = [error for _, error in results if error]
+    if shard_output == 'facts':
+        hosts_facts = merge_facts_outputs(outputs)
+        output = render_hosts_facts(hosts_facts)
+        ctx.logger.info(
+            'Ran {0} shards, {1} failed. Facts of {2} hosts.'.format(
+                len(results), len(errors), len(hosts_facts)))
+    else:
+        merged = merge_playbook_outputs(outputs)
+        output = json.dumps(merged) if merged else '\n'.join(
+            output for output in outputs if output)
+        if merged:
+            ctx.logger.info('Ran {0} shards, {1} failed. Stats: {2}'.format(
+                len(results), len(errors), json.dumps(merged['stats'])))
+    if errors:
+        # A failure is worse than unreachable hosts, which are retried.
+        error = sorted(
+            errors, key=lambda e: e.exit_code in UNREACHABLE_CODES)[0]
+        raise ProcessException(
+            error.command,
+            error.exit_code,
+            output,
+            '\n'.join(e.stderr for e in errors if e.stderr))
+    return output
+
+
+def get_executor(process):
+    """The script_func that runs a process: the resident worker of the
+    venv when process['worker_idle_timeout'] is set, see worker_executor.
+    """
+    if process.get('worker_idle_timeout'):
+        return worker_executor
+    return general_executor
+
+
+def get_worker_socket_path(script_path, env, cwd=None):
+    """The socket of the worker that runs script_path with env. Ansible
+    reads its configuration when it is imported, so runs share a worker
+    only when the venv, the working directory, the ANSIBLE_ variables and
+    the ansible.cfg they run with are the same.
+    """
+    digest = hashlib.sha256()
+    script_stat = os.stat(script_path)
+    items = [os.path.realpath(script_path),
+             script_stat.st_ino,
+             script_stat.st_mtime,
+             cwd or os.getcwd()]
+    items.extend(sorted('{0}={1}'.format(key, value)
+                        for key, value in env.items()
+                        if key.startswith('ANSIBLE_')))
+    config = env.get('ANSIBLE_CONFIG')
+    if config and os.path.isfile(config):
+        items.append(get_file_digest(config))
+    for item in items:
+        digest.update('{0}\0'.format(item).encode('utf-8'))
+    workers_dir = os.path.join(
+        tempfile.gettempdir(), WORKERS_DIR.format(uid=os.getuid()))
+    if not os.path.isdir(workers_dir):
+        os.makedirs(workers_dir, mode=0o700)
+    return os.path.join(
+        workers_dir, '{0}.sock'.format(digest.hexdigest()[:32]))
+
+
+def _connect_worker(socket_path):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+    except (OSError, socket.error):
+        conn.close()
+        raise
+    return conn
+
+
+def start_worker(python, socket_path, env, cwd=None, idle_timeout=None):
+    """Start the worker of socket_path, unless it is running.
+
+    :param python: The python of the venv of the worker.
+    :param socket_path: See get_worker_socket_path.
+    :param env: The env the worker is started with.
+    :param cwd: The working directory of the worker.
+    :param idle_timeout: Seconds without runs before the worker exits.
+    """
+    with lock_file(socket_path + '.lock'):
+        try:
+            _connect_worker(socket_path).close()
+            return
+        except (OSError, socket.error):
+            pass
+        with open(socket_path + '.log', 'ab') as log:
+            process = subprocess.Popen(
+                [python, worker.__file__, socket_path, str(idle_timeout)],
+                env=env,
+                cwd=cwd,
+                stdin=subprocess.DEVNULL,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                close_fds=True,
+                start_new_session=True)
+        deadline = time.time() + WORKER_START_TIMEOUT
+        while time.time() < deadline:
+            try:
+                _connect_worker(socket_path).close()
+                return
+            except (OSError, socket.error):
+                if process.poll() is not None:
+                    break
+                time.sleep(0.05)
+        raise OSError(
+            'The worker {0} did not start, see {1}.log'.format(
+                socket_path, socket_path))
+
+
+def _request_worker(socket_path, request, fds):
+    """Send a run to the worker.
+
+    :return: The connection, with the pid of the run read.
+    """
+    conn = _connect_worker(socket_path)
+    try:
+        worker.send_message(conn, request, fds)
+        reader = conn.makefile('rb')
+        ack = json.loads(reader.readline().decode('utf-8') or 'null')
+    except (OSError, socket.error, ValueError):
+        conn.close()
+        raise OSError('The worker {0} did not answer.'.format(socket_path))
+    if not isinstance(ack, dict) or 'pid' not in ack:
+        conn.close()
+        raise OSError('The worker {0} did not answer.'.format(socket_path))
+    return conn, reader
+
+
+class WorkerExecution(object):
+    """A run of a resident worker, with the logging and exceptions of
+    cloudify_common_sdk.processes.GeneralExecutor.
+    """
+
+    def __init__(self, command, ctx, log_stdout=True, log_stderr=True):
+        self.command = command
+        self.ctx = ctx
+        self.logger = ctx.logger
+        self.log_stdout = log_stdout
+        self.log_stderr = log_stderr
+        self.return_code = None
+        self._stdout = []
+        self._stderr = []
+
+    @property
+    def stdout(self):
+        return '\n'.join(self._stdout)
+
+    @property
+    def stderr(self):
+        return '\n'.join(self._stderr)
+
+    def emit(self, line, err=False):
+        message = line.decode('ascii', 'ignore').rstrip('\r\n')
+        if err:
+            self._stderr.append(message)
+            if self.log_stderr:
+                self.logger.error(
+                    '<err>: {0}'.format(obfuscate_passwords(message)))
+        else:
+            self._stdout.append(message)
+            if self.log_stdout:
+                self.logger.info(obfuscate_passwords(message))
+
+    def run(self, socket_path, request, proxy):
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        try:
+            conn, reader = _request_worker(
+                socket_path, request, [stdout_w, stderr_w])
+        except OSError:
+            for fd in (stdout_r, stdout_w, stderr_r, stderr_w):
+                os.close(fd)
+            raise
+        os.close(stdout_w)
+        os.close(stderr_w)
+        buffers = {stdout_r: b'', stderr_r: b''}
+        with conn, reader, selectors.DefaultSelector() as selector:
+            for fd in buffers:
+                selector.register(fd, selectors.EVENT_READ)
+            while buffers:
+                process_ctx_request(proxy)
+                for key, _ in selector.select(POLL_LOOP_INTERVAL):
+                    fd = key.fileobj
+                    data = os.read(fd, 65536)
+                    lines = (buffers[fd] + data).split(b'\n')
+                    buffers[fd] = lines.pop()
+                    if not data:
+                        if buffers[fd]:
+                            lines.append(buffers[fd])
+                        selector.unregister(fd)
+                        os.close(fd)
+                        del buffers[fd]
+                    for line in lines:
+                        self.emit(line, err=fd == stderr_r)
+            try:
+                result = json.loads(reader.readline().decode('utf-8'))
+                self.return_code = result['exit_code']
+            except (OSError, socket.error, ValueError, KeyError, TypeError):
+                self.logger.error(
+                    'Lost the connection to the worker {0}.'.format(
+                        socket_path))
+
+    def check_exception(self):
+        if isinstance(self.ctx._return_value, RuntimeError):
+            raise NonRecoverableError(str(self.ctx._return_value))
+        elif self.return_code is None:
+            # The run may have partly changed the hosts, it is not retried.
+            raise NonRecoverableError(
+                'The worker did not report the exit code of {0}.'.format(
+                    self.command))
+        elif self.return_code != 0:
+            if not (self.ctx.is_script_exception_defined and isinstance(
+                    self.ctx._return_value, ScriptException)):
+                raise ProcessException(
+                    self.command, self.return_code, self.stdout, self.stderr)
+
+
+def get_process_argv(script_path, args):
+    """The argv of a process, with each of its args split like a shell
+    would split it, without expansions. An arg may be more than one word,
+    like '-i hosts', or quote its value, like --key="value".
+
+    :raise ValueError: An arg has unbalanced quotes.
+    """
+    argv = [script_path]
+    for arg in args or []:
+        argv.extend(shlex.split(arg))
+    return argv
+
+
+def worker_executor(script_path, ctx, process):
+    """A script_func for process_execution, like general_executor, that
+    runs the process in the resident worker of the venv of script_path.
+    The worker is started on first use, and exits after
+    process['worker_idle_timeout'] seconds without runs. When the worker
+    can not be used, the process runs with general_executor.
+
+    :param script_path:
+    :param ctx:
+    :param process:
+    :return: stdout string
+    """
+
+    python = os.path.join(os.path.dirname(script_path), 'python')
+    if not os.path.isfile(python) or process.get('command_prefix'):
+        return general_executor(script_path, ctx, process)
+    try:
+        argv = get_process_argv(script_path, process.get('args'))
+    except ValueError as e:
+        ctx.logger.warning(
+            'Not using a resident worker, the args can not be split: '
+            '{0}'.format(e))
+        return general_executor(script_path, ctx, process)
+
+    proxy = start_ctx_proxy(ctx, process)
+    env = GeneralExecutor.desecretize_env(
+        _get_process_environment(process, proxy))
+    cwd = process.get('cwd')
+    command = ' '.join([script_path] + (process.get('args') or []))
+    request = {
+        'argv': argv,
+        'env': dict((key, str(value)) for key, value in env.items()),
+        'cwd': cwd,
+    }
+    execution = WorkerExecution(command,
+                                ctx,
+                                process.get('log_stdout', True),
+                                process.get('log_stderr', True))
+    try:
+        socket_path = get_worker_socket_path(script_path, env, cwd)
+        try:
+            execution.run(socket_path, request, proxy)
+        except OSError:
+            # The worker is not running, or is exiting after its idle time.
+            start_worker(python,
+                         socket_path,
+                         env,
+                         cwd,
+                         process['worker_idle_timeout'])
+            execution.run(socket_path, request, proxy)
+    except OSError as e:
+        ctx.logger.warning(
+            'Not using a resident worker: {0}'.format(e))
+        return general_executor(script_path, ctx, process)
+    finally:
+        try:
+            proxy.close()
+        except Exception:
+            ctx.logger.warning('Failed closing context proxy', exc_info=True)
+
+    execution.check_exception()
+    # some processes returns only stderr
+    return execution.stdout if execution.stdout else execution.stderr
+
+
 def get_message_from_failed_task(task, host):
     try:
         if task['hosts'][host]['failed']:
@@ -1217,10 +3971,14 @@ def get_facts(string):
     Ansible for dumping mixed format output.
 
     :param string:
-    :return:
+    :return: The facts of the host, or a dict of hostnames to facts when
+        the output has more than one host, like the output of shards.
     """
-    # ctx.logger.info('TRYING THIS')
-    # ctx.logger.info(string)
+    hosts_facts = get_hosts_facts(string)
+    if len(hosts_facts) == 1:
+        return list(hosts_facts.values())[0]
+    elif hosts_facts:
+        return hosts_facts
     new_string = []
     for line in string.split('\n'):
         if line.startswith('META'):
@@ -0,0 +1,334 @@
+# Copyright (c) 2019 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A resident fork server for ansible-playbook and ansible.
+
+The worker runs with the python of a playbook venv, imports ansible once,
+and forks a child per request that runs the venv's ansible-playbook or
+ansible script, so that a run does not pay for starting the interpreter
+and importing ansible again.
+
+Requests come over a Unix socket, one per connection: a JSON line with
+the argv, env and cwd of the run, and the stdout and stderr of the run as
+file descriptors. The worker answers with a JSON line with the pid of the
+child, and another with its exit code. When the client disconnects
+before the child exits, the child's process group is terminated.
+
+Ansible reads its configuration when it is imported, so a worker only
+serves runs with the configuration it was started with. The client keys
+the socket path by it, see utils.get_worker_socket_path.
+
+This module runs in the playbook venv, and uses only the standard library.
+"""
+
+import os
+import sys
+import json
+import time
+import array
+import errno
+import runpy
+import atexit
+import random
+import signal
+import socket
+import tempfile
+import importlib
+import selectors
+import traceback
+
+PRELOAD_MODULES = [
+    'ansible.constants',
+    'ansible.cli.playbook',
+    'ansible.cli.adhoc',
+    'ansible.executor.playbook_executor',
+    'ansible.executor.task_queue_manager',
+    'ansible.inventory.manager',
+    'ansible.parsing.dataloader',
+    'ansible.playbook',
+    'ansible.plugins.loader',
+    'ansible.template',
+    'ansible.vars.manager',
+    'ansible.executor.process.worker',
+    'ansible.plugins.action.normal',
+    'ansible.plugins.callback.default',
+    'ansible.plugins.connection.local',
+    'ansible.plugins.connection.ssh',
+    'ansible.plugins.strategy.linear',
+]
+MAX_FDS = 2
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+REQUEST_TIMEOUT = 10
+
+
+def preload(modules=None):
+    """Import the modules that every run needs. A module that is missing
+    in this version of ansible is skipped.
+    """
+    loaded = []
+    for module in PRELOAD_MODULES if modules is None else modules:
+        try:
+            importlib.import_module(module)
+        except Exception:
+            continue
+        loaded.append(module)
+    return loaded
+
+
+def send_message(conn, message, fds=()):
+    data = json.dumps(message).encode('utf-8') + b'\n'
+    if fds:
+        conn.sendmsg([data], [(socket.SOL_SOCKET,
+                               socket.SCM_RIGHTS,
+                               array.array('i', fds))])
+    else:
+        conn.sendall(data)
+
+
+def recv_request(conn):
+    """Read a request line, and the file descriptors sent with it."""
+    data = b''
+    fds = array.array('i')
+    while not data.endswith(b'\n'):
+        chunk, ancdata, _, _ = conn.recvmsg(
+            65536, socket.CMSG_SPACE(MAX_FDS * fds.itemsize))
+        for level, kind, cmsg_data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(cmsg_data[:len(cmsg_data) -
+                                        len(cmsg_data) % fds.itemsize])
+        if not chunk:
+            break
+        data += chunk
+        if len(data) > MAX_MESSAGE_SIZE:
+            break
+    try:
+        request = json.loads(data.decode('utf-8'))
+    except ValueError:
+        request = None
+    return request, list(fds)
+
+
+def get_exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def run_child(request, stdout_fd, stderr_fd):
+    """Run the script of the request in this process, as if it was
+    executed with its argv, env and cwd.
+
+    :return: The exit code.
+    """
+    os.setpgid(0, 0)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    stdin_fd = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(stdin_fd, 0)
+    os.dup2(stdout_fd, 1)
+    os.dup2(stderr_fd, 2)
+    for fd in (stdin_fd, stdout_fd, stderr_fd):
+        os.close(fd)
+
+    os.environ.clear()
+    os.environ.update(request['env'])
+    # Both are computed once per process, and this one is a copy.
+    tempfile.tempdir = None
+    random.seed()
+    if request.get('cwd'):
+        os.chdir(request['cwd'])
+    sys.argv = list(request['argv'])
+
+    try:
+        runpy.run_path(sys.argv[0], run_name='__main__')
+        exit_code = 0
+    except SystemExit as e:
+        if e.code is None:
+            exit_code = 0
+        elif isinstance(e.code, int):
+            exit_code = e.code
+        else:
+            sys.stderr.write('{0}\n'.format(e.code))
+            exit_code = 1
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+    try:
+        atexit._run_exitfuncs()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    return exit_code
+
+
+class Worker(object):
+
+    def __init__(self, socket_path, idle_timeout):
+        self.socket_path = socket_path
+        self.idle_timeout = idle_timeout
+        self.selector = selectors.DefaultSelector()
+        self.children = {}
+        self.listener = None
+        self.inode = None
+        self.wakeup_r, self.wakeup_w = os.pipe()
+
+    def listen(self):
+        """Bind a new socket and move it to the socket path, replacing
+        the socket of a worker that is exiting.
+        """
+        temp_path = '{0}.{1}'.format(self.socket_path, os.getpid())
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(temp_path)
+        os.chmod(temp_path, 0o600)
+        self.listener.listen(64)
+        self.inode = os.stat(temp_path).st_ino
+        os.rename(temp_path, self.socket_path)
+        self.selector.register(self.listener, selectors.EVENT_READ)
+
+    def close(self):
+        try:
+            if os.stat(self.socket_path).st_ino == self.inode:
+                os.unlink(self.socket_path)
+        except OSError:
+            pass
+        self.selector.close()
+        if self.listener:
+            self.listener.close()
+
+    def handle_request(self):
+        conn, _ = self.listener.accept()
+        conn.settimeout(REQUEST_TIMEOUT)
+        try:
+            request, fds = recv_request(conn)
+        except (OSError, socket.timeout):
+            conn.close()
+            return
+        if not request or len(fds) != 2:
+            for fd in fds:
+                os.close(fd)
+            conn.close()
+            return
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                signal.set_wakeup_fd(-1)
+                self.selector.close()
+                self.listener.close()
+                os.close(self.wakeup_r)
+                os.close(self.wakeup_w)
+                conn.close()
+                for child_conn in self.children.values():
+                    child_conn.close()
+                exit_code = run_child(request, *fds)
+            finally:
+                os._exit(exit_code)
+        for fd in fds:
+            os.close(fd)
+        conn.settimeout(None)
+        self.children[pid] = conn
+        try:
+            send_message(conn, {'pid': pid})
+        except OSError:
+            self.hangup(conn)
+            return
+        self.selector.register(conn, selectors.EVENT_READ)
+
+    def hangup(self, conn):
+        """The client of a child is gone, so the run is cancelled."""
+        for pid, child_conn in self.children.items():
+            if child_conn is conn:
+                try:
+                    os.killpg(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+    def reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            if not pid:
+                break
+            conn = self.children.pop(pid, None)
+            if not conn:
+                continue
+            try:
+                self.selector.unregister(conn)
+            except (KeyError, ValueError):
+                pass
+            try:
+                send_message(conn, {'exit_code': get_exit_code(status)})
+            except OSError:
+                pass
+            conn.close()
+
+    def serve(self):
+        for fd in (self.wakeup_r, self.wakeup_w):
+            os.set_blocking(fd, False)
+        signal.set_wakeup_fd(self.wakeup_w)
+        signal.signal(signal.SIGCHLD, lambda *_: None)
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+        self.listen()
+        last_active = time.time()
+        while True:
+            if self.children:
+                timeout = None
+            else:
+                timeout = last_active + self.idle_timeout - time.time()
+                if timeout <= 0:
+                    break
+            events = self.selector.select(timeout)
+            for key, _ in events:
+                if key.fileobj is self.listener:
+                    self.handle_request()
+                elif key.fileobj == self.wakeup_r:
+                    try:
+                        while os.read(self.wakeup_r, 512):
+                            pass
+                    except OSError:
+                        pass
+                else:
+                    try:
+                        data = key.fileobj.recv(512)
+                    except OSError:
+                        data = b''
+                    if not data:
+                        self.selector.unregister(key.fileobj)
+                        self.hangup(key.fileobj)
+            self.reap()
+            if events or self.children:
+                last_active = time.time()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    socket_path, idle_timeout = argv[0], float(argv[1])
+    preload()
+    worker = Worker(socket_path, idle_timeout)
+    try:
+        worker.serve()
+    finally:
+        worker.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
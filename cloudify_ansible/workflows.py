@@ -1,3 +1,21 @@
+import os
+
+from cloudify_common_sdk.utils import get_deployment_dir
+
+from cloudify_ansible.constants import (
+    GC_MIN_AGE,
+    SHARED_VENVS_DIR,
+    GALAXY_STORE_DIR,
+    TEMPLATE_VENVS_DIR)
+from cloudify_ansible.utils import (
+    collect_galaxy_store,
+    collect_shared_venvs,
+    log_garbage_report,
+    collect_orphaned_dirs,
+    collect_runtime_blobs,
+    collect_template_venvs,
+    collect_playbook_sources)
+
 
 PLAYBOOK_ARGS_PROPS = [
     'ansible_playbook_executable_path', 'extra_packages', 'galaxy_collections',
@@ -84,3 +102,33 @@ def update_playbook_venv(ctx,
                 allow_kwargs_override=True
             ))
     graph.execute()
+
+
+def collect_garbage(ctx, dry_run=True, min_age=GC_MIN_AGE, **kwargs):
+    """Remove the venvs, workspaces and module dirs of the deployment that
+    no node instance references anymore, e.g. after failed installs, the
+    runtime property blobs they do not refer to, its unused playbook
+    sources, and the entries of the tenant's shared venv, template venv
+    and galaxy stores that nothing uses anymore.
+
+    :return: dict of the removed paths to their size in bytes.
+    """
+    deployment_dir = get_deployment_dir(ctx.deployment.id)
+    report = collect_orphaned_dirs(deployment_dir,
+                                   ctx.node_instances,
+                                   dry_run=dry_run,
+                                   min_age=min_age)
+    report.update(collect_runtime_blobs(deployment_dir,
+                                        ctx.node_instances,
+                                        dry_run=dry_run,
+                                        min_age=min_age))
+    report.update(collect_playbook_sources(deployment_dir, dry_run, min_age))
+    # The stores are next to the deployment dirs of the tenant.
+    for store_name, collect in ((SHARED_VENVS_DIR, collect_shared_venvs),
+                                (TEMPLATE_VENVS_DIR, collect_template_venvs),
+                                (GALAXY_STORE_DIR, collect_galaxy_store)):
+        store_dir = os.path.join(os.path.dirname(deployment_dir), store_name)
+        if os.path.isdir(store_dir):
+            report.update(collect(store_dir, dry_run, min_age))
+    log_garbage_report(report, dry_run)
+    return report
@@ -172,6 +172,14 @@ class AnsiblePlaybookFromFile(object):
             self.module_path,
         ]
 
+    @staticmethod
+    def shard_args(args, limit_files):
+        """The args of one process per shard, limited to the hosts listed
+        in the shard's limit file.
+        """
+        return [args + ['--limit @{0}'.format(limit_file)]
+                for limit_file in limit_files]
+
     @property
     def facts_args(self):
         for key in list(self.options_config.keys()):
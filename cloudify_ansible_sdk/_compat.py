@@ -22,14 +22,17 @@ PY2 = sys.version_info[0] == 2
 
 if PY2:
     text_type = unicode
-    from urllib2 import urlopen, URLError
+    from urllib2 import urlopen, Request, URLError, HTTPError
     from StringIO import StringIO
+    intern = intern
 else:
     text_type = str
-    from urllib.request import urlopen
-    from urllib.error import URLError
+    from urllib.request import urlopen, Request
+    from urllib.error import URLError, HTTPError
     from io import StringIO
+    from sys import intern
 
 __all__ = [
-    'PY2', 'text_type', 'urlopen', 'URLError', 'StringIO'
+    'PY2', 'text_type', 'urlopen', 'Request', 'URLError', 'HTTPError',
+    'StringIO', 'intern'
 ]
@@ -12,8 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+
 from cloudify_ansible_sdk import CloudifyAnsibleSDKError
-from cloudify_ansible_sdk._compat import text_type
+from cloudify_ansible_sdk._compat import text_type, intern
+
+DEFAULT_SSH_COMMON_ARGS = '-o StrictHostKeyChecking=no'
+CONNECTION_VARS = frozenset([
+    'ansible_host',
+    'ansible_user',
+    'ansible_ssh_pass',
+    'ansible_ssh_private_key_file',
+    'ansible_become',
+    'ansible_ssh_common_args',
+])
 
 
 def legalize_hostnames(hostname):
@@ -25,12 +37,22 @@ def legalize_hostnames(hostname):
 
 
 class AnsibleSource(object):
+    """An inventory of host groups.
+
+    Hosts should be added, removed and moved through the source, which
+    keeps an index of the groups of each host. The config is built when it
+    is asked for, so a long lived source does not keep a second copy of
+    its hosts.
+    """
+
+    __slots__ = ('children', 'hosts', '_host_groups')
 
     def __init__(self, source_dict):
 
         source_dict = source_dict or {}
         self.children = {}
         self.hosts = {}
+        self._host_groups = {}
 
         if 'all' in source_dict:
             self.do_insert_children(source_dict['all'].get('children', {}))
@@ -49,46 +71,209 @@ class AnsibleSource(object):
 
     def insert_children(self, name, config=None):
         config = config or {}
-        self.children[name] = AnsibleHostGroup(name, **config)
+        if name in self.children:
+            for hostname in self.children[name].hosts:
+                self._unindex_host(hostname, name)
+        group = AnsibleHostGroup(name, **config)
+        self.children[name] = group
+        for hostname in group.hosts:
+            self._host_groups.setdefault(hostname, set()).add(name)
 
     def insert_hosts(self, name, config=None):
         name = legalize_hostnames(name)
         config = config or {}
-        self.hosts[name] = AnsibleHost(name, **config)
+        if list(config) == ['parameters']:
+            config = config['parameters']
+        self.hosts[name] = AnsibleHost(name, config)
+
+    def get_host_groups(self, hostname):
+        return set(self._host_groups.get(legalize_hostnames(hostname), ()))
+
+    def add_host(self, group_name, hostname, config=None):
+        group = self.children.get(group_name)
+        if not group:
+            group = self.children[group_name] = AnsibleHostGroup(group_name)
+        hostname = group.insert_host(hostname, config)
+        self._host_groups.setdefault(hostname, set()).add(group_name)
+
+    def remove_host(self, hostname, group_name=None):
+        """Remove a host from a group, or from all of its groups."""
+        hostname = legalize_hostnames(hostname)
+        if group_name:
+            group_names = [group_name]
+        else:
+            group_names = list(self._host_groups.get(hostname, ()))
+        for name in group_names:
+            group = self.children.get(name)
+            if group and hostname in group.hosts:
+                group.remove_host(hostname)
+                self._unindex_host(hostname, name)
+
+    def move_host(self, hostname, from_group, to_group):
+        hostname = legalize_hostnames(hostname)
+        group = self.children.get(from_group)
+        if not group or hostname not in group.hosts:
+            raise CloudifyAnsibleSDKError(
+                'Host {0} is not in group {1}.'.format(hostname, from_group))
+        host = group.hosts[hostname]
+        self.remove_host(hostname, from_group)
+        self.add_host(to_group, hostname, host)
+
+    def _unindex_host(self, hostname, group_name):
+        group_names = self._host_groups.get(hostname)
+        if group_names:
+            group_names.discard(group_name)
+            if not group_names:
+                del self._host_groups[hostname]
 
     def merge_source(self, ansible_source):
+        # Hosts that are already in a group keep their config.
         for group_name, group in ansible_source.children.items():
-            if group_name in self.children:
-                local_group = self.children.get(group_name)
-                for hostname, host in local_group.hosts.items():
-                    group.insert_host(hostname, host.config)
-            self.insert_children(group_name, group.config)
+            local_group = self.children.get(group_name)
+            if not local_group:
+                self.children[group_name] = AnsibleHostGroup(group_name)
+            for hostname, host in group.hosts.items():
+                if not local_group or hostname not in local_group.hosts:
+                    self.add_host(group_name, hostname, host)
 
     def remove_source(self, ansible_source):
         for group_name, group in ansible_source.children.items():
             if group_name in self.children:
-                local_group = self.children.get(group_name)
-                for hostname, _ in group.hosts.items():
-                    local_group.remove_host(hostname)
+                for hostname in group.hosts:
+                    self.remove_host(hostname, group_name)
 
     @property
     def config(self):
-        new_dict = {
+        return {
             'all': {
-                'hosts': {},
-                'children': {},
+                'hosts': dict(
+                    (hostname, host.config)
+                    for hostname, host in self.hosts.items()),
+                'children': dict(
+                    (group_name, group.config)
+                    for group_name, group in self.children.items()),
+            },
+        }
+
+    @property
+    def dynamic_inventory(self):
+        """The inventory in the JSON form of inventory scripts. The
+        hostvars of every host are under _meta, so ansible does not call
+        the script once per host.
+        """
+        hostvars = {}
+        inventory = {
+            '_meta': {'hostvars': hostvars},
+            'all': {
+                'hosts': list(self.hosts),
+                'children': list(self.children),
             },
         }
-        for group_name, group in self.children.items():
-            new_dict['all']['children'].update({group_name: group.config})
         for hostname, host in self.hosts.items():
-            hostname = legalize_hostnames(hostname)
-            new_dict['all']['hosts'].update({hostname: host.config})
-        return new_dict
+            hostvars.setdefault(hostname, {}).update(host.config)
+        for group_name, group in self.children.items():
+            inventory[group_name] = {'hosts': list(group.hosts)}
+            for hostname, host in group.hosts.items():
+                hostvars.setdefault(hostname, {}).update(host.config)
+        return inventory
+
+
+def get_inventory_groups(inventory):
+    """The hosts of each group of an inventory, named as they are written,
+    including the groups nested under children. The inventory is either
+    in the YAML/JSON form, or in the JSON form of inventory scripts.
+
+    :return: A dict of group names to lists of hostnames.
+    """
+    groups = {}
+
+    def _walk(name, config):
+        if isinstance(config, list):
+            hosts, children = config, None
+        elif isinstance(config, dict):
+            hosts = config.get('hosts') or []
+            children = config.get('children')
+        else:
+            return
+        group_hosts = groups.setdefault(name, [])
+        for hostname in hosts:
+            if hostname not in group_hosts:
+                group_hosts.append(hostname)
+        # In the script form, children lists the names of top level groups.
+        if isinstance(children, dict):
+            for child_name, child_config in children.items():
+                _walk(child_name, child_config)
+
+    for name, config in (inventory or {}).items():
+        if name != '_meta':
+            _walk(name, config)
+    return groups
+
+
+def shard_inventory_hosts(inventory, shards, by='hash'):
+    """Split the hosts of an inventory into at most shards lists, keeping
+    the hostnames as the inventory has them, so that they match the
+    --limit of each shard.
+
+    :param inventory: See get_inventory_groups.
+    :param shards: The number of shards.
+    :param by: hash or group, see shard_host_sets.
+    :return: A list of lists of hostnames.
+    """
+    groups = get_inventory_groups(inventory)
+    if by == 'hash':
+        host_sets = [[hostname]
+                     for hostnames in groups.values()
+                     for hostname in hostnames]
+    elif by == 'group':
+        named = sorted(
+            ((name, hostnames) for name, hostnames in groups.items()
+             if name not in ('all', 'ungrouped')),
+            key=lambda item: (-len(item[1]), item[0]))
+        host_sets = [hostnames for _, hostnames in named]
+        host_sets.append(groups.get('ungrouped', []))
+        host_sets.append(groups.get('all', []))
+    else:
+        raise CloudifyAnsibleSDKError(
+            'Cannot shard hosts by {0}, '
+            'expected hash or group.'.format(by))
+    return shard_host_sets(host_sets, shards, by)
+
+
+def shard_host_sets(host_sets, shards, by='hash'):
+    """Put lists of hosts in at most shards lists. A host is only put in
+    the shard of the first list that has it.
+
+    :param host_sets: Lists of hostnames.
+    :param shards: The number of shards.
+    :param by: hash, to put each list in a shard by the sha1 of its first
+        hostname, so that it stays there when hosts are added. group, to
+        put each list in the smallest shard, in order, so the largest
+        groups should come first.
+    :return: The non empty shards.
+    """
+    sharded = set()
+    host_shards = [[] for _ in range(max(1, shards))]
+    for hostnames in host_sets:
+        hostnames = [hostname for hostname in hostnames
+                     if hostname not in sharded]
+        if not hostnames:
+            continue
+        sharded.update(hostnames)
+        if by == 'hash':
+            digest = hashlib.sha1(hostnames[0].encode('utf-8'))
+            shard = host_shards[
+                int(digest.hexdigest(), 16) % len(host_shards)]
+        else:
+            shard = min(host_shards, key=len)
+        shard.extend(hostnames)
+    return [hostnames for hostnames in host_shards if hostnames]
 
 
 class AnsibleHostGroup(object):
 
+    __slots__ = ('name', 'hosts')
+
     def __init__(self, name, hosts=None):
 
         self.name = name
@@ -100,8 +285,17 @@ class AnsibleHostGroup(object):
             self.insert_host(hostname, host_config)
 
     def insert_host(self, hostname, config):
+        """Insert a host, from its config or an AnsibleHost, and return
+        its legal name.
+        """
         hostname = legalize_hostnames(hostname)
-        self.hosts[hostname] = AnsibleHost(hostname, config)
+        if isinstance(config, AnsibleHost) and config.name == hostname:
+            self.hosts[hostname] = config
+        else:
+            if isinstance(config, AnsibleHost):
+                config = config.config
+            self.hosts[hostname] = AnsibleHost(hostname, config)
+        return hostname
 
     def remove_host(self, hostname):
         hostname = legalize_hostnames(hostname)
@@ -110,14 +304,21 @@ class AnsibleHostGroup(object):
 
     @property
     def config(self):
-        new_dict = {}
-        for hostname, host in self.hosts.items():
-            hostname = legalize_hostnames(hostname)
-            new_dict.update({hostname: host.config})
-        return {'hosts': new_dict}
+        return {
+            'hosts': dict(
+                (hostname, host.config)
+                for hostname, host in self.hosts.items()),
+        }
 
 
 class AnsibleHost(object):
+    """A host and its hostvars. Inventories can have tens of thousands of
+    hosts, so each host keeps only a tuple of values; the tuple of names
+    is shared by every host with the same hostvars, and the dict is only
+    built by config.
+    """
+
+    __slots__ = ('name', '_keys', '_values')
 
     def __init__(self, hostname, parameters):
 
@@ -125,28 +326,66 @@ class AnsibleHost(object):
 
         self.name = legalize_hostnames(hostname)
 
-        self.ansible_host = parameters.get('ansible_host')
-        self.ansible_user = parameters.get('ansible_user')
-        self.ansible_ssh_pass = parameters.get('ansible_ssh_pass')
-        self.ansible_ssh_private_key_file = parameters.get(
-            'ansible_ssh_private_key_file')
-
-        self.ansible_become = parameters.get('ansible_become')
-        self.ansible_ssh_common_args = parameters.get(
-            'ansible_ssh_common_args', '-o StrictHostKeyChecking=no')
-
-        self.config = {}
-        if self.ansible_host:
-            self.config['ansible_host'] = self.ansible_host
-        if self.ansible_user:
-            self.config['ansible_user'] = self.ansible_user
-        if self.ansible_ssh_pass:
-            self.config['ansible_ssh_pass'] = self.ansible_ssh_pass
-        if self.ansible_ssh_private_key_file:
-            self.config['ansible_ssh_private_key_file'] = \
-                self.ansible_ssh_private_key_file
-        if self.ansible_become:
-            self.config['ansible_become'] = self.ansible_become
-        if self.ansible_ssh_common_args:
-            self.config['ansible_ssh_common_args'] = \
-                self.ansible_ssh_common_args
+        keys = []
+        values = []
+        for key, value in parameters.items():
+            # Empty connection variables are left out, so that ansible
+            # uses its defaults.
+            if value is None or not value and key in CONNECTION_VARS:
+                continue
+            keys.append(key)
+            values.append(_intern_value(value))
+        if 'ansible_ssh_common_args' not in parameters:
+            keys.append('ansible_ssh_common_args')
+            values.append(DEFAULT_SSH_COMMON_ARGS)
+        self._keys = _get_hostvar_keys(keys)
+        self._values = tuple(values)
+
+    def get(self, key, default=None):
+        try:
+            return self._values[self._keys.index(key)]
+        except ValueError:
+            return default
+
+    @property
+    def ansible_host(self):
+        return self.get('ansible_host')
+
+    @property
+    def ansible_user(self):
+        return self.get('ansible_user')
+
+    @property
+    def ansible_ssh_pass(self):
+        return self.get('ansible_ssh_pass')
+
+    @property
+    def ansible_ssh_private_key_file(self):
+        return self.get('ansible_ssh_private_key_file')
+
+    @property
+    def ansible_become(self):
+        return self.get('ansible_become')
+
+    @property
+    def ansible_ssh_common_args(self):
+        return self.get('ansible_ssh_common_args')
+
+    @property
+    def config(self):
+        return dict(zip(self._keys, self._values))
+
+
+_hostvar_keys = {}
+
+
+def _get_hostvar_keys(keys):
+    keys = tuple(intern(str(key)) for key in keys)
+    return _hostvar_keys.setdefault(keys, keys)
+
+
+def _intern_value(value):
+    # Users, keys and ssh args repeat on every host.
+    if isinstance(value, str):
+        return intern(value)
+    return value
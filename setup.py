@@ -33,6 +33,7 @@ def get_version():
 install_requires = [
     'ansible',
     'pexpect==4.8.0',
+    'packaging',
 ]
 
 if sys.version_info.major == 3 and sys.version_info.minor == 6: